@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Create/read throughput of raw node stores at large node counts
+
+Creates nodes with uuid nodeids in a NoteBookConnectionFSRaw for each
+fan-out, then reads random nodes, streams all nodeids and reports the
+largest directory size.
+
+    python bench/fs_raw_scale.py --nodes 1000000 --fanout 2 --fanout 2/2
+"""
+
+# python imports
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# keepnote imports
+from keepnote.notebook.connection import fs_raw
+
+
+def get_max_dir_size(path, depth):
+    """Returns the most entries in a directory of the top 'depth' levels"""
+    most = 0
+    with os.scandir(path) as entries:
+        names = [entry for entry in entries if entry.is_dir()]
+    most = max(most, len(names))
+    if depth > 1:
+        for entry in names:
+            most = max(most, get_max_dir_size(entry.path, depth - 1))
+    return most
+
+
+def run(path, fanout, nnodes, nreads):
+    conn = fs_raw.NoteBookConnectionFSRaw(fanout=fanout)
+    conn.connect(path)
+
+    nodeids = []
+    start = time.time()
+    for i in range(nnodes):
+        nodeid = str(uuid.uuid4())
+        conn.create_node(nodeid, {"nodeid": nodeid, "title": "node %d" % i})
+        nodeids.append(nodeid)
+        if (i + 1) % 100000 == 0:
+            print("  created %d nodes (%.0f/s)" % (
+                i + 1, (i + 1) / (time.time() - start)))
+    create = time.time() - start
+
+    sample = [random.choice(nodeids) for i in range(nreads)]
+    start = time.time()
+    for nodeid in sample:
+        conn.read_node(nodeid)
+    read = time.time() - start
+
+    start = time.time()
+    nfound = sum(1 for nodeid in conn._nodefs.iter_nodeids())
+    scan = time.time() - start
+    assert nfound == nnodes, (nfound, nnodes)
+
+    shard_root = conn._nodefs._get_shard_root(conn.get_fanout())
+    most = get_max_dir_size(shard_root, len(conn.get_fanout()) + 1)
+    conn.close()
+
+    print("%-6s %12.0f %12.0f %12.0f %10d" % (
+        fs_raw.format_fanout(fanout), nnodes / create, nreads / read,
+        nnodes / scan, most))
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("--nodes", type="int", default=1000000)
+    parser.add_option("--reads", type="int", default=10000)
+    parser.add_option("--fanout", action="append",
+                      help="fan-out to test, e.g. 2/2 (repeatable)")
+    parser.add_option("--dir", help="create node stores in DIR")
+    options, args = parser.parse_args(argv[1:])
+
+    fanouts = [fs_raw.parse_fanout(text)
+               for text in (options.fanout or ["2", "2/2"])]
+    tmpdir = tempfile.mkdtemp(prefix="keepnote_fs_raw_", dir=options.dir)
+
+    print("%d nodes" % options.nodes)
+    print("%-6s %12s %12s %12s %10s" % (
+        "fanout", "create/s", "read/s", "scan/s", "max dir"))
+    try:
+        for fanout in fanouts:
+            path = os.path.join(tmpdir, fs_raw.format_fanout(fanout)
+                                .replace("/", "_"))
+            run(path, fanout, options.nodes, options.reads)
+            shutil.rmtree(path, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
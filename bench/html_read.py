@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Speed of the HTML tokenizers for reading richtext pages
+
+Reads the page.html fixtures from tests/data with each available
+tokenizer of HtmlBuffer, checks that they give the same contents and
+reports the throughput in MB of HTML per second.
+
+    python bench/html_read.py --repeat 5
+"""
+
+# python imports
+from io import StringIO
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# keepnote imports
+from keepnote.gui.richtext.richtext_html import HtmlBuffer, get_tokenizers
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "tests", "data")
+
+
+def find_pages(path):
+    for root, dirs, files in os.walk(path):
+        if "page.html" in files:
+            yield os.path.join(root, "page.html")
+
+
+def display_contents(contents):
+    """Returns a comparable form of buffer contents"""
+    items = []
+    for kind, pos, param in contents:
+        if kind == "anchor":
+            param = type(param[0]).__name__
+        elif not isinstance(param, str):
+            param = str(param)
+        items.append((kind, param))
+    return items
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("--repeat", type="int", default=5)
+    parser.add_option("--data", default=DATA_DIR)
+    options, args = parser.parse_args(argv[1:])
+
+    pages = []
+    for filename in sorted(find_pages(options.data)):
+        with open(filename, encoding="utf8") as infile:
+            pages.append(infile.read())
+    mb = sum(len(page.encode("utf8")) for page in pages) / float(1024 * 1024)
+    print("pages:      %d (%.2f MB)" % (len(pages), mb))
+
+    results = {}
+    for name in get_tokenizers():
+        html_buffer = HtmlBuffer(tokenizer=name)
+        start = time.time()
+        for i in range(options.repeat):
+            contents = [html_buffer.read(StringIO(page)) for page in pages]
+        seconds = time.time() - start
+        results[name] = [display_contents(page) for page in contents]
+        print("%-10s  %8.2f MB/s" % (name + ":",
+                                     mb * options.repeat / seconds))
+
+    names = list(results)
+    for name in names[1:]:
+        same = results[name] == results[names[0]]
+        print("%s matches %s: %s" % (name, names[0], same))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Throughput of writing richtext HTML
+
+Loads the page.html fixtures used by tests/test_richtext_html.py (from
+tests/data) into a RichTextBuffer and reports how fast HtmlBuffer writes
+them, in MB of HTML per second.  Requires GTK.
+
+    python bench/html_write.py --repeat 5
+"""
+
+# python imports
+from io import StringIO
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# keepnote imports
+from keepnote.gui.richtext.richtext_html import HtmlBuffer
+from keepnote.gui.richtext.richtextbuffer import RichTextBuffer, ignore_tag
+from keepnote.gui.richtext.textbuffer_tools import iter_buffer_contents_fast
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "tests", "data")
+
+
+def find_pages(path):
+    for root, dirs, files in os.walk(path):
+        if "page.html" in files:
+            yield os.path.join(root, "page.html")
+
+
+def load_page(filename):
+    buf = RichTextBuffer()
+    buf.block_signals()
+    with open(filename, encoding="utf8") as infile:
+        buf.load_contents(HtmlBuffer().read(infile, partial=True))
+    buf.unblock_signals()
+    return buf
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("--repeat", type="int", default=5)
+    parser.add_option("--data", default=DATA_DIR)
+    options, args = parser.parse_args(argv[1:])
+
+    buffers = [load_page(filename)
+               for filename in sorted(find_pages(options.data))]
+    html_buffer = HtmlBuffer()
+
+    # capture buffer contents once, like a background save
+    contents = [html_buffer.prepare_contents(
+        iter_buffer_contents_fast(buf, None, None, ignore_tag),
+        buf.tag_table) for buf in buffers]
+
+    size = 0
+    write_time = 0.0
+    total_time = 0.0
+    for i in range(options.repeat):
+        for buf, content in zip(buffers, contents):
+            out = StringIO()
+            html_buffer.set_output(out)
+            start = time.time()
+            html_buffer.write_contents(content)
+            write_time += time.time() - start
+            size += len(out.getvalue().encode("utf8"))
+
+            out = StringIO()
+            html_buffer.set_output(out)
+            start = time.time()
+            html_buffer.write(
+                iter_buffer_contents_fast(buf, None, None, ignore_tag),
+                buf.tag_table, partial=True)
+            total_time += time.time() - start
+
+    mb = size / float(1024 * 1024)
+    print("pages:            %d" % len(buffers))
+    print("html written:     %.2f MB" % mb)
+    print("write_contents:   %.2f MB/s" % (mb / max(write_time, 1e-9)))
+    print("buffer to html:   %.2f MB/s" % (mb / max(total_time, 1e-9)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
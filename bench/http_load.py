@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Load test for the notebook HTTP server
+
+Starts a notebook server (or uses a running one given with --url), then
+fires concurrent node and file reads/writes from several client threads
+and reports throughput and p50/p99 latency per operation.
+
+    python bench/http_load.py --threads 8 --requests 200 --threaded
+"""
+
+# python imports
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# keepnote imports
+from keepnote.notebook.connection import fs_raw
+from keepnote.notebook.connection.http import NoteBookConnectionHttp
+from keepnote.server import BaseNoteBookHttpServer
+
+
+def percentile(values, fraction):
+    """Returns a percentile of a sorted list"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def make_notebook(path, nnodes, file_size):
+    """Make a notebook with 'nnodes' pages, each with one file"""
+    conn = fs_raw.NoteBookConnectionFSRaw()
+    conn.connect(path)
+    conn.create_node("root", {"nodeid": "root", "title": "root"})
+    data = os.urandom(file_size)
+    for i in range(nnodes):
+        nodeid = "node%d" % i
+        conn.create_node(nodeid, {"nodeid": nodeid, "parentids": ["root"],
+                                  "title": "page %d" % i})
+        with conn.open_file(nodeid, "file.bin", "wb") as out:
+            out.write(data)
+    return conn
+
+
+def run_client(conn, nrequests, nnodes, write_ratio, file_size, timings):
+    """Issue random requests and record (operation, seconds)"""
+    data = os.urandom(file_size)
+    for i in range(nrequests):
+        nodeid = "node%d" % random.randrange(nnodes)
+        op = random.random()
+        start = time.time()
+        if op < write_ratio / 2:
+            name = "update_node"
+            conn.update_node(nodeid, {
+                "nodeid": nodeid, "parentids": ["root"],
+                "title": "page %s" % time.time()})
+        elif op < write_ratio:
+            name = "write_file"
+            with conn.open_file(nodeid, "file.bin", "wb") as out:
+                out.write(data)
+        elif op < (1 + write_ratio) / 2:
+            name = "read_node"
+            conn.read_node(nodeid)
+        else:
+            name = "read_file"
+            with conn.open_file(nodeid, "file.bin", "rb") as infile:
+                infile.read()
+        timings.append((name, time.time() - start))
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("--url", help="use a running server at URL")
+    parser.add_option("--port", type="int", default=8180)
+    parser.add_option("--threaded", action="store_true", default=False,
+                      help="use the threaded server mode")
+    parser.add_option("--threads", type="int", default=8,
+                      help="number of client threads")
+    parser.add_option("--requests", type="int", default=100,
+                      help="requests per client thread")
+    parser.add_option("--nodes", type="int", default=50)
+    parser.add_option("--file-size", type="int", default=256 * 1024)
+    parser.add_option("--write-ratio", type="float", default=0.2)
+    options, args = parser.parse_args(argv[1:])
+
+    server = None
+    tmpdir = None
+    url = options.url
+    if not url:
+        tmpdir = tempfile.mkdtemp(prefix="keepnote_load_")
+        conn = make_notebook(os.path.join(tmpdir, "notebook"),
+                             options.nodes, options.file_size)
+        server = BaseNoteBookHttpServer(conn, host="localhost",
+                                        port=options.port,
+                                        threaded=options.threaded)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = "http://localhost:%d/notebook/" % options.port
+
+    client = NoteBookConnectionHttp(pool_size=options.threads)
+    client.connect(url)
+    while True:
+        try:
+            client.get_rootid()
+            break
+        except Exception:
+            time.sleep(0.05)
+
+    timings = []
+    threads = [threading.Thread(
+        target=run_client,
+        args=(client, options.requests, options.nodes, options.write_ratio,
+              options.file_size, timings))
+        for i in range(options.threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = time.time() - start
+
+    print("server: %s" % ("threaded" if options.threaded else "single"))
+    print("requests: %d in %.2fs (%.1f req/s)" % (
+        len(timings), total, len(timings) / total))
+    print("%-12s %8s %10s %10s" % ("operation", "count", "p50 (ms)",
+                                   "p99 (ms)"))
+    names = sorted(set(name for name, seconds in timings))
+    for name in names + ["all"]:
+        values = sorted(seconds for name2, seconds in timings
+                        if name == "all" or name2 == name)
+        print("%-12s %8d %10.2f %10.2f" % (
+            name, len(values), 1000 * percentile(values, 0.5),
+            1000 * percentile(values, 0.99)))
+
+    client.close()
+    if server:
+        server.shutdown()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Speed of bullet list and indentation updates
+
+Builds a RichTextBuffer with many lines (no window needed), then times
+turning the whole buffer into a bullet list, indenting it and removing the
+bullets again.  Requires GTK.
+
+    python bench/indent_update.py --lines 10000
+"""
+
+# python imports
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# keepnote imports
+from keepnote.gui.richtext.richtextbuffer import RichTextBuffer
+
+
+def select_all(buf):
+    buf.select_range(buf.get_start_iter(), buf.get_end_iter())
+
+
+def timed(name, func):
+    start = time.time()
+    func()
+    print("%-20s %8.3f s" % (name + ":", time.time() - start))
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("--lines", type="int", default=10000)
+    options, args = parser.parse_args(argv[1:])
+
+    buf = RichTextBuffer()
+    buf.insert(buf.get_start_iter(), "".join(
+        "line %d of the list\n" % i for i in range(options.lines)))
+    buf.undo_stack.reset()
+
+    def bullets_on():
+        select_all(buf)
+        buf.toggle_bullet_list("bullet")
+
+    def indent():
+        select_all(buf)
+        buf.indent()
+
+    def bullets_off():
+        select_all(buf)
+        buf.toggle_bullet_list("none")
+
+    print("lines:               %d" % options.lines)
+    timed("bullets on", bullets_on)
+    timed("indent", indent)
+    timed("bullets off", bullets_off)
+    timed("undo", buf.undo)
+    print("undo steps:          %d" % len(buf.undo_stack))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
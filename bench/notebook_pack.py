@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Compare the directory notebook format with single-file packs
+
+Builds a notebook directory with many pages, copies it into a pack with
+keepnote.notebook.sync.copy_notebook, then times opening and walking each
+notebook, title and full text search, and saving edited pages.
+
+    python bench/notebook_pack.py --pages 5000
+"""
+
+# python imports
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# keepnote imports
+from keepnote import notebook
+from keepnote.notebook.connection import fs
+from keepnote.notebook.connection import pack
+import keepnote.notebook.sync as sync
+
+
+def write_page(page, text):
+    with page.open_file(notebook.PAGE_DATA_FILE, "w") as out:
+        out.write(notebook.NOTE_HEADER)
+        out.write(text)
+        out.write(notebook.NOTE_FOOTER)
+
+
+def make_notebook(path, npages, page_size):
+    """Make a notebook directory with 'npages' pages in folders of 100"""
+    book = notebook.NoteBook()
+    book.create(path)
+    words = ("alpha", "beta", "gamma", "delta", "epsilon", "zeta")
+    folder = None
+    for i in range(npages):
+        if i % 100 == 0:
+            folder = notebook.new_page(book, "folder %d" % (i // 100))
+        page = notebook.new_page(folder, "page %d" % i)
+        text = " ".join(words[(i + j) % len(words)]
+                        for j in range(page_size // 6))
+        write_page(page, "page%d %s" % (i, text))
+    book.close()
+
+
+def get_disk_usage(path):
+    """Returns (number of files, bytes) under a local path"""
+    if os.path.isfile(path):
+        return 1, os.path.getsize(path)
+    nfiles = size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            nfiles += 1
+            size += os.path.getsize(os.path.join(dirpath, name))
+    return nfiles, size
+
+
+def walk(node):
+    n = 1
+    for child in node.get_children():
+        n += walk(child)
+    return n
+
+
+def run(name, url, conn_class, nedits):
+    """Time a notebook format and print one row per operation"""
+    timings = []
+
+    start = time.time()
+    book = notebook.NoteBook()
+    book.load(url, conn_class())
+    nnodes = walk(book)
+    timings.append(("open+walk", time.time() - start))
+
+    start = time.time()
+    for i in range(20):
+        book.search_node_titles("page %d" % (i * 37))
+    timings.append(("title x20", time.time() - start))
+
+    start = time.time()
+    for i in range(20):
+        list(book.search_node_contents("page%d" % (i * 37)))
+    timings.append(("fulltext x20", time.time() - start))
+
+    nodeids = [nodeid for nodeid, title in
+               book.search_node_titles("page")][:nedits]
+    start = time.time()
+    for nodeid in nodeids:
+        page = book.get_node_by_id(nodeid)
+        write_page(page, "edited %s" % time.time())
+        page.set_attr("title", page.get_title() + " edited")
+    book.save()
+    timings.append(("save x%d" % len(nodeids), time.time() - start))
+    book.close()
+
+    for op, seconds in timings:
+        print("%-6s %-14s %10.1f" % (name, op, 1000 * seconds))
+    return nnodes
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("--pages", type="int", default=2000)
+    parser.add_option("--page-size", type="int", default=2000,
+                      help="approximate page text size in bytes")
+    parser.add_option("--edits", type="int", default=100,
+                      help="number of pages to edit and save")
+    parser.add_option("--dir", help="keep test notebooks in DIR")
+    options, args = parser.parse_args(argv[1:])
+
+    tmpdir = options.dir or tempfile.mkdtemp(prefix="keepnote_pack_")
+    dirname = os.path.join(tmpdir, "notebook")
+    packname = os.path.join(tmpdir, "notebook.knp")
+
+    start = time.time()
+    make_notebook(dirname, options.pages, options.page_size)
+    print("create dir:  %.2fs" % (time.time() - start))
+
+    start = time.time()
+    conn1 = fs.NoteBookConnectionFS()
+    conn1.connect(dirname)
+    conn2 = pack.NoteBookConnectionPack()
+    conn2.connect(packname)
+    sync.copy_notebook(conn1, conn2)
+    stats = conn2.get_pack_stats()
+    conn1.close()
+    conn2.close()
+    print("import pack: %.2fs" % (time.time() - start))
+
+    for name, path in (("dir", dirname), ("pack", packname)):
+        nfiles, size = get_disk_usage(path)
+        print("%-6s %8d files %10.1f MB" % (name, nfiles, size / 1e6))
+    print("pack   compressed %.1f MB of file data into %.1f MB" % (
+        stats["bytes"] / 1e6, stats["bytes_stored"] / 1e6))
+
+    print("%-6s %-14s %10s" % ("format", "operation", "time (ms)"))
+    run("dir", dirname, fs.NoteBookConnectionFS, options.edits)
+    run("pack", "pack://" + packname, pack.NoteBookConnectionPack,
+        options.edits)
+
+    if not options.dir:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Memory of the richtext undo history while typing
+
+Types keystrokes into a RichTextBuffer (with a current bold font and a
+backspace every few words) and reports the undo steps and the memory
+allocated for the undo history per 10k keystrokes.  Requires GTK.
+
+    python bench/undo_memory.py --keys 10000
+"""
+
+# python imports
+import optparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# keepnote imports
+from keepnote.gui.richtext.richtextbuffer import RichTextBuffer
+
+
+TEXT = "the quick brown fox jumps over the lazy dog "
+
+
+def type_keys(buf, nkeys):
+    """Type nkeys keystrokes at the cursor like a user would"""
+    for i in range(nkeys):
+        buf.begin_user_action()
+        if i % 50 == 49:
+            it = buf.get_insert_iter()
+            start = it.copy()
+            start.backward_char()
+            buf.delete_interactive(start, it, True)
+        else:
+            buf.insert_interactive_at_cursor(TEXT[i % len(TEXT)], -1, True)
+        buf.end_user_action()
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option("--keys", type="int", default=10000)
+    parser.add_option("--max-memory", type="int",
+                      help="undo memory budget in bytes")
+    options, args = parser.parse_args(argv[1:])
+
+    buf = RichTextBuffer()
+    buf.toggle_tag_selected(buf.tag_table.lookup("bold"))
+    if options.max_memory is not None:
+        buf.undo_stack.set_max_memory(options.max_memory)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.time()
+    type_keys(buf, options.keys)
+    seconds = time.time() - start
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    scale = 10000.0 / options.keys
+    print("keystrokes:        %d (%.0f/s)" % (options.keys,
+                                              options.keys / seconds))
+    print("undo steps:        %d" % len(buf.undo_stack))
+    print("estimated memory:  %.1f KB per 10k keys" % (
+        buf.undo_stack.get_memory() * scale / 1024))
+    print("allocated memory:  %.1f KB per 10k keys" % (
+        (after - before) * scale / 1024))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -28,6 +28,7 @@ import keepnote.notebook as notebooklib
 import keepnote.notebook.connection
 import keepnote.notebook.connection.fs
 import keepnote.notebook.connection.http
+import keepnote.notebook.connection.pack
 from keepnote.pref import Pref
 import keepnote.timestamp
 import keepnote.trans
@@ -501,6 +502,7 @@ class KeepNote:
         self._conns = keepnote.notebook.connection.NoteBookConnections()
         self._conns.add("file", keepnote.notebook.connection.fs.NoteBookConnectionFS)
         self._conns.add("http", keepnote.notebook.connection.http.NoteBookConnectionHttp)
+        self._conns.add("pack", keepnote.notebook.connection.pack.NoteBookConnectionPack)
         self._external_apps = []
         self._external_apps_lookup = {}
         self._extension_paths = []
@@ -1,7 +1,7 @@
 """
 
     KeepNote
-    Task object for threading
+    Caches with bounded size
 
 """
 
@@ -26,45 +26,41 @@
 #
 
 # python imports
-from heapq import heappop
+from collections import OrderedDict
 
 
 NULL = object()
 
 
-class LRUDict (dict):
+class LRUDict (OrderedDict):
     """A Least Recently Used (LRU) dict-based cache"""
 
     def __init__(self, limit=1000):
-        dict.__init__(self)
+        OrderedDict.__init__(self)
         self._limit = limit
-        self._age = 0
-        self._age_lookup = {}
-        self._ages = []
         assert limit > 1
 
     def __setitem__(self, key, val):
-        dict.__setitem__(self, key, val)
+        OrderedDict.__setitem__(self, key, val)
+        self.move_to_end(key)
 
-        self._age_lookup[key] = self._age
-        self._ages.append((self._age, key))
-        self._age += 1
-
-        # shirk cache if it is over limit
-        while len(self._ages) > self._limit:
-            minage, minkey = heappop(self._ages)
-            if self._age_lookup[minkey] == minage:
-                del self._age_lookup[minkey]
-                self.__delitem__(minkey)
+        # shrink cache if it is over limit
+        while len(self) > self._limit:
+            self.popitem(last=False)
 
     def __getitem__(self, key):
-        val = dict.__getitem(self, key)
+        val = OrderedDict.__getitem__(self, key)
+        self.move_to_end(key)
+        return val
 
-        self._age_lookup[key] = self._age
-        self._ages.append((self._age, key))
-        self._age += 1
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
-        return val
+    def get_limit(self):
+        return self._limit
 
 
 class DictCache (object):
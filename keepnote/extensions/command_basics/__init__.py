@@ -21,6 +21,8 @@ import keepnote
 from keepnote import AppCommand
 import keepnote.notebook
 import keepnote.notebook.update
+from keepnote.notebook.connection.fs import NoteBookConnectionFS
+from keepnote.notebook.connection import fs_raw
 import keepnote.extension
 import keepnote.gui.extension
 
@@ -76,6 +78,13 @@ class Extension(keepnote.gui.extension.Extension):
             AppCommand("backup", self.on_backup_notebook,
                        metavar="NOTEBOOK [ARCHIVE_NAME]",
                        help="backup a notebook to a tar archive"),
+            AppCommand("blobs", self.on_notebook_blobs,
+                       metavar="[migrate|gc|stats] NOTEBOOK",
+                       help="deduplicate notebook attachments"),
+            AppCommand("reshard", self.on_reshard_node_store,
+                       metavar="FANOUT STORE",
+                       help="change the directory fan-out of a node store, "
+                       "e.g. 2/2"),
 
             # misc
             AppCommand("screenshot", self.on_screenshot,
@@ -293,6 +302,63 @@ class Extension(keepnote.gui.extension.Extension):
         except Exception as e:
             self.error(f"Failed to create backup '{archive_name}': {str(e)}")
 
+    def on_notebook_blobs(self, app, args):
+        if len(args) < 3 or args[1] not in ("migrate", "gc", "stats"):
+            self.error("Usage: blobs [migrate|gc|stats] NOTEBOOK")
+            return
+
+        action, notebook_path = args[1], args[2]
+        if not os.path.exists(notebook_path):
+            self.error(f"Notebook path does not exist: {notebook_path}")
+            return
+
+        conn = NoteBookConnectionFS()
+        conn.connect(notebook_path)
+        try:
+            if action == "migrate":
+                nfiles = conn.migrate_blobs()
+                print(f"Moved {nfiles} files into the blob store")
+            elif action == "gc":
+                result = conn.collect_blobs()
+                print(f"Removed {result['blobs']} unused blobs "
+                      f"({result['bytes']} bytes)")
+            elif not conn.get_blob_store():
+                print("Notebook does not use a blob store")
+                return
+
+            stats = conn.get_blob_store().get_stats()
+            print(f"{stats['blobs']} blobs, {stats['refs']} references, "
+                  f"{stats['bytes_stored']} bytes stored, "
+                  f"{stats['bytes_saved']} bytes saved")
+        except Exception as e:
+            self.error(f"Failed to update blobs of '{notebook_path}': {str(e)}")
+        finally:
+            conn.close()
+
+    def on_reshard_node_store(self, app, args):
+        if len(args) < 3:
+            self.error("Usage: reshard FANOUT STORE")
+            return
+
+        store_path = args[2]
+        if not os.path.exists(store_path):
+            self.error(f"Node store path does not exist: {store_path}")
+            return
+
+        nodefs = None
+        try:
+            fanout = fs_raw.parse_fanout(args[1])
+            nodefs = fs_raw.NodeFS(store_path)
+            nmoved = nodefs.reshard(
+                fanout, progress=lambda n: print(f"Moved {n} nodes"))
+            print(f"Node store now uses fan-out {args[1]} "
+                  f"({nmoved} nodes moved)")
+        except Exception as e:
+            self.error(f"Failed to reshard '{store_path}': {str(e)}")
+        finally:
+            if nodefs:
+                nodefs.close()
+
     def view_nodeid(self, app, nodeid):
         for window in app.get_windows():
             notebook = window.get_notebook()
@@ -80,7 +80,8 @@ class Extension (keepnote.gui.extension.Extension):
         # start server in another thread
         host = "localhost"
         url = "http://%s:%d/" % (host, port)
-        server = NoteBookHttpServer(conn, host="localhost", port=port)
+        server = NoteBookHttpServer(conn, host="localhost", port=port,
+                                    threaded=True)
 
         if port in self._ports:
             raise Exception("Server already on port %d" % port)
@@ -15,6 +15,7 @@ from keepnote import notebook as notebooklib
 from keepnote.gui import dialog_image_new
 from keepnote.gui.richtext import RichTextView, RichTextBuffer, RichTextIO, RichTextError, RichTextImage
 from keepnote.gui.richtext.richtext_tags import RichTextLinkTag
+from keepnote.gui.richtext.image_loader import ThumbnailStore
 from keepnote.gui.icons import lookup_icon_filename
 from keepnote.gui.font_selector import FontSelector
 from keepnote.gui.colortool import FgColorTool, BgColorTool
@@ -29,6 +30,9 @@ from keepnote.gui import (
 
 _ = keepnote.translate
 
+# notebook directory for scaled images
+THUMBNAIL_DIR = notebooklib.NOTEBOOK_META_DIR + "/thumbnails"
+
 def is_relative_file(filename):
     """Returns True if filename is relative"""
     return (not re.match("[^:/]+://", filename) and
@@ -54,8 +58,10 @@ class NodeIO(RichTextIO):
         """Save buffer contents to file"""
         super().save(textbuffer, filename, title, stream=stream)
 
-    def load(self, textview, textbuffer, filename, stream=None):
-        super().load(textview, textbuffer, filename, stream=stream)
+    def load(self, textview, textbuffer, filename, stream=None,
+             on_done=None):
+        super().load(textview, textbuffer, filename, stream=stream,
+                     on_done=on_done)
 
     def _load_images(self, textbuffer, html_filename):
         """Load images present in textbuffer"""
@@ -92,18 +98,28 @@ class NodeIO(RichTextIO):
         if filename.startswith("http:/") or filename.startswith("file:/"):
             image.set_from_url(filename)
         elif is_relative_file(filename):
-            try:
-                infile = self._node.open_file(filename, mode="r")
-                image.set_from_stream(infile)
-                infile.close()
-            except:
-                image.set_no_image()
+            self._load_node_image(image, filename)
         else:
             image.set_from_file(filename)
 
         # Record loaded images
         self._image_files.add(image.get_filename())
 
+    def _load_node_image(self, image, filename):
+        """Load an image file of the node in the background"""
+        node = self._node
+        nodeid = node.get_attr("nodeid")
+        notebook = node.get_notebook()
+        size, mtime = notebook.get_connection().get_file_stat(
+            nodeid, filename)
+        key = (nodeid, filename, size, mtime) if mtime is not None else None
+
+        def read_data():
+            with node.open_file(filename, mode="rb") as infile:
+                return infile.read()
+        self._image_loader.load(image, read_data, key,
+                                ThumbnailStore(notebook, THUMBNAIL_DIR))
+
     def _save_image(self, textbuffer, image, html_filename):
         if image.save_needed():
             out = self._node.open_file(image.get_filename(), mode="w")
@@ -216,6 +232,8 @@ class RichTextEditor(KeepNoteEditor):
 
     def clear_view(self):
         """Clear editor view"""
+        self._textview_io.cancel_load()
+        self._textview_io.wait_save()
         self._page = None
         self._textview.disable()
 
@@ -251,9 +269,9 @@ class RichTextEditor(KeepNoteEditor):
                     self._textview,
                     self._textview.get_buffer(),
                     self._page.get_page_file(),
-                    stream=self._page.open_file(self._page.get_page_file(), "r", "utf-8")
+                    stream=self._page.open_file(self._page.get_page_file(), "r", "utf-8"),
+                    on_done=self._on_page_loaded
                 )
-                self._load_cursor()
             except RichTextError as e:
                 self.clear_view()
                 self.emit("error", e.msg, e)
@@ -264,6 +282,14 @@ class RichTextEditor(KeepNoteEditor):
         if pages:
             self.emit("view-node", pages[0])
 
+    def _on_page_loaded(self, error):
+        """Callback for a page that has finished loading"""
+        if error is not None:
+            self.clear_view()
+            self.emit("error", error.msg, error)
+        else:
+            self._load_cursor()
+
     def _save_cursor(self):
         if self._page is not None:
             it = self._textview.get_buffer().get_iter_at_mark(self._textview.get_buffer().get_insert())
@@ -289,19 +315,29 @@ class RichTextEditor(KeepNoteEditor):
 
     def save(self):
         """Save the loaded page"""
+        # a page that is still loading is read-only and has no changes
+        if self._textview_io.is_loading():
+            return
         if self._page is not None and self._page.is_valid() and self._textview.is_modified():
             try:
-                self._textview_io.save(
+                # the HTML is written in the background while typing goes on
+                self._textview_io.save_async(
                     self._textview.get_buffer(),
                     self._page.get_page_file(),
                     self._page.get_title(),
-                    stream=self._page.open_file(self._page.get_page_file(), "w", "utf-8")
+                    stream=self._page.open_file(self._page.get_page_file(), "w", "utf-8"),
+                    on_done=self._on_page_saved
                 )
                 self._page.set_attr_timestamp("modified_time")
                 self._page.save()
             except (RichTextError, NoteBookError) as e:
                 self.emit("error", e.msg, e)
 
+    def _on_page_saved(self, error):
+        """Callback for a finished background save"""
+        if error is not None:
+            self.emit("error", error.msg, error)
+
     def save_needed(self):
         """Returns True if textview is modified"""
         return self._textview.is_modified()
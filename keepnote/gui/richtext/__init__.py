@@ -2,6 +2,7 @@
 
 # Python imports
 import codecs
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 import os
 import re
@@ -13,14 +14,14 @@ from xml.sax.saxutils import escape
 import gi
 gi.require_version('Gtk', '3.0')
 # PyGObject imports (GTK 3)
-from gi.repository import Gtk, Gdk, Pango, GObject
+from gi.repository import Gtk, Gdk, Pango, GObject, GLib
 
 # Textbuffer_tools imports
 from .textbuffer_tools import \
-    iter_buffer_contents, iter_buffer_anchors, sanitize_text
+    iter_buffer_contents_fast, iter_buffer_anchors, sanitize_text
 
 # Richtextbuffer imports
-from .richtextbuffer import ignore_tag,RichTextBuffer,RichTextImage
+from .richtextbuffer import RichTextBuffer,RichTextImage
 
 # Tag imports
 from .richtext_tags import \
@@ -41,6 +42,8 @@ RichTextIndentTag
 
 # Richtext IO
 from .richtext_html import HtmlBuffer, HtmlError
+from .image_loader import ImageLoader
+from .segment_cache import SegmentCache
 
 import keepnote
 from keepnote import translate as _
@@ -48,6 +51,7 @@ from keepnote import translate as _
 # Constants
 DEFAULT_FONT = "Sans 10"
 TEXTVIEW_MARGIN = 5
+LOAD_CHUNKS_PER_IDLE = 20  # parsed elements inserted per idle call
 if keepnote.get_platform() == "darwin":
     CLIPBOARD_NAME = Gdk.SELECTION_PRIMARY
 else:
@@ -176,62 +180,206 @@ class RichTextIO(object):
     """Read/Writes the contents of a RichTextBuffer to disk"""
     def __init__(self):
         self._html_buffer = HtmlBuffer()
+        self._image_loader = ImageLoader()
+        self._segment_cache = None
+
+        # background saving
+        self._save_pool = None
+        self._save_writer = HtmlBuffer()  # only used by the save worker
+        self._saves = []
+
+        # unfinished load: (step, cancel)
+        self._loading = None
+
+    def _get_segment_cache(self, textbuffer):
+        """Returns the cache of paragraph HTML for a buffer"""
+        if self._segment_cache is not None:
+            if self._segment_cache.get_buffer() is textbuffer:
+                return self._segment_cache
+            self._segment_cache.close()
+        self._segment_cache = SegmentCache(textbuffer)
+        return self._segment_cache
 
     def save(self, textbuffer, filename, title=None, stream=None):
+        self.finish_load()
+        self.wait_save()
         self._save_images(textbuffer, filename)
+        cache = self._get_segment_cache(textbuffer)
+        # only paragraphs changed since the last save are written again
+        pieces, pending = cache.snapshot(self._html_buffer)
+        cache.store(self._write_page(self._html_buffer, pieces, pending,
+                                     filename, title, stream))
+        textbuffer.set_modified(False)
+
+    def save_async(self, textbuffer, filename, title=None, stream=None,
+                   on_done=None):
+        """
+        Save buffer contents in a background thread
+
+        The contents are captured right away and then written (and 'stream'
+        closed) by a worker.  on_done(error) is called in the GUI thread,
+        where error is None or a RichTextError.
+        """
+        self.finish_load()
+        self._save_images(textbuffer, filename)
+        cache = self._get_segment_cache(textbuffer)
+        pieces, pending = cache.snapshot(self._html_buffer)
+        textbuffer.set_modified(False)
+
+        if self._save_pool is None:
+            self._save_pool = ThreadPoolExecutor(1)
+        future = self._save_pool.submit(
+            self._write_page, self._save_writer, pieces, pending,
+            filename, title, stream)
+
+        def finish():
+            if (future, finish) not in self._saves:
+                return False
+            self._saves.remove((future, finish))
+            try:
+                results = future.result()
+            except Exception as e:
+                if not isinstance(e, RichTextError):
+                    e = RichTextError(f"Could not save '{filename}'.", e)
+                textbuffer.set_modified(True)
+                error = e
+            else:
+                if cache is self._segment_cache:
+                    cache.store(results)
+                error = None
+            if on_done:
+                on_done(error)
+            return False
+
+        self._saves.append((future, finish))
+        future.add_done_callback(lambda future: GLib.idle_add(finish))
+
+    def wait_save(self):
+        """Wait for background saves to finish"""
+        for future, finish in list(self._saves):
+            finish()
+
+    def _write_page(self, html_buffer, pieces, pending, filename, title,
+                    stream):
+        """Write the HTML of a page from a segment cache snapshot"""
         try:
-            buffer_contents = iter_buffer_contents(
-                textbuffer, None, None, ignore_tag)
+            results = []
+            for i, mark in pending:
+                out = io.StringIO()
+                html_buffer.set_output(out)
+                html_buffer.write_contents(pieces[i])
+                pieces[i] = out.getvalue()
+                results.append((mark, pieces[i]))
+
             if stream:
                 out = stream
             else:
                 out = codecs.open(filename, "w", "utf-8")
-            self._html_buffer.set_output(out)
-            self._html_buffer.write(buffer_contents,
-                                    textbuffer.tag_table,
-                                    title=title)
+            html_buffer.set_output(out)
+            html_buffer.write_html(pieces, title=title)
             out.close()
         except IOError as e:
             raise RichTextError(f"Could not save '{filename}'.", e)
-        textbuffer.set_modified(False)
-
-    def load(self, textview, textbuffer, filename, stream=None):
+        return results
+
+    def load(self, textview, textbuffer, filename, stream=None,
+             on_done=None):
+        """
+        Load buffer contents from a file
+
+        The first chunk of the file is shown right away and the rest is
+        inserted from the GLib idle loop, while the view is read-only.
+        on_done(error) is called once the whole file is loaded, where error
+        is None or a RichTextError.  Errors in the first chunk are raised.
+        """
+        self.cancel_load()
         textbuffer.block_signals()
         if textview:
             spell = textview.is_spell_check_enabled()
             textview.enable_spell_check(False)
             textview.set_buffer(None)
+        self.wait_save()
         textbuffer.clear()
-        err = None
+        self._get_segment_cache(textbuffer).clear()
+
+        def finish(err, canceled=False):
+            self._loading = None
+            infile.close()
+            if err is not None or canceled:
+                textbuffer.clear()
+            else:
+                self._load_images(textbuffer, filename)
+            textbuffer.unblock_signals()
+            if textview:
+                textview.set_editable(True)
+                textview.enable_spell_check(spell)
+                textview.enable()
+            textbuffer.set_modified(False)
+            if err is not None:
+                err = RichTextError(f"Error loading '{filename}'.", err)
+            if on_done and not canceled:
+                on_done(err)
+            return err
+
+        def step():
+            if self._loading is None or self._loading[0] is not step:
+                return False
+            try:
+                for i in range(LOAD_CHUNKS_PER_IDLE):
+                    buffer_contents = next(chunks, None)
+                    if buffer_contents is None:
+                        finish(None)
+                        return False
+                    textbuffer.load_contents(buffer_contents,
+                                             textbuffer.get_end_iter())
+            except (HtmlError, IOError, Exception) as e:
+                finish(e)
+                return False
+            return True
+
         try:
             if stream:
                 infile = stream
             else:
                 infile = codecs.open(filename, "r", "utf-8")
-            buffer_contents = self._html_buffer.read(infile)
-            textbuffer.insert_contents(buffer_contents,
-                                       textbuffer.get_start_iter())
-            infile.close()
+            # insert the first chunk as soon as it is parsed
+            chunks = self._html_buffer.read_chunks(infile)
+            buffer_contents = next(chunks, None)
+            if buffer_contents is not None:
+                textbuffer.load_contents(buffer_contents,
+                                         textbuffer.get_end_iter())
             textbuffer.place_cursor(textbuffer.get_start_iter())
         except (HtmlError, IOError, Exception) as e:
-            err = e
             textbuffer.clear()
             if textview:
                 textview.set_buffer(textbuffer)
-            ret = False
-        else:
-            self._load_images(textbuffer, filename)
+            textbuffer.unblock_signals()
             if textview:
-                textview.set_buffer(textbuffer)
-                textview.show_all()
-            ret = True
-        textbuffer.unblock_signals()
+                textview.enable_spell_check(spell)
+                textview.enable()
+            textbuffer.set_modified(False)
+            raise RichTextError(f"Error loading '{filename}'.", e)
+
         if textview:
-            textview.enable_spell_check(spell)
-            textview.enable()
-        textbuffer.set_modified(False)
-        if not ret:
-            raise RichTextError(f"Error loading '{filename}'.", err)
+            textview.set_buffer(textbuffer)
+            textview.set_editable(False)
+            textview.show_all()
+        self._loading = (step, lambda: finish(None, canceled=True))
+        GLib.idle_add(step)
+
+    def is_loading(self):
+        """Returns True if a load is still inserting contents"""
+        return self._loading is not None
+
+    def finish_load(self):
+        """Insert the rest of an unfinished load right away"""
+        while self._loading is not None and self._loading[0]():
+            pass
+
+    def cancel_load(self):
+        """Stop an unfinished load and clear its buffer"""
+        if self._loading is not None:
+            self._loading[1]()
 
     def _load_images(self, textbuffer, html_filename):
         for kind, it, param in iter_buffer_anchors(textbuffer, None, None):
@@ -246,8 +394,16 @@ class RichTextIO(object):
                 self._save_image(textbuffer, child, html_filename)
 
     def _load_image(self, textbuffer, image, html_filename):
-        image.set_from_file(
-            self._get_filename(html_filename, image.get_filename()))
+        filename = self._get_filename(html_filename, image.get_filename())
+        try:
+            key = (filename, os.stat(filename).st_mtime)
+        except OSError:
+            key = None
+
+        def read_data():
+            with open(filename, "rb") as infile:
+                return infile.read()
+        self._image_loader.load(image, read_data, key)
 
     def _save_image(self, textbuffer, image, html_filename):
         if image.save_needed():
@@ -576,7 +732,8 @@ class RichTextView(Gtk.TextView):
             self.paste_clipboard(clipboard, False, True)
         end = self._textbuffer.get_iter_at_mark(self._textbuffer.get_insert())
         start = self._textbuffer.get_iter_at_offset(offset1)
-        contents2 = list(iter_buffer_contents(self._textbuffer, start, end))
+        contents2 = list(iter_buffer_contents_fast(self._textbuffer,
+                                                   start, end))
         self._textbuffer.delete(start, end)
         self._textbuffer.insert_contents(before)
         self._textbuffer.insert_contents(contents2)
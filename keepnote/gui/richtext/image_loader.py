@@ -0,0 +1,236 @@
+"""
+
+    KeepNote
+    Deferred image loading for RichText
+
+"""
+
+# python imports
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import GLib, GdkPixbuf
+
+# keepnote imports
+import keepnote
+from keepnote.cache import LRUDict
+
+
+# number of threads decoding images
+DEFAULT_WORKERS = 2
+
+# number of scaled images kept in memory
+DEFAULT_CACHE_SIZE = 200
+
+# format of thumbnails stored on disk
+THUMBNAIL_FORMAT = "png"
+
+# number of thumbnails kept on disk
+DEFAULT_THUMBNAILS = 1000
+
+
+def decode_pixbuf(data):
+    """Returns a pixbuf decoded from the bytes of an image file"""
+    loader = GdkPixbuf.PixbufLoader()
+    try:
+        loader.write(data)
+    finally:
+        loader.close()
+    return loader.get_pixbuf()
+
+
+def scale_pixbuf(pixbuf, width, height):
+    """Scale a pixbuf, keeping its aspect ratio if a dimension is None"""
+    if width is None and height is None:
+        return pixbuf
+
+    width2 = pixbuf.get_width()
+    height2 = pixbuf.get_height()
+    if width is None:
+        width = int(height / float(height2) * width2)
+    if height is None:
+        height = int(width / float(width2) * height2)
+    return pixbuf.scale_simple(width, height, GdkPixbuf.InterpType.BILINEAR)
+
+
+def get_thumbnail_name(key):
+    """Returns the filename of the thumbnail for an image key"""
+    return "%s.%s" % (hashlib.sha1(repr(key).encode("utf8")).hexdigest(),
+                      THUMBNAIL_FORMAT)
+
+
+class ThumbnailStore (object):
+    """
+    Stores scaled images as files of a notebook node
+
+    Once there are more than 'max_files' thumbnails, the oldest ones are
+    removed, since every edited image leaves its old thumbnails behind.
+    The store reads and writes node files, so it is used from the GUI
+    thread only.
+    """
+
+    def __init__(self, node, dirname, max_files=DEFAULT_THUMBNAILS):
+        self._node = node
+        self._dirname = dirname
+        self._max_files = max_files
+
+    def _get_filename(self, key):
+        return self._dirname + "/" + get_thumbnail_name(key)
+
+    def read(self, key):
+        """Returns the encoded thumbnail for 'key' or None"""
+        filename = self._get_filename(key)
+        try:
+            with self._node.open_file(filename, "rb") as infile:
+                return infile.read()
+        except Exception:
+            return None
+
+    def write(self, key, data):
+        """Store the encoded thumbnail for 'key'"""
+        try:
+            with self._node.open_file(self._get_filename(key), "wb") as out:
+                out.write(data)
+            self.prune()
+        except Exception as e:
+            keepnote.log_error(e)
+
+    def prune(self):
+        """Remove the oldest thumbnails if there are too many"""
+        filenames = [filename for filename in
+                     self._node.list_dir(self._dirname + "/")
+                     if filename.endswith("." + THUMBNAIL_FORMAT)]
+        if len(filenames) <= self._max_files:
+            return
+
+        # remove a quarter at once so that pruning is rare
+        conn = self._node.get_notebook().get_connection()
+        nodeid = self._node.get_attr("nodeid")
+        mtimes = dict(
+            (filename, conn.get_file_stat(nodeid, filename)[1] or 0)
+            for filename in filenames)
+        filenames.sort(key=lambda filename: mtimes[filename])
+        nremove = len(filenames) - self._max_files * 3 // 4
+        for filename in filenames[:nremove]:
+            self._node.delete_file(filename)
+
+
+class ImageLoader (object):
+    """
+    Loads the images of a RichTextBuffer without blocking the GUI
+
+    Images are decoded and scaled in worker threads and shown when ready.
+    Files are read and written in the GUI thread, since notebook
+    connections are not shared with the workers.  Scaled images are kept
+    in a memory cache and, if a ThumbnailStore is given, on disk, so that
+    reopening a page does not decode them again.
+    """
+
+    def __init__(self, nworkers=DEFAULT_WORKERS,
+                 cache_size=DEFAULT_CACHE_SIZE):
+        self._nworkers = nworkers
+        self._pool = None
+        self._cache = LRUDict(cache_size)
+
+    def _submit(self, func, callback, *args):
+        """Call func(*args) in a worker and callback(result) in the GUI"""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self._nworkers)
+
+        def on_done(future):
+            GLib.idle_add(self._on_done, future, callback)
+        self._pool.submit(func, *args).add_done_callback(on_done)
+
+    def _on_done(self, future, callback):
+        try:
+            result = future.result()
+        except Exception as e:
+            keepnote.log_error(e)
+            result = None
+        callback(result)
+        return False
+
+    def load(self, image, read_data, key=None, thumbnails=None):
+        """
+        Load a RichTextImage in the background
+
+        read_data  -- function returning the bytes of the image file
+                      (called in the GUI thread)
+        key        -- hashable key of the image file and its version
+                      (e.g. mtime), or None to disable caching
+        thumbnails -- ThumbnailStore for scaled images (optional)
+        """
+        width, height = image.get_size()
+        scaled = width is not None or height is not None
+        if key is not None:
+            key = (key, width, height)
+
+        def load_original():
+            try:
+                return decode_pixbuf(read_data())
+            except Exception:
+                return None
+
+        # memory cache
+        pixbuf = self._cache.get(key) if key is not None else None
+        if pixbuf is not None:
+            if scaled:
+                image.set_loaded(pixbuf, load_original=load_original)
+            else:
+                image.set_loaded(pixbuf, original=pixbuf)
+            return
+
+        image.set_placeholder()
+        if not scaled or key is None:
+            thumbnails = None
+
+        # disk cache
+        data = thumbnails.read(key) if thumbnails is not None else None
+        cached = data is not None
+        if not cached:
+            try:
+                data = read_data()
+            except Exception:
+                image.set_no_image()
+                return
+
+        def on_image(result):
+            if result is None:
+                image.set_no_image()
+                return
+            original, pixbuf, thumbnail = result
+            if key is not None:
+                self._cache[key] = pixbuf
+            if thumbnail is not None:
+                thumbnails.write(key, thumbnail)
+            if original is None:
+                image.set_loaded(pixbuf, load_original=load_original)
+            else:
+                image.set_loaded(pixbuf, original=original)
+
+        self._submit(self._decode, on_image, data, cached, width, height,
+                     thumbnails is not None and not cached)
+
+    def _decode(self, data, cached, width, height, make_thumbnail):
+        """
+        Decode and scale an image (in a worker thread)
+
+        cached         -- True if 'data' is an already scaled thumbnail
+        make_thumbnail -- True to also encode the scaled image
+
+        Returns (original, pixbuf, thumbnail), where 'original' is None for
+        cached images and 'thumbnail' is None unless requested.
+        """
+        if cached:
+            return None, decode_pixbuf(data), None
+
+        original = decode_pixbuf(data)
+        pixbuf = scale_pixbuf(original, width, height)
+        thumbnail = None
+        if make_thumbnail and pixbuf is not original:
+            ok, thumbnail = pixbuf.save_to_bufferv(THUMBNAIL_FORMAT, [], [])
+            if not ok:
+                thumbnail = None
+        return original, pixbuf, thumbnail
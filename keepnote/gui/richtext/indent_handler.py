@@ -5,7 +5,6 @@ from .textbuffer_tools import \
     move_to_end_of_line, \
     paragraph_iter
 from .richtext_tags import RichTextIndentTag
-from .richtextbasebuffer import get_paragraph
 from .textbuffer_tools import get_paragraphs_selected
 
 
@@ -13,6 +12,15 @@ from .textbuffer_tools import get_paragraphs_selected
 BULLET_STR = "\u2022 "
 
 
+def add_run(runs, start, end, tag):
+    """Add range (start, end) to a list of (start, end, tag) offset runs"""
+    a, b = start.get_offset(), end.get_offset()
+    if runs and runs[-1][1] == a and runs[-1][2] is tag:
+        runs[-1] = (runs[-1][0], b, tag)
+    else:
+        runs.append((a, b, tag))
+
+
 #=============================================================================
 
 class IndentHandler (object):
@@ -115,29 +123,31 @@ class IndentHandler (object):
             else:
                 par_type = "bullet"
 
-        # set each paragraph's bullet status
+        # set each paragraph's bullet status, re-tagging runs of
+        # paragraphs with the same indentation at once
+        runs = []
         for pos in paragraph_iter(self._buf, start, end):
             par_end = pos.copy()
             par_end.forward_line()
-            self._set_bullet_list_paragraph(pos, par_end, par_type)
-
-        self._buf.end_user_action()
 
-    def _set_bullet_list_paragraph(self, par_start, par_end, par_type):
-        """Set the state of a bullet list for a paragraph"""
+            # start indent if it is not present
+            indent, _ = self.get_indent(pos)
+            if indent == 0:
+                indent = 1
+            indent_tag = self._buf.tag_table.lookup(
+                RichTextIndentTag.tag_name(indent, par_type))
 
-        # start indent if it is not present
-        indent, _ = self.get_indent(par_start)
-        if indent == 0:
-            indent = 1
+            add_run(runs, pos, par_end, indent_tag)
 
-        # apply indent to whole paragraph
-        indent_tag = self._buf.tag_table.lookup(
-            RichTextIndentTag.tag_name(indent, par_type))
-        self._buf.clear_tag_class(indent_tag, par_start, par_end)
-        self._buf.apply_tag(indent_tag, par_start, par_end)
+        for a, b, indent_tag in runs:
+            self._set_indent(self._buf.get_iter_at_offset(a),
+                             self._buf.get_iter_at_offset(b), indent_tag)
+        if runs:
+            self._queue_update_indentation(
+                self._buf.get_iter_at_offset(runs[0][0]),
+                self._buf.get_iter_at_offset(runs[-1][1]))
 
-        self._queue_update_indentation(par_start, par_end)
+        self._buf.end_user_action()
 
     def _insert_bullet(self, par_start, indent_tag):
         """Insert a bullet point at the begining of the paragraph"""
@@ -257,62 +267,101 @@ class IndentHandler (object):
         end = self._buf.get_iter_at_mark(self._indent_update_end)
         pos = move_to_start_of_line(pos)
         end.forward_line()
+        self._buf.move_mark(self._indent_update_start, pos)
+        self._buf.move_mark(self._indent_update_end, end)
+
+        # remove bullets mid paragraph
+        self._remove_inner_bullets(pos, end)
+        pos = self._buf.get_iter_at_mark(self._indent_update_start)
+        end = self._buf.get_iter_at_mark(self._indent_update_end)
 
-        # iterate through the paragraphs that need updating
-        for pos in paragraph_iter(self._buf, pos, end):
+        # The edits are first computed for all paragraphs, so that the
+        # buffer is only changed where needed and offsets stay valid.
+        runs = []     # (start, end, indent_tag) ranges to re-tag
+        bullets = []  # (start, indent_tag, par_type) paragraphs to fix
+        while pos.compare(end) < 0:
             par_end = pos.copy()
             par_end.forward_line()
             indent_tag = self.get_indent_tag(pos)
 
-            # remove bullets mid paragraph
-            it = pos.copy()
-            it.forward_char()
-            while True:
-                match = it.forward_search(BULLET_STR, 0, par_end)
-                if not match:
-                    it.backward_char()
-                    pos, par_end = get_paragraph(it)
-                    break
-                self._buf.move_mark(self._indent_update_start, match[0])
-                self._buf.delete(match[0], match[1])
-                it = self._buf.get_iter_at_mark(self._indent_update_start)
-                par_end = it.copy()
-                par_end.forward_line()
+            if not self._has_indent(pos, par_end, indent_tag):
+                add_run(runs, pos, par_end, indent_tag)
 
-            # check indentation
+            # check for bullets
             if indent_tag is None:
-                # remove all indent tags
-                # TODO: RichTextBaseBuffer function
-                self._buf.clear_tag_class(
-                    self._buf.tag_table.lookup(
-                        RichTextIndentTag.tag_name(1)),
-                    pos, par_end)
-                # remove bullets
                 par_type = "none"
-
             else:
-                self._buf.clear_tag_class(indent_tag, pos, par_end)
-                self._buf.apply_tag(indent_tag, pos, par_end)
-
-                # check for bullets
                 par_type = indent_tag.get_par_indent()
+            if par_type not in ("bullet", "none"):
+                raise Exception("unknown par_type '%s'" % par_type)
+            if (par_type == "bullet") != self.par_has_bullet(pos):
+                bullets.append((pos.get_offset(), indent_tag, par_type))
 
-            # check paragraph type
-            if par_type == "bullet":
-                # ensure proper bullet is in place
-                pos = self._insert_bullet(pos, indent_tag)
+            if not pos.forward_line():
+                break
 
-            elif par_type == "none":
-                # remove bullets
-                pos = self._remove_bullet(pos)
+        # tags do not change offsets
+        for a, b, indent_tag in runs:
+            self._set_indent(self._buf.get_iter_at_offset(a),
+                             self._buf.get_iter_at_offset(b), indent_tag)
 
+        # insert or remove bullets, last paragraph first
+        for offset, indent_tag, par_type in reversed(bullets):
+            pos = self._buf.get_iter_at_offset(offset)
+            if par_type == "bullet":
+                # ensure proper bullet is in place
+                self._insert_bullet(pos, indent_tag)
             else:
-                raise Exception("unknown par_type '%s'" % par_type)
+                self._remove_bullet(pos)
 
         #self._updating = False
         self._buf.end_noninteractive()
         self._buf.end_user_action()
 
+    def _remove_inner_bullets(self, start, end):
+        """Remove bullets that are not at the start of a paragraph"""
+        offsets = []
+        it = start.copy()
+        while True:
+            match = it.forward_search(BULLET_STR, 0, end)
+            if not match:
+                break
+            if not match[0].starts_line():
+                offsets.append(match[0].get_offset())
+            it = match[1]
+
+        for offset in reversed(offsets):
+            a = self._buf.get_iter_at_offset(offset)
+            b = a.copy()
+            b.forward_chars(len(BULLET_STR))
+            self._buf.delete(a, b)
+
+    def _has_indent(self, start, end, indent_tag):
+        """Returns True if 'indent_tag' is the only indentation of a range"""
+        expected = [indent_tag] if indent_tag else []
+        it = start.copy()
+        while it.compare(end) < 0:
+            tags = [tag for tag in it.get_tags()
+                    if isinstance(tag, RichTextIndentTag)]
+            if tags != expected:
+                return False
+            if not it.forward_to_tag_toggle(None):
+                break
+        return True
+
+    def _set_indent(self, start, end, indent_tag):
+        """Make 'indent_tag' the only indentation of a range"""
+        if indent_tag is None:
+            # remove all indent tags
+            # TODO: RichTextBaseBuffer function
+            self._buf.clear_tag_class(
+                self._buf.tag_table.lookup(
+                    RichTextIndentTag.tag_name(1)),
+                start, end)
+        else:
+            self._buf.clear_tag_class(indent_tag, start, end)
+            self._buf.apply_tag(indent_tag, start, end)
+
     #==========================================
     # query and navigate paragraphs/indentation
 
@@ -11,6 +11,11 @@ import re
 from html.parser import HTMLParser
 from xml.sax.saxutils import escape
 
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
 # keepnote imports
 from keepnote import log_error, log_message
 
@@ -60,6 +65,15 @@ HTML_FOOTER = "</body></html>"
 
 BULLET_STR = "\u2022 "
 
+# number of characters HtmlBuffer reads at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+# marks the end of a chunk of read contents
+READ_CHUNK_END = ("chunk", None, None)
+
+# HTML tokenizers for reading whole pages, fastest first
+TOKENIZERS = ["lxml", "python"]
+
 JUSTIFY_VALUES = set([
     "left",
     "center",
@@ -797,6 +811,80 @@ class HtmlTagImgWriter (HtmlTagWriter):
 
 
 #=============================================================================
+# HTML tokenizers
+
+
+class LxmlHtmlTarget (object):
+    """Passes the events of an lxml parser to HtmlBuffer callbacks"""
+
+    def __init__(self, handler):
+        self._handler = handler
+        self._data = []
+
+    def _flush(self):
+        # give runs of text in one call, like HTMLParser does
+        if self._data:
+            data = "".join(self._data)
+            self._data = []
+            self._handler.handle_data(data)
+
+    def start(self, tag, attrib):
+        self._flush()
+        self._handler.handle_starttag(tag, list(attrib.items()))
+
+    def end(self, tag):
+        self._flush()
+        self._handler.handle_endtag(tag)
+
+    def data(self, data):
+        self._data.append(data)
+
+    def comment(self, text):
+        self._flush()
+
+    def pi(self, target, data):
+        self._flush()
+
+    def close(self):
+        self._flush()
+
+
+class LxmlHtmlTokenizer (object):
+    """Tokenizes HTML with the incremental (libxml2) parser of lxml"""
+
+    def __init__(self, handler):
+        self._handler = handler
+        self._parser = None
+
+    def reset(self):
+        self._parser = lxml_etree.HTMLParser(
+            target=LxmlHtmlTarget(self._handler), no_network=True)
+
+    def feed(self, data):
+        self._parser.feed(data)
+
+    def close(self):
+        self._parser.close()
+
+
+def get_tokenizers():
+    """Returns the names of the HTML tokenizers that can be used"""
+    return [name for name in TOKENIZERS
+            if name != "lxml" or lxml_etree is not None]
+
+
+#=============================================================================
+
+class StringBuffer (object):
+    """Output stream that collects strings and joins them at the end"""
+
+    def __init__(self):
+        self._strings = []
+        self.write = self._strings.append
+
+    def getvalue(self):
+        return "".join(self._strings)
+
 
 # TODO: may need to include support for ignoring information between
 # <scirpt> and <style> tags
@@ -804,10 +892,12 @@ class HtmlTagImgWriter (HtmlTagWriter):
 class HtmlBuffer (HTMLParser):
     """Read and write HTML for a RichTextBuffer"""
 
-    def __init__(self, out=None):
+    def __init__(self, out=None, tokenizer=None):
         HTMLParser.__init__(self)
 
         self._out = out
+        self._tokenizer = None
+        self.set_tokenizer(tokenizer)
         self._mod_tags = "biu"
         self._newline = False
 
@@ -832,6 +922,7 @@ class HtmlBuffer (HTMLParser):
 
         self._tag_readers = {}
         self._tag_writers = []
+        self._tag_writer_lookup = {}  # class -> tag writer
 
         # misc tags
         self.add_tag_reader(HtmlTagParReader(self))
@@ -879,16 +970,89 @@ class HtmlBuffer (HTMLParser):
 
     def add_tag_writer(self, tag_writer):
         self._tag_writers.append(tag_writer)
+        self._tag_writer_lookup.clear()
+
+    def get_tag_writer(self, obj):
+        """Returns the tag writer for a tag or anchor, or None"""
+        cls = type(obj)
+        try:
+            return self._tag_writer_lookup[cls]
+        except KeyError:
+            pass
+
+        # the first writer registered for the class (or a base) is used
+        for tag_writer in self._tag_writers:
+            if issubclass(cls, tag_writer.tagclass):
+                break
+        else:
+            tag_writer = None
+        self._tag_writer_lookup[cls] = tag_writer
+        return tag_writer
 
     def set_output(self, out):
         """Set the output stream for HTML"""
         self._out = out
 
+    def set_tokenizer(self, name=None):
+        """
+        Set the HTML tokenizer used for reading whole pages
+
+        name -- "lxml", "python", or None for the fastest available.
+        Partial HTML is always read with the python tokenizer (HTMLParser),
+        since lxml adds implied <html>, <body> and <p> tags to fragments.
+        """
+        if name is None:
+            name = get_tokenizers()[0]
+        if name not in get_tokenizers():
+            raise HtmlError("HTML tokenizer '%s' is not available" % name)
+        self._tokenizer_name = name
+
+    def get_tokenizer(self):
+        """Returns the name of the HTML tokenizer for whole pages"""
+        return self._tokenizer_name
+
+    def _get_tokenizer(self, partial):
+        if partial or self._tokenizer_name == "python":
+            return self
+        if self._tokenizer is None:
+            self._tokenizer = LxmlHtmlTokenizer(self)
+        return self._tokenizer
+
     #===========================================
     # Reading HTML
 
     def read(self, infile, partial=False, ignore_errors=False):
         """Read from stream infile to populate textbuffer"""
+        contents = []
+        for chunk in self.read_chunks(infile, partial=partial,
+                                      ignore_errors=ignore_errors):
+            contents.extend(chunk)
+        return contents
+
+    def read_chunks(self, infile, partial=False, ignore_errors=False,
+                    chunk_size=READ_CHUNK_SIZE):
+        """
+        Read from stream infile, yielding lists of buffer contents
+
+        The stream is parsed 'chunk_size' characters at a time and the
+        contents of each finished top-level element are yielded as soon
+        as possible.  Every yielded list has balanced tags, so that it can
+        be inserted on its own after the previous ones.
+        """
+        chunk = []
+        for item in unnest_indent_tags(self._read_contents(
+                infile, partial, ignore_errors, chunk_size)):
+            if item is READ_CHUNK_END:
+                if chunk:
+                    yield chunk
+                    chunk = []
+            else:
+                chunk.append(item)
+        if chunk:
+            yield chunk
+
+    def _read_contents(self, infile, partial, ignore_errors, chunk_size):
+        """Parse infile and yield the contents of finished DOM nodes"""
         #self._text_queue = []
         self._within_body = False
         self._partial = partial
@@ -896,23 +1060,76 @@ class HtmlBuffer (HTMLParser):
         self._dom = TextBufferDom()
         self._dom_ptr = self._dom
         self._tag_stack = [(None, self._dom)]
+        self._read_last = None
+
+        tokenizer = self._get_tokenizer(partial)
+        tokenizer.reset()
+        # chunks read since the last tag, joined only once fed
+        rest = []
+        while True:
+            try:
+                data = infile.read(chunk_size)
+                if not data:
+                    tokenizer.feed("".join(rest))
+                    tokenizer.close()
+                    break
+
+                # only feed up to the last tag so that runs of text are
+                # never split, which would change whitespace collapsing
+                i = data.rfind("<")
+                if i < 0:
+                    rest.append(data)
+                    continue
+                rest.append(data[:i])
+                tokenizer.feed("".join(rest))
+                rest = [data[i:]]
+
+            except Exception as e:
+                log_error(e, sys.exc_info()[2])
+                # reraise error if not ignored
+                tokenizer.close()
+                if not ignore_errors:
+                    raise
+                break
 
-        try:
-            self.reset()
-            #for line in infile:
-            #    self.feed(line)
-            self.feed(infile.read())
-            self.close()
-
-        except Exception as e:
-            log_error(e, sys.exc_info()[2])
-            # reraise error if not ignored
-            self.close()
-            if not ignore_errors:
-                raise
-
-        self.process_dom_read(self._dom)
-        return unnest_indent_tags(self._dom.get_contents())
+            for item in self._flush_read():
+                yield item
+            yield READ_CHUNK_END
+
+        for item in self._flush_read(True):
+            yield item
+
+    def _flush_read(self, final=False):
+        """
+        Returns the contents of top-level DOM nodes that are done parsing
+
+        The last top-level node may still receive children, so it is only
+        flushed when 'final' is True.  The last flushed node is kept in
+        the DOM, since reading a list depends on its previous sibling.
+        """
+        contents = []
+        visit = lambda kind, pos, param: contents.append((kind, pos, param))
+        dom = self._dom
+        last = None if final else dom.last_child()
+
+        node = (self._read_last.next_sibling() if self._read_last
+                else dom.first_child())
+        while node is not None and node is not last:
+            # processing may insert new nodes before this one
+            self.process_dom_read(node)
+            child = (self._read_last.next_sibling() if self._read_last
+                     else dom.first_child())
+            while child is not node:
+                child.visit_contents(visit)
+                child = child.next_sibling()
+            node.visit_contents(visit)
+
+            while dom.first_child() is not node:
+                dom.first_child().remove()
+            self._read_last = node
+            node = node.next_sibling()
+
+        return contents
 
     def process_dom_read(self, dom):
         """Process a DOM after reading"""
@@ -1031,16 +1248,12 @@ class HtmlBuffer (HTMLParser):
 
         if self._newline:
             #data = re.sub("^\r?\n[\r\n\t ]*", "", data)
-            data = re.sub(self.remove_first_whitespace, "", data)
-
-            # collapse a sequence of whitespace into one space char
-            #data = re.sub("[\r\n\t ]+", " ", data)
-            data = re.sub(self.remove_whitespace, " ", data)
+            data = self.remove_first_whitespace.sub("", data)
             self._newline = False
-        else:
-            # collapse a sequence of whitespace into one space char
-            #data = re.sub("[\r\n\t ]+", " ", data)
-            data = re.sub(self.remove_whitespace, " ", data)
+
+        # collapse a sequence of whitespace into one space char
+        #data = re.sub("[\r\n\t ]+", " ", data)
+        data = self.remove_whitespace.sub(" ", data)
 
         if len(data) > 0:
             self.append_text(data)
@@ -1067,17 +1280,45 @@ class HtmlBuffer (HTMLParser):
               partial=False, xhtml=True):
         if not partial:
             self._write_header(title, xhtml=xhtml)
+        self.write_contents(self.prepare_contents(buffer_content, tag_table),
+                            xhtml=xhtml)
+        if not partial:
+            self._write_footer(xhtml=xhtml)
+
+    def prepare_contents(self, buffer_content, tag_table):
+        """
+        Returns buffer contents normalized for writing as a list
 
-        # normalize contents, prepare them for DOM
-        contents = normalize_tags(
+        Only this step uses the tag table.  The result can be written with
+        write_contents() after the buffer has changed, e.g. in a worker
+        thread.
+        """
+        return list(normalize_tags(
             nest_indent_tags(find_paragraphs(buffer_content), tag_table),
             is_stable_tag=lambda tag:
-            isinstance(tag, (RichTextIndentTag, RichTextParTag)))
+            isinstance(tag, (RichTextIndentTag, RichTextParTag))))
 
+    def write_contents(self, contents, xhtml=True):
+        """Write contents returned by prepare_contents()"""
         dom = TextBufferDom(contents)
         self.prepare_dom_write(dom)
-        self.write_dom(dom, xhtml=xhtml)
 
+        # collect the many small strings and write them at once
+        out = self._out
+        self._out = StringBuffer()
+        try:
+            self.write_dom(dom, xhtml=xhtml)
+            text = self._out.getvalue()
+        finally:
+            self._out = out
+        out.write(text)
+
+    def write_html(self, html, title=None, partial=False, xhtml=True):
+        """Write body HTML that was already written (e.g. SegmentCache)"""
+        if not partial:
+            self._write_header(title, xhtml=xhtml)
+        for text in html:
+            self._out.write(text)
         if not partial:
             self._write_footer(xhtml=xhtml)
 
@@ -1138,30 +1379,24 @@ class HtmlBuffer (HTMLParser):
 
     def write_anchor(self, dom, anchor, xhtml=True):
         """Write an anchor object"""
-        for tag_writer in self._tag_writers:
-            if isinstance(anchor, tag_writer.tagclass):
-                tag_writer.write(self._out, dom, xhtml)
-                return
-
-        # warning
-        log_message("unknown anchor element", anchor)
+        tag_writer = self.get_tag_writer(anchor)
+        if tag_writer is not None:
+            tag_writer.write(self._out, dom, xhtml)
+        else:
+            # warning
+            log_message("unknown anchor element", anchor)
 
     def write_tag_begin(self, dom, xhtml=True):
         """Write opening tag of DOM"""
-        tag = dom.tag
-
-        for tag_writer in self._tag_writers:
-            if isinstance(tag, tag_writer.tagclass):
-                tag_writer.write_tag_begin(self._out, dom, xhtml)
-                return
+        tag_writer = self.get_tag_writer(dom.tag)
+        if tag_writer is not None:
+            tag_writer.write_tag_begin(self._out, dom, xhtml)
 
     def write_tag_end(self, dom, xhtml=True):
         """Write closing tag of DOM"""
-        tag = dom.tag
-        for tag_writer in self._tag_writers:
-            if isinstance(tag, tag_writer.tagclass):
-                tag_writer.write_tag_end(self._out, dom, xhtml)
-                return
+        tag_writer = self.get_tag_writer(dom.tag)
+        if tag_writer is not None:
+            tag_writer.write_tag_end(self._out, dom, xhtml)
 
     def prepare_dom_write(self, dom):
         """Prepare a DOM for writing"""
@@ -18,9 +18,10 @@ import keepnote
 
 # Textbuffer imports
 from .textbuffer_tools import \
-    iter_buffer_contents, \
+    iter_buffer_contents_fast, \
     iter_buffer_anchors, \
-    insert_buffer_contents
+    insert_buffer_contents, \
+    insert_buffer_contents_fast
 
 # RichText imports
 from .richtextbasebuffer import \
@@ -197,6 +198,8 @@ class RichTextImage(RichTextAnchor):
         self._download = False
         self._pixbuf = None
         self._pixbuf_original = None
+        self._load_original = None
+        self._placeholder = None
         self._size = [None, None]
         self._save_needed = False
 
@@ -212,6 +215,8 @@ class RichTextImage(RichTextAnchor):
 
         if self._pixbuf is not None:
             self._widgets[view].set_from_pixbuf(self._pixbuf)
+        elif self._placeholder is not None:
+            self._widgets[view].set_from_pixbuf(self._placeholder)
 
         return self._widgets[view]
 
@@ -221,7 +226,15 @@ class RichTextImage(RichTextAnchor):
 
     def set_filename(self, filename):
         """Sets the filename used for saving image"""
-        self._filename = filename
+        if filename != self._filename:
+            self._filename = filename
+            self._emit_changed()
+
+    def _emit_changed(self):
+        """Notify the buffer that the saved form of the image changed"""
+        buf = self.get_buffer()
+        if buf is not None and not self.get_deleted():
+            buf.emit("child-changed", self)
 
     def get_filename(self):
         """Returns the filename used for saving image"""
@@ -229,6 +242,11 @@ class RichTextImage(RichTextAnchor):
 
     def get_original_pixbuf(self):
         """Returns the pixbuf of the image at its original size (no scaling)"""
+        if self._pixbuf_original is None and self._load_original:
+            # decode original image on first use
+            load_original = self._load_original
+            self._load_original = None
+            self._pixbuf_original = load_original()
         return self._pixbuf_original
 
     def set_save_needed(self, save):
@@ -243,7 +261,7 @@ class RichTextImage(RichTextAnchor):
         """Write image to file"""
         if self._pixbuf:
             ext = get_image_format(filename)
-            self._pixbuf_original.savev(filename, ext, [], [])
+            self.get_original_pixbuf().savev(filename, ext, [], [])
             self._save_needed = False
 
     def write_stream(self, stream, filename="image.png"):
@@ -252,7 +270,7 @@ class RichTextImage(RichTextAnchor):
             stream.write(buf)
             return True
         format = get_image_format(filename)
-        self._pixbuf_original.save_to_callbackv(write, format, [], [])
+        self.get_original_pixbuf().save_to_callbackv(write, format, [], [])
         self._save_needed = False
 
     def copy(self):
@@ -264,6 +282,7 @@ class RichTextImage(RichTextAnchor):
         if self._pixbuf:
             img._pixbuf = self._pixbuf
             img._pixbuf_original = self._pixbuf_original
+            img._load_original = self._load_original
         else:
             img.set_no_image()
 
@@ -310,8 +329,35 @@ class RichTextImage(RichTextAnchor):
         for widget in self.get_all_widgets().values():
             widget.set_from_icon_name("image-missing", Gtk.IconSize.MENU)
         self._pixbuf_original = None
+        self._load_original = None
+        self._placeholder = None
         self._pixbuf = None
 
+    def set_placeholder(self):
+        """Show an empty image of the stored size until the image loads"""
+        width, height = self._size
+        if width is None or height is None:
+            return
+        self._placeholder = GdkPixbuf.Pixbuf.new(
+            GdkPixbuf.Colorspace.RGB, True, 8, max(width, 1), max(height, 1))
+        self._placeholder.fill(0)
+        for widget in self.get_all_widgets().values():
+            widget.set_from_pixbuf(self._placeholder)
+
+    def set_loaded(self, pixbuf, original=None, load_original=None):
+        """
+        Set the image from an already scaled pixbuf
+
+        If the original pixbuf is not given, it is loaded by calling
+        load_original() when first needed.
+        """
+        self._pixbuf = pixbuf
+        self._pixbuf_original = original
+        self._load_original = load_original if original is None else None
+        self._placeholder = None
+        for widget in self.get_all_widgets().values():
+            widget.set_from_pixbuf(self._pixbuf)
+
     def set_from_pixbuf(self, pixbuf, filename=None):
         """Set the image from a pixbuf"""
         if filename is not None:
@@ -351,12 +397,13 @@ class RichTextImage(RichTextAnchor):
     def get_size(self, actual_size=False):
         """Returns the size of the image"""
         if actual_size:
-            if self._pixbuf_original is not None:
+            original = self.get_original_pixbuf()
+            if original is not None:
                 w, h = self._size
                 if w is None:
-                    w = self._pixbuf_original.get_width()
+                    w = original.get_width()
                 if h is None:
-                    h = self._pixbuf_original.get_height()
+                    h = original.get_height()
                 return [w, h]
             else:
                 return [0, 0]
@@ -364,8 +411,8 @@ class RichTextImage(RichTextAnchor):
             return self._size
 
     def get_original_size(self):
-        return [self._pixbuf_original.get_width(),
-                self._pixbuf_original.get_height()]
+        original = self.get_original_pixbuf()
+        return [original.get_width(), original.get_height()]
 
     def is_size_set(self):
         return self._size[0] is not None or self._size[1] is not None
@@ -375,7 +422,10 @@ class RichTextImage(RichTextAnchor):
         if not self.is_valid():
             return
 
-        self._size = [width, height]
+        if [width, height] != self._size:
+            self._size = [width, height]
+            self._emit_changed()
+        self.get_original_pixbuf()
 
         if not self.is_size_set():
             if self._pixbuf != self._pixbuf_original:
@@ -493,6 +543,7 @@ class RichTextBuffer(RichTextBaseBuffer):
     __gsignals__ = {
         "child-added": (GObject.SIGNAL_RUN_LAST, None, (object,)),
         "child-activated": (GObject.SIGNAL_RUN_LAST, None, (object,)),
+        "child-changed": (GObject.SIGNAL_RUN_LAST, None, (object,)),
         "child-menu": (GObject.SIGNAL_RUN_LAST, None, (object, object, object)),
         "font-change": (GObject.SIGNAL_RUN_LAST, None, (object,)),
     }
@@ -537,9 +588,26 @@ class RichTextBuffer(RichTextBaseBuffer):
                                self.tag_table.lookup(name))
         self.end_user_action()
 
+    def load_contents(self, contents, it=None):
+        """
+        Inserts a content stream while loading
+
+        Signal handlers should be blocked with block_signals(), since text
+        is inserted and tagged in bulk.
+        """
+        if it is None:
+            it = self.get_insert_iter()
+
+        insert_buffer_contents_fast(self, it,
+                                    contents,
+                                    add_child_to_buffer,
+                                    lookup_tag=lambda name:
+                                    self.tag_table.lookup(name))
+
     def copy_contents(self, start, end):
         """Return a content stream for copying from iter start and end"""
-        contents = iter(iter_buffer_contents(self, start, end, ignore_tag))
+        contents = iter(iter_buffer_contents_fast(self, start, end,
+                                                  ignore_tag))
 
         for item in contents:
             if item[0] == "begin" and not item[2].can_be_copied():
@@ -583,7 +651,7 @@ class RichTextBuffer(RichTextBaseBuffer):
 
         super()._on_delete_range(textbuffer, start, end)
 
-        for kind, offset, param in iter_buffer_contents(
+        for kind, offset, param in iter_buffer_contents_fast(
                 self, start, end, ignore_tag):
             if kind == "anchor":
                 child = param[0]
@@ -0,0 +1,252 @@
+"""
+
+    KeepNote
+    Incremental HTML serialization of a RichTextBuffer
+
+"""
+
+# python imports
+from io import StringIO
+
+# keepnote imports
+from .textbuffer_tools import iter_buffer_contents_fast
+from .richtextbuffer import ignore_tag, RichTextHorizontalRule
+from .richtext_tags import RichTextIndentTag
+
+
+class SegmentCache (object):
+    """
+    Caches the HTML of the paragraphs of a RichTextBuffer
+
+    The buffer is split into segments of whole lines.  Segments only start
+    at lines whose HTML does not depend on the lines before them (no font
+    or indentation continues across the line break), so that the HTML of
+    the buffer is the concatenation of the HTML of its segments.  Edits
+    mark the segments they touch as dirty, and only dirty segments are
+    written again on the next save.
+    """
+
+    def __init__(self, textbuffer):
+        self._buffer = textbuffer
+        self._marks = []  # mark at the start of each segment
+        self._html = []   # HTML of each segment, None if dirty
+        self._stale = set()  # marks of segments edited since the snapshot
+        self._signals = [
+            textbuffer.connect_after("insert-text", self._on_insert_text),
+            textbuffer.connect_after("insert-child-anchor",
+                                     self._on_insert_child_anchor),
+            textbuffer.connect_after("delete-range", self._on_delete_range),
+            textbuffer.connect("child-changed", self._on_child_changed),
+            textbuffer.connect("apply-tag", self._on_change_tag),
+            textbuffer.connect("remove-tag", self._on_change_tag)]
+
+    def get_buffer(self):
+        return self._buffer
+
+    def close(self):
+        """Stop tracking the buffer"""
+        self.clear()
+        for signal in self._signals:
+            self._buffer.disconnect(signal)
+        self._signals = []
+
+    def clear(self):
+        """Forget all cached HTML"""
+        for mark in self._marks:
+            self._buffer.delete_mark(mark)
+        self._marks = []
+        self._html = []
+        self._stale.clear()
+
+    def get_dirty(self):
+        """Returns the number of segments that need to be written again"""
+        return sum(1 for html in self._html if html is None)
+
+    def __len__(self):
+        return len(self._marks)
+
+    #===========================================
+    # dirty tracking
+
+    def _on_insert_text(self, textbuffer, it, text, length):
+        end = it.get_offset()
+        self.invalidate(end - len(text), end)
+
+    def _on_insert_child_anchor(self, textbuffer, it, anchor):
+        end = it.get_offset()
+        self.invalidate(end - 1, end)
+
+    def _on_delete_range(self, textbuffer, start, end):
+        offset = start.get_offset()
+        self.invalidate(offset, offset)
+
+    def _on_child_changed(self, textbuffer, child):
+        offset = textbuffer.get_iter_at_child_anchor(child).get_offset()
+        self.invalidate(offset, offset + 1)
+
+    def _on_change_tag(self, textbuffer, tag, start, end):
+        if not ignore_tag(tag):
+            self.invalidate(start.get_offset(), end.get_offset())
+
+    def invalidate(self, start, end):
+        """Mark the segments touching the offsets [start, end] as dirty"""
+        if not self._marks:
+            return
+
+        # neighbouring lines are included since a change may affect
+        # whether they can start a segment
+        i = self._find(start - 1)
+        j = self._find(end + 1)
+        for k in range(i, j + 1):
+            self._html[k] = None
+            self._stale.add(self._marks[k])
+
+    def _get_offset(self, i):
+        return self._buffer.get_iter_at_mark(self._marks[i]).get_offset()
+
+    def _find(self, offset):
+        """Returns the index of the segment containing 'offset'"""
+        low, high = 0, len(self._marks)
+        while high - low > 1:
+            mid = (low + high) // 2
+            if self._get_offset(mid) <= offset:
+                low = mid
+            else:
+                high = mid
+        return low
+
+    #===========================================
+    # writing
+
+    def is_boundary(self, it):
+        """Returns True if a segment can start at iter 'it'"""
+        if it.is_start() or it.is_end():
+            return True
+        if not it.starts_line():
+            return False
+
+        # a horizontal rule removes the newline before it
+        anchor = it.get_child_anchor()
+        if isinstance(anchor, RichTextHorizontalRule):
+            return False
+
+        tags = set(tag for tag in it.get_tags() if not ignore_tag(tag))
+        for tag in tags:
+            if isinstance(tag, RichTextIndentTag):
+                return False
+
+        # a font continuing across the line break
+        prev = it.copy()
+        prev.backward_char()
+        for tag in prev.get_tags():
+            if tag in tags:
+                return False
+
+        return True
+
+    def get_html(self, html_buffer, xhtml=True):
+        """Returns the HTML of the buffer body as a list of strings"""
+        pieces, pending = self.snapshot(html_buffer)
+        results = []
+        for i, mark in pending:
+            out = StringIO()
+            html_buffer.set_output(out)
+            html_buffer.write_contents(pieces[i], xhtml=xhtml)
+            pieces[i] = out.getvalue()
+            results.append((mark, pieces[i]))
+        self.store(results)
+        return pieces
+
+    def snapshot(self, html_buffer):
+        """
+        Capture the buffer for writing
+
+        Returns a list 'pieces' holding, for each segment, either its
+        cached HTML or its contents prepared by html_buffer, and a list of
+        (index, mark) of the segments to write.  The contents do not refer
+        to the buffer, so they can be written in another thread; the HTML
+        is then given back with store().
+        """
+        textbuffer = self._buffer
+        self._stale.clear()
+
+        if not self._marks:
+            self._marks, self._html = self._split_region(
+                textbuffer.get_start_iter(), textbuffer.get_end_iter())
+        else:
+            i = 0
+            while i < len(self._marks):
+                if self._html[i] is not None:
+                    i += 1
+                    continue
+
+                # find a run of dirty segments between two boundaries
+                j = i
+                while j < len(self._marks) and self._html[j] is None:
+                    j += 1
+                while i > 0 and not self.is_boundary(
+                        textbuffer.get_iter_at_mark(self._marks[i])):
+                    i -= 1
+                while j < len(self._marks) and not self.is_boundary(
+                        textbuffer.get_iter_at_mark(self._marks[j])):
+                    j += 1
+
+                start = textbuffer.get_iter_at_mark(self._marks[i])
+                if j < len(self._marks):
+                    end = textbuffer.get_iter_at_mark(self._marks[j])
+                else:
+                    end = textbuffer.get_end_iter()
+                marks, html = self._split_region(start, end)
+
+                for mark in self._marks[i:j]:
+                    textbuffer.delete_mark(mark)
+                self._marks[i:j] = marks
+                self._html[i:j] = html
+                i += len(marks)
+
+        pieces = []
+        pending = []
+        for i, html in enumerate(self._html):
+            if html is None:
+                mark = self._marks[i]
+                pending.append((i, mark))
+                start = textbuffer.get_iter_at_mark(mark)
+                if i + 1 < len(self._marks):
+                    end = textbuffer.get_iter_at_mark(self._marks[i + 1])
+                else:
+                    end = textbuffer.get_end_iter()
+                contents = iter_buffer_contents_fast(textbuffer, start, end,
+                                                     ignore_tag)
+                html = html_buffer.prepare_contents(contents,
+                                                    textbuffer.tag_table)
+            pieces.append(html)
+
+        return pieces, pending
+
+    def store(self, results):
+        """Store the HTML written for a list of (mark, html)"""
+        index = dict((mark, i) for i, mark in enumerate(self._marks))
+        for mark, html in results:
+            i = index.get(mark)
+            # skip segments that were edited or replaced since the snapshot
+            if i is not None and mark not in self._stale:
+                self._html[i] = html
+
+    def _split_region(self, start, end):
+        """Split a region into dirty segments"""
+        marks = []
+
+        def add_segment(start, end):
+            if start.equal(end) and marks:
+                return
+            marks.append(self._buffer.create_mark(None, start, True))
+
+        seg_start = start.copy()
+        it = start.copy()
+        while it.forward_line() and it.compare(end) < 0:
+            if self.is_boundary(it):
+                add_segment(seg_start, it)
+                seg_start = it.copy()
+        add_segment(seg_start, end)
+
+        return marks, [None] * len(marks)
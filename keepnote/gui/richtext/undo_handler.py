@@ -5,16 +5,19 @@
 
 """
 
+# python imports
+import sys
+
 # keepnote imports
-from keepnote.undo import UndoStack
+from keepnote.undo import UndoStack, UndoAction, ACTION_SIZE
 from keepnote.listening import Listeners
 
 # import textbuffer tools
 from .textbuffer_tools import \
-    iter_buffer_contents, \
+    iter_buffer_contents_fast, \
     buffer_contents_iter_to_offset, \
-    insert_buffer_contents, \
-    buffer_contents_apply_tags
+    flatten_buffer_contents, \
+    insert_flat_contents
 
 # richtext imports
 from .richtextbase_tags import RichTextTag
@@ -23,15 +26,45 @@ from .richtextbase_tags import RichTextTag
 # default maximum undo levels
 MAX_UNDOS = 100
 
+# default maximum memory (bytes) of undo actions
+MAX_UNDO_MEMORY = 10 * 1024 * 1024
+
+# approximate memory of a recorded tag run or anchor
+RANGE_SIZE = 64
+
 
 def add_child_to_buffer(textbuffer, it, anchor):
     textbuffer.add_child(it, anchor)
 
 
+def shift_ranges(tag_ranges, offset):
+    """Shift (tag, start, end) ranges by offset"""
+    return [(tag, start + offset, end + offset)
+            for tag, start, end in tag_ranges]
+
+
+def shift_anchors(anchors, offset):
+    """Shift (offset, anchor) pairs by offset"""
+    return [(anchor_offset + offset, anchor)
+            for anchor_offset, anchor in anchors]
+
+
+def join_ranges(ranges1, ranges2):
+    """Concatenate two lists of sorted ranges, joining touching runs"""
+    ranges = list(ranges1)
+    for item in ranges2:
+        if ranges and ranges[-1][-1] == item[-2] and \
+                ranges[-1][:-2] == item[:-2]:
+            ranges[-1] = ranges[-1][:-1] + item[-1:]
+        else:
+            ranges.append(item)
+    return ranges
+
+
 #=============================================================================
 # RichTextBaseBuffer undoable actions
 
-class Action (object):
+class Action (UndoAction):
     """A base class for undoable actions in RichTextBuffer"""
 
     def __init__(self):
@@ -74,6 +107,24 @@ class InsertAction (Action):
         #       (start.get_slice(end), self.text)
         self.textbuffer.delete(start, end)
 
+    def get_size(self):
+        return (ACTION_SIZE + sys.getsizeof(self.text) +
+                8 * len(self.current_tags))
+
+    def can_merge(self, action):
+        # merge typing of single characters into words
+        return (isinstance(action, InsertAction) and
+                action.textbuffer is self.textbuffer and
+                self.cursor_insert and action.cursor_insert and
+                action.length == 1 and action.text != "\n" and
+                (self.text[-1:].isspace() or not action.text.isspace()) and
+                action.pos == self.pos + self.length and
+                action.current_tags == self.current_tags)
+
+    def merge(self, action):
+        self.text += action.text
+        self.length += action.length
+
 
 class DeleteAction (Action):
     """Represents the act of deleting a region in a RichTextBuffer"""
@@ -86,7 +137,8 @@ class DeleteAction (Action):
         self.end_offset = end_offset
         self.text = text
         self.cursor_offset = cursor_offset
-        self.contents = []
+        self.anchors = []
+        self.tag_ranges = []
         self._record_range()
 
     def do(self):
@@ -100,17 +152,48 @@ class DeleteAction (Action):
         start = self.textbuffer.get_iter_at_offset(self.start_offset)
 
         self.textbuffer.begin_user_action()
-        insert_buffer_contents(self.textbuffer, start, self.contents,
-                               add_child=add_child_to_buffer)
+        insert_flat_contents(self.textbuffer, start, self.text,
+                             self.anchors, self.tag_ranges,
+                             add_child=add_child_to_buffer)
         cursor = self.textbuffer.get_iter_at_offset(self.cursor_offset)
         self.textbuffer.place_cursor(cursor)
         self.textbuffer.end_user_action()
 
     def _record_range(self):
+        # store deleted region as text, anchors and tag runs
         start = self.textbuffer.get_iter_at_offset(self.start_offset)
         end = self.textbuffer.get_iter_at_offset(self.end_offset)
-        self.contents = list(buffer_contents_iter_to_offset(
-            iter_buffer_contents(self.textbuffer, start, end)))
+        self.text, self.anchors, self.tag_ranges = flatten_buffer_contents(
+            iter_buffer_contents_fast(self.textbuffer, start, end))
+
+    def get_size(self):
+        return (ACTION_SIZE + sys.getsizeof(self.text) +
+                RANGE_SIZE * (len(self.anchors) + len(self.tag_ranges)))
+
+    def can_merge(self, action):
+        # merge deleting single characters with backspace or delete
+        return (isinstance(action, DeleteAction) and
+                action.textbuffer is self.textbuffer and
+                action.end_offset - action.start_offset == 1 and
+                not action.anchors and action.text != "\n" and
+                (action.end_offset == self.start_offset or
+                 action.start_offset == self.start_offset))
+
+    def merge(self, action):
+        if action.end_offset == self.start_offset:
+            # backspace
+            self.anchors = shift_anchors(self.anchors, 1)
+            self.tag_ranges = join_ranges(
+                action.tag_ranges, shift_ranges(self.tag_ranges, 1))
+            self.text = action.text + self.text
+            self.start_offset = action.start_offset
+        else:
+            # delete
+            self.tag_ranges = join_ranges(
+                self.tag_ranges,
+                shift_ranges(action.tag_ranges, len(self.text)))
+            self.text += action.text
+        self.end_offset = self.start_offset + len(self.text)
 
 
 class InsertChildAction (Action):
@@ -147,7 +230,7 @@ class TagAction (Action):
         self.start_offset = start_offset
         self.end_offset = end_offset
         self.applied = applied
-        self.contents = []
+        self.ranges = []
         self._record_range()
 
     def do(self):
@@ -166,16 +249,42 @@ class TagAction (Action):
         if self.applied:
             self.textbuffer.remove_tag(self.tag, start, end)
         # undo for remove tag is simply to restore old tags
-        buffer_contents_apply_tags(self.textbuffer, self.contents)
+        get_iter = self.textbuffer.get_iter_at_offset
+        for start, end in self.ranges:
+            self.textbuffer.apply_tag(self.tag, get_iter(start),
+                                      get_iter(end))
 
     def _record_range(self):
+        # store the (start, end) runs of this tag within the region
         start = self.textbuffer.get_iter_at_offset(self.start_offset)
         end = self.textbuffer.get_iter_at_offset(self.end_offset)
 
-        # TODO: I can probably discard iter's.  Maybe make argument to
-        # iter_buffer_contents
-        self.contents = [kind_it_param for kind_it_param in buffer_contents_iter_to_offset(
-                iter_buffer_contents(self.textbuffer, start, end)) if kind_it_param[0] in ("begin", "end") and kind_it_param[2] == self.tag]
+        self.ranges = []
+        run_start = None
+        for kind, offset, param in buffer_contents_iter_to_offset(
+                iter_buffer_contents_fast(self.textbuffer, start, end)):
+            if param != self.tag:
+                continue
+            if kind == "begin":
+                run_start = offset
+            elif kind == "end" and run_start is not None:
+                self.ranges.append((run_start, offset))
+                run_start = None
+
+    def get_size(self):
+        return ACTION_SIZE + RANGE_SIZE * len(self.ranges)
+
+    def can_merge(self, action):
+        # merge tagging of single typed characters with the current font
+        return (isinstance(action, TagAction) and
+                action.textbuffer is self.textbuffer and
+                action.tag == self.tag and action.applied == self.applied and
+                action.end_offset - action.start_offset == 1 and
+                action.start_offset == self.end_offset)
+
+    def merge(self, action):
+        self.ranges = join_ranges(self.ranges, action.ranges)
+        self.end_offset = action.end_offset
 
 
 #=============================================================================
@@ -186,7 +295,7 @@ class UndoHandler (object):
     """TextBuffer Handler that provides undo/redo functionality"""
 
     def __init__(self, textbuffer):
-        self.undo_stack = UndoStack(MAX_UNDOS)
+        self.undo_stack = UndoStack(MAX_UNDOS, MAX_UNDO_MEMORY)
         self._next_action = None
         self._buffer = textbuffer
         self.after_changed = Listeners()
@@ -235,7 +344,7 @@ class UndoHandler (object):
 
         action = TagAction(textbuffer, tag, start.get_offset(),
                            end.get_offset(), True)
-        self.undo_stack.do(action.do, action.undo, False)
+        self.undo_stack.do_action(action, False)
         textbuffer.set_modified(True)
 
     def on_remove_tag(self, textbuffer, tag, start, end):
@@ -247,7 +356,7 @@ class UndoHandler (object):
 
         action = TagAction(textbuffer, tag, start.get_offset(),
                            end.get_offset(), False)
-        self.undo_stack.do(action.do, action.undo, False)
+        self.undo_stack.do_action(action, False)
         textbuffer.set_modified(True)
 
     def on_changed(self, textbuffer):
@@ -261,7 +370,7 @@ class UndoHandler (object):
         # add action to undo stack
         action = self._next_action
         self._next_action = None
-        self.undo_stack.do(action.do, action.undo, False)
+        self.undo_stack.do_action(action, False)
 
         # perfrom additional "clean-up" actions
         # note: only if undo/redo is not currently in progress
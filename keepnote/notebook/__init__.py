@@ -839,12 +839,13 @@ class NoteBookNode (object):
             # change parent pointer
             self._attr["parentids"] = [parent._attr["nodeid"]]
 
+            # parents are listed before their children
             def walk(node):
-                sync.sync_node(node._attr["nodeid"], conn1, conn2,
-                               attr=node._attr)
+                yield node._attr["nodeid"], node._attr
                 for child in node.get_children():
-                    walk(child)
-            walk(self)
+                    for item in walk(child):
+                        yield item
+            sync.SyncScheduler(conn1, conn2).sync_nodes(walk(self))
         except:
             keepnote.log_error()
             raise
@@ -988,9 +989,30 @@ class NoteBookNode (object):
         """Iterate through children
            Returns temporary node objects
         """
-        for childid in self._attr["childrenids"]:
+        # read all children attrs at once, which is a single request for
+        # connections that support batch reads
+        childids = self._attr["childrenids"]
+        try:
+            attrs = self._conn.read_nodes(childids)
+        except (connection.ConnectionError, NotImplementedError) as e:
+            # fallback to reading children one at a time
+            keepnote.log_message(
+                "cannot read children of '%s' at once (%s), reading them "
+                "one at a time\n" % (self._attr.get("nodeid"), e))
+            for childid in childids:
+                try:
+                    yield self._notebook._read_node(childid, parent=self)
+                except:
+                    keepnote.log_error()
+                    continue
+            return
+
+        for childid, attr in zip(childids, attrs):
+            if attr is None:
+                keepnote.log_message("unknown child node '%s'\n" % childid)
+                continue
             try:
-                yield self._notebook._read_node(childid, parent=self)
+                yield self._notebook._new_node_from_attr(attr, parent=self)
             except:
                 keepnote.log_error()
                 continue
@@ -1368,6 +1390,8 @@ class NoteBook (NoteBookNode):
         # catches all the desired attr's
         self._conn.index_attr("icon", "TEXT")
         self._conn.index_attr("title", "TEXT", index_value=True)
+        self._conn.index_attr("content_type", "TEXT")
+        self._conn.index_attr("order", "INTEGER")
 
     #--------------------------------------
     # input/output
@@ -1424,6 +1448,10 @@ class NoteBook (NoteBookNode):
     def _read_node(self, nodeid, parent=None,
                    default_content_type=CONTENT_TYPE_DIR):
         attr = self._conn.read_node(nodeid)
+        return self._new_node_from_attr(attr, parent, default_content_type)
+
+    def _new_node_from_attr(self, attr, parent=None,
+                            default_content_type=CONTENT_TYPE_DIR):
         node = NoteBookNode(
             attr.get("title", DEFAULT_PAGE_NAME),
             parent=parent, notebook=self,
@@ -1486,7 +1514,7 @@ class NoteBook (NoteBookNode):
         filename = connection.path_join(
             NOTEBOOK_META_DIR, NOTEBOOK_ICON_DIR, basename)
         if self._conn.has_file(self._attr["nodeid"], filename):
-            return self._conn.get_file(self._attr["nodeid"], filename)
+            return self._conn.get_local_file(self._attr["nodeid"], filename)
         else:
             return None
 
@@ -25,8 +25,16 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
 #
 
+# python imports
+import hashlib
+import json
+import os
+import sys
 import urllib.parse
 
+# keepnote imports
+from keepnote.cache import LRUDict
+
 
 #=============================================================================
 # errors
@@ -113,9 +121,154 @@ def is_dir(filename):
     return filename.endswith('/')
 
 
+class OnCloseFile (object):
+    """A written file stream that calls 'on_close()' once it is closed"""
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def write(self, data):
+        return self._stream.write(data)
+
+    def close(self):
+        if self._on_close:
+            self._stream.close()
+            self._on_close()
+            self._on_close = None
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+#=============================================================================
+# content hashing
+
+HASH_BLOCK_SIZE = 1024*64
+
+# number of file hashes cached in memory by each connection
+FILE_HASH_CACHE_SIZE = 10000
+
+
+# attrs that are derived from other nodes and are not part of the hash
+HASH_ATTR_SKIP = set(["childrenids"])
+
+
+def hash_attr(attr):
+    """Returns a content hash of a node attr dict"""
+    attr = dict((key, value) for key, value in attr.items()
+                if key not in HASH_ATTR_SKIP)
+    data = json.dumps(attr, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode("utf8")).hexdigest()
+
+
+def hash_stream(stream):
+    """Returns a content hash of a file stream"""
+    h = hashlib.sha1()
+    while True:
+        data = stream.read(HASH_BLOCK_SIZE)
+        if len(data) == 0:
+            break
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        h.update(data)
+    return h.hexdigest()
+
+
+#=============================================================================
+# node trees
+
+def make_tree_row(nodeid, parentid, depth, attr, has_children):
+    """
+    Returns a node tree row
+
+    Rows are JSON-compatible dicts with the keys 'nodeid', 'parentid',
+    'depth', 'title', 'content_type', 'order', and 'has_children'.
+    """
+    return {
+        "nodeid": nodeid,
+        "parentid": parentid,
+        "depth": depth,
+        "title": attr.get("title"),
+        "content_type": attr.get("content_type"),
+        "order": attr.get("order"),
+        "has_children": has_children,
+    }
+
+
+def walk_node_tree(conn, nodeid, depth=None):
+    """
+    Returns the rows of the tree under 'nodeid' using only node reads
+
+    Each level of the tree is read with one batched read_nodes() call.
+    Nodes deeper than 'depth' below 'nodeid' are not read.
+    """
+    rows = []
+    level = [(nodeid, None)]
+    level_depth = 0
+    while level:
+        attrs = conn.read_nodes([childid for childid, parentid in level])
+        next_level = []
+        for (childid, parentid), attr in zip(level, attrs):
+            if attr is None:
+                continue
+            if parentid is None and attr.get("parentids"):
+                parentid = attr["parentids"][0]
+            childrenids = attr.get("childrenids", [])
+            rows.append(make_tree_row(childid, parentid, level_depth, attr,
+                                      bool(childrenids)))
+            if depth is None or level_depth < depth:
+                next_level.extend((grandchildid, childid)
+                                  for grandchildid in childrenids)
+        level = next_level
+        level_depth += 1
+    return rows
+
+
+def sort_node_tree(rows, nodeid):
+    """
+    Returns node tree rows in preorder starting from 'nodeid'
+
+    Siblings are ordered by their 'order' attr and then by title.
+    """
+    children = {}
+    root = None
+    for row in rows:
+        if row["nodeid"] == nodeid:
+            root = row
+        else:
+            children.setdefault(row["parentid"], []).append(row)
+    if root is None:
+        return []
+
+    def key(row):
+        order = row["order"]
+        return (order if isinstance(order, int) else sys.maxsize,
+                row["title"] or "")
+
+    result = []
+    stack = [root]
+    while stack:
+        row = stack.pop()
+        result.append(row)
+        stack.extend(sorted(children.get(row["nodeid"], ()),
+                            key=key, reverse=True))
+    return result
+
+
 #=============================================================================
 
 class NoteBookConnection (object):
+
+    # cache of local file hashes: (nodeid, filename) --> (size, mtime, hash)
+    _file_hashes = None
+
     def __init__(self):
         pass
 
@@ -149,6 +302,22 @@ class NoteBookConnection (object):
         """Read a node attr"""
         raise NotImplementedError("read_node")
 
+    def read_nodes(self, nodeids):
+        """
+        Read the attrs of several nodes
+
+        Returns a list of attrs in the same order as 'nodeids'.  Unknown
+        nodes are returned as None.  Connections with a high per-request
+        cost should override this with a batch read.
+        """
+        attrs = []
+        for nodeid in nodeids:
+            try:
+                attrs.append(self.read_node(nodeid))
+            except UnknownNode:
+                attrs.append(None)
+        return attrs
+
     def update_node(self, nodeid, attr):
         """Write node attr"""
         raise NotImplementedError("update_node")
@@ -252,6 +421,86 @@ class NoteBookConnection (object):
             stream1.close()
             stream2.close()
 
+    #---------------------------------
+    # manifests
+
+    def get_file_stat(self, nodeid, filename):
+        """
+        Returns (size, mtime) of a node file or (None, None) if unknown
+
+        Only connections that expose local files can stat them cheaply.
+        """
+        try:
+            path = self.get_local_file(nodeid, filename)
+            stat = os.stat(path)
+        except (NotImplementedError, ConnectionError, OSError, TypeError):
+            return None, None
+        return stat.st_size, stat.st_mtime
+
+    def get_file_hash(self, nodeid, filename, size=None, mtime=None):
+        """Returns the content hash of a node file"""
+
+        # Local files are hashed directly and cached by (size, mtime).
+        if mtime is not None:
+            filehash = self._get_cached_hash(nodeid, filename, size, mtime)
+            if filehash is None:
+                with open(self.get_local_file(nodeid, filename),
+                          "rb") as infile:
+                    filehash = hash_stream(infile)
+                self._set_cached_hash(nodeid, filename, size, mtime,
+                                      filehash)
+            return filehash
+
+        with self.open_file(nodeid, filename) as infile:
+            return hash_stream(infile)
+
+    def _get_cached_hash(self, nodeid, filename, size, mtime):
+        """Returns the cached hash of a file with (size, mtime) or None"""
+        if self._file_hashes is None:
+            return None
+        cached = self._file_hashes.get((nodeid, filename))
+        if cached and cached[:2] == (size, mtime):
+            return cached[2]
+        return None
+
+    def _set_cached_hash(self, nodeid, filename, size, mtime, filehash):
+        """Cache the hash of a file with (size, mtime)"""
+        if self._file_hashes is None:
+            self._file_hashes = LRUDict(FILE_HASH_CACHE_SIZE)
+        self._file_hashes[(nodeid, filename)] = (size, mtime, filehash)
+
+    def get_node_manifest(self, nodeid, attr=None):
+        """
+        Returns a manifest describing a node and its files
+
+        The manifest is a JSON-compatible dict:
+          {"nodeid": nodeid,
+           "attr_hash": hash,
+           "files": [[filename, size, mtime, hash], ...]}
+
+        Directories are listed with a trailing '/' and no size or hash.
+        """
+        if attr is None:
+            attr = self.read_node(nodeid)
+
+        files = []
+        dirs = ["/"]
+        while dirs:
+            for filename in self.list_dir(nodeid, dirs.pop()):
+                if is_dir(filename):
+                    files.append([filename, None, None, None])
+                    dirs.append(filename)
+                else:
+                    size, mtime = self.get_file_stat(nodeid, filename)
+                    files.append([filename, size, mtime, self.get_file_hash(
+                        nodeid, filename, size, mtime)])
+
+        return {
+            "nodeid": nodeid,
+            "attr_hash": hash_attr(attr),
+            "files": files,
+        }
+
     #---------------------------------
     # indexing
 
@@ -266,6 +515,8 @@ class NoteBookConnection (object):
         # ["has_fulltext"]
         # ["node_path", nodeid]
         # ["get_attr", nodeid, key]
+        # ["node_manifest", nodeid]
+        # ["node_tree", nodeid, (depth)]
 
         if query[0] == "index_attr":
             index_value = query[3] if len(query) == 4 else False
@@ -287,6 +538,13 @@ class NoteBookConnection (object):
         elif query[0] == "get_attr":
             return self.get_attr_by_id(query[1], query[2])
 
+        elif query[0] == "node_manifest":
+            return self.get_node_manifest(query[1])
+
+        elif query[0] == "node_tree":
+            depth = query[2] if len(query) == 3 else None
+            return walk_node_tree(self, query[1], depth)
+
         # FS-specific
         elif query[0] == "init":
             return self.init_index()
@@ -323,6 +581,16 @@ class NoteBookConnection (object):
     def get_attr_by_id(self, nodeid, key):
         return self.index(["get_attr", nodeid, key])
 
+    def get_node_tree(self, nodeid, depth=None):
+        """
+        Returns the rows of the tree under a node in preorder
+
+        See make_tree_row() for the row format.  Nodes more than 'depth'
+        levels below 'nodeid' are left out.
+        """
+        return sort_node_tree(self.index(["node_tree", nodeid, depth]),
+                              nodeid)
+
     #---------------------------------------
     # FS-specific index management
     # TODO: try to deprecate
@@ -356,6 +624,15 @@ class NoteBookConnection (object):
     def get_file(self, nodeid, filename, _path=None):
         raise NotImplementedError("get_file")
 
+    def get_local_file(self, nodeid, filename, _path=None):
+        """
+        Returns a local path for reading a node file
+
+        Unlike get_file(), the path may be shared with other files and
+        must not be written.
+        """
+        return self.get_file(nodeid, filename)
+
 
 #=============================================================================
 # Connection registration
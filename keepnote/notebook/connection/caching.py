@@ -0,0 +1,405 @@
+"""
+
+    KeepNote
+
+    Caching connection wrapper
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+# python imports
+from collections import defaultdict
+import io
+import threading
+
+# keepnote imports
+from keepnote.cache import LRUDict
+from keepnote.cache import NULL
+from keepnote.notebook.connection import NoteBookConnection
+
+
+# default cache limits
+DEFAULT_MAX_NODES = 5000
+DEFAULT_MAX_DIRS = 2000
+DEFAULT_MAX_FILES = 500
+
+# only files up to this size are cached
+DEFAULT_MAX_FILE_SIZE = 64 * 1024
+
+# names of the caches
+CACHE_NAMES = ("nodes", "has_node", "list_dir", "has_file", "files")
+
+
+def copy_attr(attr):
+    """Copy node attr so that cached attrs are not changed by callers"""
+    return dict((key, (list(value) if isinstance(value, list) else
+                       dict(value) if isinstance(value, dict) else value))
+                for key, value in attr.items())
+
+
+class PrefixedStream (io.RawIOBase):
+    """Reads some already consumed bytes and then the rest of a stream"""
+
+    def __init__(self, prefix, stream):
+        io.RawIOBase.__init__(self)
+        self._prefix = prefix
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if self._prefix:
+            size = min(len(buf), len(self._prefix))
+            buf[:size] = self._prefix[:size]
+            self._prefix = self._prefix[size:]
+            return size
+        data = self._stream.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._stream.close()
+        io.RawIOBase.close(self)
+
+
+class WriteStream (object):
+    """Calls a function when a written node file is closed"""
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if self._on_close:
+                on_close = self._on_close
+                self._on_close = None
+                on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+#=============================================================================
+# Caching connection
+
+class CachingConnection (NoteBookConnection):
+    """
+    Caches reads of a slower notebook connection
+
+    Node attrs, node existence, directory listings, file existence and
+    small file contents are kept in bounded LRU caches.  Writes made
+    through this connection invalidate the affected entries; changes made
+    by other clients of the inner connection are not seen until
+    invalidate() is called.
+    """
+
+    def __init__(self, conn, max_nodes=DEFAULT_MAX_NODES,
+                 max_dirs=DEFAULT_MAX_DIRS, max_files=DEFAULT_MAX_FILES,
+                 max_file_size=DEFAULT_MAX_FILE_SIZE):
+        NoteBookConnection.__init__(self)
+        self._conn = conn
+        self._max_file_size = max_file_size
+        self._lock = threading.RLock()
+        self._caches = {
+            "nodes": LRUDict(max_nodes),
+            "has_node": LRUDict(max_nodes),
+            "list_dir": LRUDict(max_dirs),
+            "has_file": LRUDict(max_dirs),
+            "files": LRUDict(max_files),
+        }
+        self._stats = defaultdict(int)
+
+        # Generations are bumped on invalidation, so that values read
+        # before a concurrent write are not cached afterwards.
+        self._generation = 0
+        self._generations = {}
+
+    def get_connection(self):
+        return self._conn
+
+    #======================
+    # cache
+
+    def _get(self, cache, key):
+        with self._lock:
+            value = self._caches[cache].get(key, NULL)
+            self._stats[cache + "_hits" if value is not NULL
+                        else cache + "_misses"] += 1
+            return value
+
+    def _get_generation(self, nodeid):
+        """Returns the current generation of a node's entries"""
+        with self._lock:
+            return self._generation, self._generations.get(nodeid, 0)
+
+    def _put(self, cache, key, value, generation):
+        """Cache a value unless its node was invalidated since 'generation'"""
+        nodeid = key[0] if isinstance(key, tuple) else key
+        with self._lock:
+            if self._get_generation(nodeid) == generation:
+                self._caches[cache][key] = value
+
+    def _bump_generation(self, nodeid=None):
+        with self._lock:
+            if nodeid is None:
+                self._generation += 1
+                self._generations.clear()
+            else:
+                self._generations[nodeid] = (
+                    self._generations.get(nodeid, 0) + 1)
+
+    def get_cache_stats(self):
+        """Returns hits, misses and entries of each cache"""
+        with self._lock:
+            return dict(
+                (name, {"hits": self._stats[name + "_hits"],
+                        "misses": self._stats[name + "_misses"],
+                        "entries": len(self._caches[name])})
+                for name in CACHE_NAMES)
+
+    def invalidate(self, nodeid=None):
+        """Drop cached entries for a node, or all entries if nodeid is None"""
+        with self._lock:
+            if nodeid is None:
+                self._bump_generation()
+                for cache in self._caches.values():
+                    cache.clear()
+                return
+            self._bump_generation(nodeid)
+            self._caches["nodes"].pop(nodeid, None)
+            self._caches["has_node"].pop(nodeid, None)
+            self._invalidate_files(nodeid)
+
+    def _invalidate_files(self, nodeid):
+        with self._lock:
+            self._bump_generation(nodeid)
+            for name in ("list_dir", "has_file", "files"):
+                cache = self._caches[name]
+                for key in [key for key in cache if key[0] == nodeid]:
+                    del cache[key]
+
+    def _invalidate_attrs(self):
+        with self._lock:
+            self._bump_generation()
+            self._caches["nodes"].clear()
+            self._caches["has_node"].clear()
+
+    #======================
+    # connection API
+
+    def connect(self, url):
+        self.invalidate()
+        return self._conn.connect(url)
+
+    def close(self):
+        self.invalidate()
+        return self._conn.close()
+
+    def save(self):
+        return self._conn.save()
+
+    #======================
+    # node I/O API
+
+    def create_node(self, nodeid, attr):
+        try:
+            return self._conn.create_node(nodeid, attr)
+        finally:
+            # Parents may derive their childrenids from their children.
+            self.invalidate(nodeid)
+            for parentid in attr.get("parentids", ()):
+                self.invalidate(parentid)
+
+    def read_node(self, nodeid):
+        attr = self._get("nodes", nodeid)
+        if attr is NULL:
+            generation = self._get_generation(nodeid)
+            attr = self._conn.read_node(nodeid)
+            self._put("nodes", nodeid, copy_attr(attr), generation)
+            self._put("has_node", nodeid, True, generation)
+            return attr
+        return copy_attr(attr)
+
+    def read_nodes(self, nodeids):
+        attrs = [self._get("nodes", nodeid) for nodeid in nodeids]
+        missing = [nodeid for nodeid, attr in zip(nodeids, attrs)
+                   if attr is NULL]
+        loaded = {}
+        if missing:
+            generations = dict((nodeid, self._get_generation(nodeid))
+                               for nodeid in missing)
+            loaded = dict(zip(missing, self._conn.read_nodes(missing)))
+            for nodeid, attr in loaded.items():
+                if attr is not None:
+                    self._put("nodes", nodeid, copy_attr(attr),
+                              generations[nodeid])
+                self._put("has_node", nodeid, attr is not None,
+                          generations[nodeid])
+        return [(loaded[nodeid] if attr is NULL else copy_attr(attr))
+                for nodeid, attr in zip(nodeids, attrs)]
+
+    def update_node(self, nodeid, attr):
+        with self._lock:
+            old_attr = self._caches["nodes"].get(nodeid)
+        try:
+            return self._conn.update_node(nodeid, attr)
+        finally:
+            if (old_attr is None or
+                    old_attr.get("parentids") != attr.get("parentids")):
+                # A moved node changes the children of unknown parents.
+                self._invalidate_attrs()
+            else:
+                self.invalidate(nodeid)
+                for parentid in attr.get("parentids", ()):
+                    self.invalidate(parentid)
+
+    def delete_node(self, nodeid):
+        try:
+            return self._conn.delete_node(nodeid)
+        finally:
+            # Connections may delete whole subtrees.
+            self.invalidate()
+
+    def has_node(self, nodeid):
+        exists = self._get("has_node", nodeid)
+        if exists is NULL:
+            generation = self._get_generation(nodeid)
+            exists = self._conn.has_node(nodeid)
+            self._put("has_node", nodeid, exists, generation)
+        return exists
+
+    def get_rootid(self):
+        return self._conn.get_rootid()
+
+    #===============
+    # file API
+
+    def open_file(self, nodeid, filename, mode="r", codec=None):
+        if not mode.startswith("r"):
+            self._invalidate_files(nodeid)
+            stream = self._conn.open_file(nodeid, filename, mode, codec)
+            return WriteStream(
+                stream, lambda: self._invalidate_files(nodeid))
+
+        key = (nodeid, filename)
+        data = self._get("files", key)
+        if data is NULL:
+            generation = self._get_generation(nodeid)
+            stream = self._conn.open_file(nodeid, filename, "rb")
+            data = stream.read(self._max_file_size + 1)
+            if len(data) > self._max_file_size:
+                stream = io.BufferedReader(PrefixedStream(data, stream))
+            else:
+                stream.close()
+                self._put("files", key, data, generation)
+                stream = io.BytesIO(data)
+        else:
+            stream = io.BytesIO(data)
+
+        if "b" in mode:
+            return stream
+        return io.TextIOWrapper(stream, encoding=codec or "utf-8")
+
+    def delete_file(self, nodeid, filename):
+        try:
+            return self._conn.delete_file(nodeid, filename)
+        finally:
+            self._invalidate_files(nodeid)
+
+    def create_dir(self, nodeid, filename):
+        try:
+            return self._conn.create_dir(nodeid, filename)
+        finally:
+            self._invalidate_files(nodeid)
+
+    def list_dir(self, nodeid, filename="/"):
+        key = (nodeid, filename)
+        names = self._get("list_dir", key)
+        if names is NULL:
+            generation = self._get_generation(nodeid)
+            names = list(self._conn.list_dir(nodeid, filename))
+            self._put("list_dir", key, names, generation)
+        return iter(names)
+
+    def has_file(self, nodeid, filename):
+        key = (nodeid, filename)
+        exists = self._get("has_file", key)
+        if exists is NULL:
+            generation = self._get_generation(nodeid)
+            exists = self._conn.has_file(nodeid, filename)
+            self._put("has_file", key, exists, generation)
+        return exists
+
+    def move_file(self, nodeid1, filename1, nodeid2, filename2):
+        try:
+            return self._conn.move_file(nodeid1, filename1,
+                                        nodeid2, filename2)
+        finally:
+            self._invalidate_files(nodeid1)
+            self._invalidate_files(nodeid2)
+
+    def copy_file(self, nodeid1, filename1, nodeid2, filename2):
+        try:
+            return self._conn.copy_file(nodeid1, filename1,
+                                        nodeid2, filename2)
+        finally:
+            self._invalidate_files(nodeid2)
+
+    def get_file_stat(self, nodeid, filename):
+        return self._conn.get_file_stat(nodeid, filename)
+
+    def get_file_hash(self, nodeid, filename, size=None, mtime=None):
+        return self._conn.get_file_hash(nodeid, filename, size, mtime)
+
+    def get_node_manifest(self, nodeid, attr=None):
+        return self._conn.get_node_manifest(nodeid, attr)
+
+    #---------------------------------
+    # indexing
+
+    def index(self, query):
+        return self._conn.index(query)
+
+    #================================
+    # Filesystem-specific API
+
+    def get_node_path(self, nodeid):
+        return self._conn.get_node_path(nodeid)
+
+    def get_node_basename(self, nodeid):
+        return self._conn.get_node_basename(nodeid)
+
+    def get_file(self, nodeid, filename, _path=None):
+        return self._conn.get_file(nodeid, filename)
+
+    def get_local_file(self, nodeid, filename, _path=None):
+        return self._conn.get_local_file(nodeid, filename)
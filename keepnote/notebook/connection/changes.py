@@ -0,0 +1,183 @@
+"""
+
+    KeepNote
+
+    Change log for notebook connections
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+# python imports
+from collections import deque
+import threading
+import time
+import uuid
+
+# keepnote imports
+import keepnote.notebook.connection as connlib
+from keepnote.notebook.connection.locking import LockedConnection
+
+
+# number of changes kept in the log
+DEFAULT_LOG_SIZE = 10000
+
+# change types
+CHANGE_CREATE_NODE = "create_node"
+CHANGE_UPDATE_NODE = "update_node"
+CHANGE_DELETE_NODE = "delete_node"
+CHANGE_FILE = "file"
+
+
+class ChangeLog (object):
+    """
+    A bounded log of notebook changes with increasing sequence numbers
+
+    Each change is a dict with keys 'seq', 'type', 'nodeid', 'parentids'
+    and 'filename'.  Every log has a unique 'logid', so clients can
+    detect a restarted server whose sequence numbers have started over.
+    """
+
+    def __init__(self, maxsize=DEFAULT_LOG_SIZE):
+        self.logid = str(uuid.uuid4())
+        self._changes = deque(maxlen=maxsize)
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def get_seq(self):
+        """Returns the sequence number of the latest change"""
+        with self._cond:
+            return self._seq
+
+    def add(self, type, nodeid, parentids=(), filename=None):
+        """Record a change and wake any waiting readers"""
+        with self._cond:
+            self._seq += 1
+            self._changes.append({
+                "seq": self._seq,
+                "type": type,
+                "nodeid": nodeid,
+                "parentids": list(parentids),
+                "filename": filename,
+            })
+            self._cond.notify_all()
+
+    def get_changes(self, since, timeout=0):
+        """
+        Returns changes after sequence number 'since'
+
+        If there are no changes yet, wait up to 'timeout' seconds for one.
+        Returns a dict with the keys 'logid', 'seq', 'changes', and 'reset'.
+        'reset' is True if changes after 'since' were dropped from the log,
+        in which case the caller should discard everything it has cached.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._seq <= since:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            if self._changes:
+                oldest = self._changes[0]["seq"]
+            else:
+                oldest = self._seq + 1
+            reset = since > self._seq or since < oldest - 1
+            if reset:
+                changes = []
+            else:
+                changes = [change for change in self._changes
+                           if change["seq"] > since]
+            return {
+                "logid": self.logid,
+                "seq": self._seq,
+                "changes": changes,
+                "reset": reset,
+            }
+
+
+class ChangeLogConnection (LockedConnection):
+    """
+    A locked connection that records every change in a ChangeLog
+    """
+
+    def __init__(self, conn, changes=None, lock=None):
+        LockedConnection.__init__(self, conn, lock)
+        self.changes = changes if changes else ChangeLog()
+
+    def _get_parentids(self, nodeid):
+        try:
+            parentids = self._conn.read_node(nodeid).get("parentids", [])
+        except connlib.UnknownNode:
+            return []
+        return [parentid for parentid in parentids if parentid is not None]
+
+    def create_node(self, nodeid, attr):
+        with self._lock.write_lock():
+            result = self._conn.create_node(nodeid, attr)
+            self.changes.add(CHANGE_CREATE_NODE, result or nodeid,
+                             attr.get("parentids", []))
+            return result
+
+    def update_node(self, nodeid, attr):
+        with self._lock.write_lock():
+            # Both old and new parents change their children.
+            parentids = self._get_parentids(nodeid)
+            self._conn.update_node(nodeid, attr)
+            for parentid in attr.get("parentids", []):
+                if parentid not in parentids:
+                    parentids.append(parentid)
+            self.changes.add(CHANGE_UPDATE_NODE, nodeid, parentids)
+
+    def delete_node(self, nodeid):
+        with self._lock.write_lock():
+            parentids = self._get_parentids(nodeid)
+            self._conn.delete_node(nodeid)
+            self.changes.add(CHANGE_DELETE_NODE, nodeid, parentids)
+
+    def open_file(self, nodeid, filename, mode="r", codec=None):
+        stream = LockedConnection.open_file(
+            self, nodeid, filename, mode, codec)
+        if mode.startswith("r"):
+            return stream
+        return connlib.OnCloseFile(stream, lambda: self.changes.add(
+            CHANGE_FILE, nodeid, filename=filename))
+
+    def delete_file(self, nodeid, filename):
+        with self._lock.write_lock():
+            self._conn.delete_file(nodeid, filename)
+            self.changes.add(CHANGE_FILE, nodeid, filename=filename)
+
+    def create_dir(self, nodeid, filename):
+        with self._lock.write_lock():
+            self._conn.create_dir(nodeid, filename)
+            self.changes.add(CHANGE_FILE, nodeid, filename=filename)
+
+    def move_file(self, nodeid1, filename1, nodeid2, filename2):
+        with self._lock.write_lock():
+            self._conn.move_file(nodeid1, filename1, nodeid2, filename2)
+            self.changes.add(CHANGE_FILE, nodeid1, filename=filename1)
+            self.changes.add(CHANGE_FILE, nodeid2, filename=filename2)
+
+    def copy_file(self, nodeid1, filename1, nodeid2, filename2):
+        with self._lock.write_lock():
+            self._conn.copy_file(nodeid1, filename1, nodeid2, filename2)
+            self.changes.add(CHANGE_FILE, nodeid2, filename=filename2)
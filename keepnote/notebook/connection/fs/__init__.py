@@ -99,6 +99,7 @@ from keepnote.notebook.connection import ConnectionError
 from keepnote.notebook.connection import NodeExists
 from keepnote.notebook.connection import NoteBookConnection
 from keepnote.notebook.connection import UnknownNode
+from keepnote.notebook.connection.fs import blobs as blobslib
 from keepnote.notebook.connection.fs import index as notebook_index
 from keepnote.notebook.connection.fs.file import FileFS
 from keepnote.notebook.connection.fs.file import get_node_filename
@@ -604,7 +605,11 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
 
     def get_file(self, nodeid, filename, _path=None):
         path = self._get_node_path(nodeid) if _path is None else _path
-        return get_node_filename(path, filename)
+        return self._filefs.get_file(nodeid, filename, _path=path)
+
+    def get_local_file(self, nodeid, filename, _path=None):
+        path = self._get_node_path(nodeid) if _path is None else _path
+        return self._filefs.get_local_file(nodeid, filename, _path=path)
 
     #===========================
     # Private path API
@@ -657,10 +662,16 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         """Make a new connection"""
         self._filename = url
         self.init_index()
+        if os.path.exists(self._get_blob_dir()):
+            self.enable_blob_store()
 
     def close(self):
         """Close connection"""
         self._index.close()
+        blobs = self._filefs.get_blob_store()
+        if blobs:
+            blobs.close()
+            self._filefs.set_blob_store(None)
         self._filename = None
 
     def save(self):
@@ -1022,7 +1033,8 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
 
     def _get_node_attr_file(self, nodeid, path=None):
         """Returns the meta file for the node"""
-        return self.get_file(nodeid, NODE_META_FILE, path)
+        path = self._get_node_path(nodeid) if path is None else path
+        return get_node_filename(path, NODE_META_FILE)
 
     def _write_attr(self, filename, nodeid, attr):
         """Write a node meta data file"""
@@ -1056,6 +1068,8 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         """Delete a node file."""
         self._filefs.delete_file(
             nodeid, filename, _path=_path)
+        if self._index:
+            self._index.remove_file_hash(nodeid, filename)
 
     def list_dir(self, nodeid, filename="/", _path=None):
         """
@@ -1089,6 +1103,84 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         self._filefs.copy_file(nodeid1, filename1, nodeid2, filename2,
                                _path1=_path1, _path2=_path2)
 
+    #---------------------------------
+    # blob store
+
+    def _get_blob_dir(self):
+        return os.path.join(self._filename, NOTEBOOK_META_DIR,
+                            blobslib.BLOB_DIR)
+
+    def get_blob_store(self):
+        """Returns the BlobStore of the notebook or None"""
+        return self._filefs.get_blob_store()
+
+    def enable_blob_store(self):
+        """
+        Store large node files by content hash from now on
+
+        The store is kept in the notebook, so it is used by every later
+        connection.  Use migrate_blobs() to move existing files into it.
+        """
+        blobs = self._filefs.get_blob_store()
+        if not blobs:
+            blobs = blobslib.BlobStore(self._get_blob_dir())
+            self._filefs.set_blob_store(blobs)
+        return blobs
+
+    def migrate_blobs(self):
+        """
+        Move the large files of all nodes into the blob store
+
+        Returns the number of files moved.
+        """
+        blobs = self.enable_blob_store()
+        nfiles = 0
+        for dirpath, dirnames, filenames in os.walk(self._filename):
+            if dirpath == self._filename and NOTEBOOK_META_DIR in dirnames:
+                dirnames.remove(NOTEBOOK_META_DIR)
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                if (blobslib.is_blob_file(filename,
+                                          os.path.getsize(filename)) and
+                        not blobslib.is_ref_file(filename)):
+                    blobs.add_file(filename)
+                    nfiles += 1
+        return nfiles
+
+    def collect_blobs(self):
+        """
+        Recount blob references and remove unreferenced blobs
+
+        Returns a dict with the keys 'blobs' and 'bytes' removed.
+        """
+        blobs = self.enable_blob_store()
+        refs = {}
+        # files in the notebook meta directory (e.g. thumbnails) may also
+        # be stored as blobs
+        for filename, key, size in blobslib.iter_refs(
+                self._filename, skip=(blobs.get_path(),)):
+            refs[key] = refs.get(key, 0) + 1
+        return blobs.collect(refs)
+
+    def _get_cached_hash(self, nodeid, filename, size, mtime):
+        # file hashes are also kept in the index across connections
+        filehash = NoteBookConnection._get_cached_hash(
+            self, nodeid, filename, size, mtime)
+        if filehash is None and self._index:
+            filehash = self._index.get_file_hash(nodeid, filename,
+                                                 size, mtime)
+            if filehash is not None:
+                NoteBookConnection._set_cached_hash(
+                    self, nodeid, filename, size, mtime, filehash)
+        return filehash
+
+    def _set_cached_hash(self, nodeid, filename, size, mtime, filehash):
+        NoteBookConnection._set_cached_hash(
+            self, nodeid, filename, size, mtime, filehash)
+        if self._index:
+            self._index.set_file_hash(nodeid, filename, size, mtime,
+                                      filehash)
+
     #---------------------------------
     # index management
 
@@ -1143,6 +1235,10 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         elif query[0] == "compact":
             return self._index.compact()
 
+        elif query[0] == "node_tree" and not self._index.index_needed():
+            depth = query[2] if len(query) == 3 else None
+            return self._index.get_node_tree(query[1], depth)
+
         else:
             return NoteBookConnection.index(self, query)
 
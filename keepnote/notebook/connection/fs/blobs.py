@@ -0,0 +1,360 @@
+"""
+
+    KeepNote
+
+    Content-addressed blob store for node files
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+# python imports
+import hashlib
+import os
+import re
+import shutil
+import sqlite3 as sqlite
+import stat
+import tempfile
+import threading
+
+# keepnote imports
+from keepnote.notebook.connection.fs.paths import NODE_META_FILE
+
+
+# directory of the blob store within the notebook meta directory
+BLOB_DIR = "blobs"
+
+# refcount database within the blob store
+BLOB_DB = "blobs.sqlite"
+
+# reference files are kept next to their node file under this prefix,
+# which node files may not use
+REF_PREFIX = "__blobref__"
+
+# the first bytes of a reference file
+REF_HEADER = b"keepnote-blob-ref 1 "
+
+# reference files are never larger than this
+MAX_REF_SIZE = 128
+
+# smaller files are kept in the node directory
+MIN_BLOB_SIZE = 4096
+
+# node files that are always kept in the node directory
+INLINE_FILES = set([NODE_META_FILE, "page.html", "notebook.nbk"])
+
+# file extensions kept on blob files
+BLOB_EXT = re.compile(r"^\.[A-Za-z0-9_-]{1,16}$")
+
+BLOCK_SIZE = 64 * 1024
+
+
+#=============================================================================
+# reference files
+
+
+def hash_file(filename):
+    """Returns the (sha1 hash, size) of a local file"""
+    h = hashlib.sha1()
+    size = 0
+    with open(filename, "rb") as infile:
+        while True:
+            data = infile.read(BLOCK_SIZE)
+            if not data:
+                break
+            h.update(data)
+            size += len(data)
+    return h.hexdigest(), size
+
+
+def get_ref_file(filename):
+    """Returns the local path of the reference file for a node file"""
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, REF_PREFIX + basename)
+
+
+def is_ref_file(filename):
+    """Returns True if a filename is reserved for reference files"""
+    return os.path.basename(filename.rstrip("/")).startswith(REF_PREFIX)
+
+
+def read_ref(filename):
+    """
+    Returns the (key, size) of the blob holding a node file
+
+    Returns None if the file is not stored as a blob.
+    """
+    reffile = get_ref_file(filename)
+    try:
+        if os.path.getsize(reffile) > MAX_REF_SIZE:
+            return None
+        with open(reffile, "rb") as infile:
+            data = infile.read(MAX_REF_SIZE)
+    except (OSError, IOError):
+        return None
+
+    if not data.startswith(REF_HEADER):
+        return None
+    try:
+        key, size = data[len(REF_HEADER):].decode("ascii").split()
+        return key, int(size)
+    except ValueError:
+        return None
+
+
+def write_ref(filename, key, size):
+    """Replace a local file with a reference to a blob"""
+    reffile = get_ref_file(filename)
+    fd, tmp = tempfile.mkstemp(".tmp", os.path.basename(reffile) + "_",
+                               dir=os.path.dirname(reffile) or ".")
+    with os.fdopen(fd, "wb") as out:
+        out.write(REF_HEADER + ("%s %d\n" % (key, size)).encode("ascii"))
+    os.replace(tmp, reffile)
+    if os.path.isfile(filename):
+        os.remove(filename)
+
+
+def remove_ref(filename):
+    """Remove the reference file of a node file, if any"""
+    reffile = get_ref_file(filename)
+    if os.path.isfile(reffile):
+        os.remove(reffile)
+
+
+def get_blob_key(filehash, filename):
+    """
+    Returns the key of the blob holding a file
+
+    The key is the content hash followed by the file extension, so that
+    blob files keep their type when opened by other programs.
+    """
+    ext = os.path.splitext(filename)[1]
+    if not BLOB_EXT.match(ext):
+        ext = ""
+    return filehash + ext
+
+
+def is_blob_file(filename, size):
+    """Returns True if a node file should be stored as a blob"""
+    return (os.path.basename(filename) not in INLINE_FILES and
+            size >= MIN_BLOB_SIZE)
+
+
+def iter_refs(path, skip=()):
+    """
+    Iterate through the reference files under a local path
+
+    Yields (filename, key, size) where filename is the local path of the
+    node file.  The local directories in 'skip' are not searched.
+    """
+    skip = set(os.path.normpath(dirname) for dirname in skip)
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [name for name in dirnames
+                       if os.path.normpath(os.path.join(dirpath, name))
+                       not in skip]
+        for name in filenames:
+            if not name.startswith(REF_PREFIX):
+                continue
+            filename = os.path.join(dirpath, name[len(REF_PREFIX):])
+            ref = read_ref(filename)
+            if ref:
+                yield filename, ref[0], ref[1]
+
+
+#=============================================================================
+# blob store
+
+
+class BlobStore (object):
+    """
+    Stores node files by content hash with reference counting
+
+    Blobs live in 'path/ab/cdef....png' for the key 'abcdef....png' (see
+    get_blob_key) and are read-only.  Node directories hold small
+    reference files in their place (see get_ref_file).
+
+    Reference counts are kept up to date by the notebook connection, but
+    node directories may also be copied or deleted behind its back, so
+    blobs are only ever removed by collect(), after a full scan.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.RLock()
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._con = sqlite.connect(os.path.join(path, BLOB_DB),
+                                   check_same_thread=False)
+        self._con.execute("""CREATE TABLE IF NOT EXISTS Blobs
+                             (hash TEXT PRIMARY KEY,
+                              size INTEGER,
+                              refs INTEGER);""")
+        self._con.commit()
+
+    def get_path(self):
+        return self._path
+
+    def close(self):
+        with self._lock:
+            if self._con:
+                self._con.commit()
+                self._con.close()
+                self._con = None
+
+    def get_blob_file(self, key):
+        """Returns the local path of a blob"""
+        return os.path.join(self._path, key[:2], key[2:])
+
+    def has_blob(self, key):
+        return os.path.exists(self.get_blob_file(key))
+
+    #==========================
+    # references
+
+    def get_refs(self, key):
+        """Returns the reference count of a blob"""
+        with self._lock:
+            row = self._con.execute("SELECT refs FROM Blobs WHERE hash=?",
+                                    (key,)).fetchone()
+            return row[0] if row else 0
+
+    def incref(self, key, size, count=1):
+        with self._lock:
+            self._con.execute(
+                """INSERT OR IGNORE INTO Blobs VALUES (?, ?, 0)""",
+                (key, size))
+            self._con.execute(
+                """UPDATE Blobs SET refs = refs + ? WHERE hash=?""",
+                (count, key))
+            self._con.commit()
+
+    def decref(self, key):
+        with self._lock:
+            self._con.execute(
+                """UPDATE Blobs SET refs = MAX(0, refs - 1) WHERE hash=?""",
+                (key,))
+            self._con.commit()
+
+    #==========================
+    # storing files
+
+    def add_file(self, filename, filehash=None, size=None):
+        """
+        Move a local file into the store and leave a reference in its place
+
+        Returns (key, size).
+        """
+        if filehash is None:
+            filehash, size = hash_file(filename)
+        key = get_blob_key(filehash, filename)
+        blobfile = self.get_blob_file(key)
+
+        with self._lock:
+            if os.path.exists(blobfile):
+                os.remove(filename)
+            else:
+                dirname = os.path.dirname(blobfile)
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                shutil.move(filename, blobfile)
+                os.chmod(blobfile, stat.S_IRUSR | stat.S_IRGRP |
+                         stat.S_IROTH)
+            write_ref(filename, key, size)
+            self.incref(key, size)
+        return key, size
+
+    def link_file(self, filename, key, size):
+        """Write a reference to an existing blob"""
+        with self._lock:
+            write_ref(filename, key, size)
+            self.incref(key, size)
+
+    def restore_file(self, filename, key):
+        """Replace a reference with a private copy of its blob"""
+        fd, tmp = tempfile.mkstemp(".tmp", os.path.basename(filename) + "_",
+                                   dir=os.path.dirname(filename) or ".")
+        os.close(fd)
+        shutil.copyfile(self.get_blob_file(key), tmp)
+        os.replace(tmp, filename)
+        remove_ref(filename)
+        self.decref(key)
+
+    #==========================
+    # maintenance
+
+    def collect(self, refs):
+        """
+        Remove unreferenced blobs
+
+        'refs' maps every key referenced in the notebook to its number of
+        references.  Stored reference counts are replaced by these counts.
+        Returns a dict with the keys 'blobs' and 'bytes' removed.
+        """
+        removed = 0
+        freed = 0
+        with self._lock:
+            self._con.execute("UPDATE Blobs SET refs = 0")
+            for key, count in refs.items():
+                self._con.execute("UPDATE Blobs SET refs = ? WHERE hash=?",
+                                  (count, key))
+
+            for dirname in os.listdir(self._path):
+                dirpath = os.path.join(self._path, dirname)
+                if not os.path.isdir(dirpath):
+                    continue
+                for name in os.listdir(dirpath):
+                    key = dirname + name
+                    if refs.get(key):
+                        continue
+                    blobfile = os.path.join(dirpath, name)
+                    freed += os.path.getsize(blobfile)
+                    removed += 1
+                    os.chmod(blobfile, stat.S_IRUSR | stat.S_IWUSR)
+                    os.remove(blobfile)
+                    self._con.execute("DELETE FROM Blobs WHERE hash=?",
+                                      (key,))
+                if not os.listdir(dirpath):
+                    os.rmdir(dirpath)
+
+            self._con.commit()
+        return {"blobs": removed, "bytes": freed}
+
+    def get_stats(self):
+        """
+        Returns statistics for the store
+
+        'bytes_saved' is the space the referenced files would use if each
+        reference were a separate copy, less the space of the blobs.
+        """
+        with self._lock:
+            blobs, refs, stored, referenced = self._con.execute(
+                """SELECT COUNT(*), SUM(refs), SUM(size), SUM(size * refs)
+                   FROM Blobs""").fetchone()
+        stored = stored or 0
+        referenced = referenced or 0
+        return {
+            "blobs": blobs,
+            "refs": refs or 0,
+            "bytes_stored": stored,
+            "bytes_referenced": referenced,
+            "bytes_saved": max(0, referenced - stored),
+        }
@@ -3,8 +3,10 @@ import shutil
 
 from keepnote import safefile
 from keepnote.notebook.connection import FileError
+from keepnote.notebook.connection import OnCloseFile
 from keepnote.notebook.connection import path_join
 from keepnote.notebook.connection import UnknownFile
+from keepnote.notebook.connection.fs import blobs as blobslib
 from keepnote.notebook.connection.fs.paths import get_node_meta_file
 from keepnote.notebook.connection.fs.paths import path_node2local
 from keepnote.notebook.connection.fs.paths import NODE_META_FILE
@@ -22,27 +24,126 @@ def get_node_filename(node_path, filename):
     return os.path.join(node_path, path_node2local(filename))
 
 
+def check_filename(filename):
+    """Raises FileError if a node filename is reserved"""
+    if blobslib.is_ref_file(filename):
+        raise FileError("filename '%s' is reserved" % filename)
+
+
 class FileFS(object):
     """
     Implements the NoteBook File API using the file-system.
     """
 
-    def __init__(self, nodeid2path):
+    def __init__(self, nodeid2path, blobs=None):
         """
         nodeid2path: a function that returns a filesystem path for a nodeid.
+        blobs: an optional BlobStore for large files.
         """
         self._nodeid2path = nodeid2path
+        self._blobs = blobs
 
     def get_node_path(self, nodeid):
         return self._nodeid2path(nodeid)
 
+    def set_blob_store(self, blobs):
+        """Store large files in a BlobStore (None to disable)"""
+        self._blobs = blobs
+
+    def get_blob_store(self):
+        return self._blobs
+
+    def get_file(self, nodeid, filename, _path=None):
+        """
+        Returns the local path of a node file
+
+        Files stored as blobs are first replaced by a private copy, so that
+        the path may be handed out for editing.
+        """
+        path = self.get_node_path(nodeid) if _path is None else _path
+        fullname = get_node_filename(path, filename)
+        if self._blobs:
+            ref = blobslib.read_ref(fullname)
+            if ref:
+                try:
+                    self._blobs.restore_file(fullname, ref[0])
+                except Exception as e:
+                    raise FileError("cannot copy file '%s'" % fullname, e)
+        return fullname
+
+    def get_local_file(self, nodeid, filename, _path=None):
+        """
+        Returns the local path holding the contents of a node file
+
+        Files stored as blobs resolve to the blob, which must only be read.
+        """
+        path = self.get_node_path(nodeid) if _path is None else _path
+        fullname = get_node_filename(path, filename)
+        if self._blobs:
+            ref = blobslib.read_ref(fullname)
+            if ref:
+                return self._blobs.get_blob_file(ref[0])
+        return fullname
+
+    def _store_blob(self, fullname):
+        """Move a newly written file into the blob store if it is large"""
+        try:
+            size = os.path.getsize(fullname)
+            if blobslib.is_blob_file(fullname, size):
+                self._blobs.add_file(fullname)
+        except Exception as e:
+            raise FileError("cannot store file '%s'" % fullname, e)
+
+    def _release_refs(self, fullname):
+        """Drop the blob references of a file or directory to be removed"""
+        if os.path.isdir(fullname):
+            for filename, filehash, size in blobslib.iter_refs(fullname):
+                self._blobs.decref(filehash)
+        else:
+            ref = blobslib.read_ref(fullname)
+            if ref:
+                blobslib.remove_ref(fullname)
+                self._blobs.decref(ref[0])
+
+    def _exists(self, fullname):
+        """Returns True if a local node file or its reference exists"""
+        return (os.path.exists(fullname) or
+                bool(self._blobs and blobslib.read_ref(fullname)))
+
+    def _copy_blob_file(self, fullname1, fullname2, ref=None):
+        """
+        Copy a file into a node, sharing its blob if possible
+
+        ref -- the (key, size) of the blob holding the source file, if any
+        Returns False if the file should be copied normally.
+        """
+        if self._exists(fullname2):
+            self._release_refs(fullname2)
+
+        if ref:
+            self._blobs.link_file(fullname2, ref[0], ref[1])
+            return True
+
+        size = os.path.getsize(fullname1)
+        if not blobslib.is_blob_file(fullname2, size):
+            return False
+        filehash, size = blobslib.hash_file(fullname1)
+        key = blobslib.get_blob_key(filehash, fullname2)
+        if self._blobs.has_blob(key):
+            self._blobs.link_file(fullname2, key, size)
+        else:
+            shutil.copy(fullname1, fullname2)
+            self._blobs.add_file(fullname2, filehash, size)
+        return True
+
     def open_file(self, nodeid, filename, mode="r", codec=None, _path=None):
         """Open a node file"""
-        if mode not in "rwa" and mode + "b" not in "rbwbab":  # 检查合法模式
+        if mode not in ("r", "w", "a", "rb", "wb", "ab"):  # 检查合法模式
             raise FileError("mode must be 'r', 'w', 'a', 'rb', 'wb', or 'ab'")
 
         if filename.endswith("/"):
             raise FileError("filename '%s' cannot end with '/'" % filename)
+        check_filename(filename)
 
         path = self.get_node_path(nodeid) if _path is None else _path
         fullname = get_node_filename(path, filename)
@@ -52,6 +153,16 @@ class FileFS(object):
             if not os.path.exists(dirpath):
                 os.makedirs(dirpath)
 
+            if self._blobs:
+                ref = blobslib.read_ref(fullname)
+                if ref and mode.startswith("r"):
+                    return safefile.open(self._blobs.get_blob_file(ref[0]),
+                                         mode, codec=codec)
+                elif ref and mode.startswith("a"):
+                    self._blobs.restore_file(fullname, ref[0])
+                elif ref:
+                    self._release_refs(fullname)
+
             # 直接使用传入的 mode，不强制添加 "b"
             stream = safefile.open(fullname, mode, codec=codec)
         except Exception as e:
@@ -59,6 +170,8 @@ class FileFS(object):
                 "cannot open file '%s' '%s': %s" %
                 (nodeid, filename, str(e)), e)
 
+        if self._blobs and not mode.startswith("r"):
+            return OnCloseFile(stream, lambda: self._store_blob(fullname))
         return stream
 
     def delete_file(self, nodeid, filename, _path=None):
@@ -67,6 +180,8 @@ class FileFS(object):
         filepath = get_node_filename(path, filename)
 
         try:
+            if self._blobs and self._exists(filepath):
+                self._release_refs(filepath)
             if os.path.isfile(filepath):
                 os.remove(filepath)
             elif filename.endswith('/') and os.path.isdir(filepath):
@@ -108,7 +223,11 @@ class FileFS(object):
                               (nodeid, filename))
 
         for name in filenames:
-            if (name != NODE_META_FILE and
+            if name.startswith(blobslib.REF_PREFIX):
+                name = name[len(blobslib.REF_PREFIX):]
+                if name not in filenames:
+                    yield path_join(filename, name)
+            elif (name != NODE_META_FILE and
                     not name.startswith("__")):
                 fullname = os.path.join(path, name)
                 node_fullname = path_join(filename, name)
@@ -121,10 +240,12 @@ class FileFS(object):
     def has_file(self, nodeid, filename, _path=None):
         """Return True if file exists."""
         path = self.get_node_path(nodeid) if _path is None else _path
+        fullname = get_node_filename(path, filename)
         if filename.endswith("/"):
-            return os.path.isdir(get_node_filename(path, filename))
+            return os.path.isdir(fullname)
         else:
-            return os.path.isfile(get_node_filename(path, filename))
+            return (os.path.isfile(fullname) or
+                    bool(self._blobs and blobslib.read_ref(fullname)))
 
     def move_file(self, nodeid1, filename1, nodeid2, filename2,
                   _path1=None, _path2=None):
@@ -133,13 +254,20 @@ class FileFS(object):
         path2 = self.get_node_path(nodeid2) if _path2 is None else _path2
         filepath1 = get_node_filename(path1, filename1)
         filepath2 = get_node_filename(path2, filename2)
+        check_filename(filename2)
         try:
+            if self._blobs and self._exists(filepath2):
+                self._release_refs(filepath2)
             if os.path.isfile(filepath2):
                 os.remove(filepath2)
             if os.path.isdir(filepath2):  # 修正可能的笔误
                 shutil.rmtree(filepath2)
 
-            os.rename(filepath1, filepath2)
+            if self._blobs and blobslib.read_ref(filepath1):
+                os.rename(blobslib.get_ref_file(filepath1),
+                          blobslib.get_ref_file(filepath2))
+            else:
+                os.rename(filepath1, filepath2)
         except Exception as e:
             raise FileError("could not move file '%s' '%s'" %
                             (nodeid1, filename1), e)
@@ -153,6 +281,9 @@ class FileFS(object):
         """
         if nodeid1 is None:
             fullname1 = filename1
+        elif self._blobs and nodeid2 is None:
+            # copy the contents of a blob out of the notebook
+            fullname1 = self.get_local_file(nodeid1, filename1, _path1)
         else:
             path1 = self.get_node_path(nodeid1) if not _path1 else _path1
             fullname1 = get_node_filename(path1, filename1)
@@ -160,14 +291,25 @@ class FileFS(object):
         if nodeid2 is None:
             fullname2 = filename2
         else:
+            check_filename(filename2)
             path2 = self.get_node_path(nodeid2) if not _path2 else _path2
             fullname2 = get_node_filename(path2, filename2)
 
+        ref = None
+        if self._blobs and nodeid1 is not None and nodeid2 is not None:
+            ref = blobslib.read_ref(fullname1)
+
         try:
-            if os.path.isfile(fullname1):
-                shutil.copy(fullname1, fullname2)
+            if ref or os.path.isfile(fullname1):
+                if not (self._blobs and nodeid2 is not None and
+                        self._copy_blob_file(fullname1, fullname2, ref)):
+                    shutil.copy(fullname1, fullname2)
             elif os.path.isdir(fullname1):
                 shutil.copytree(fullname1, fullname2)
+                if self._blobs and nodeid2 is not None:
+                    for name, filehash, size in blobslib.iter_refs(
+                            fullname2):
+                        self._blobs.incref(filehash, size)
         except Exception as e:
             raise FileError(
-                "unable to copy file '%s' '%s'" % (nodeid1, filename1), e)
\ No newline at end of file
+                "unable to copy file '%s' '%s'" % (nodeid1, filename1), e)
@@ -42,12 +42,19 @@ except Exception as e:
 # keepnote imports
 import keepnote
 import keepnote.notebook
+import keepnote.notebook.connection as connlib
 from keepnote.notebook.connection.index import NodeIndex
+from keepnote.notebook.connection.locking import RWLock
+from keepnote.notebook.connection.locking import read_locked
+from keepnote.notebook.connection.locking import write_locked
 
 
 # index filename
 INDEX_FILE = "index.sqlite"
-INDEX_VERSION = 3
+INDEX_VERSION = 4
+
+# number of file hashes buffered before they are written to the index
+FILE_HASH_BATCH = 1000
 
 #=============================================================================
 
@@ -55,14 +62,23 @@ INDEX_VERSION = 3
 # TODO: remove uniroot
 
 class NoteBookIndex (NodeIndex):
-    """Index for a NoteBook"""
+    """
+    Index for a NoteBook
+
+    Queries share a reader/writer lock and use their own cursors, so they
+    may run concurrently.  Changes to the index hold the lock exclusively.
+    """
 
     def __init__(self, conn, index_file):
         NodeIndex.__init__(self, conn)
         self._index_file = index_file
         self._uniroot = keepnote.notebook.UNIVERSAL_ROOT
         self.con = None     # sqlite connection
-        self.cur = None     # sqlite cursor
+        self.cur = None     # sqlite cursor used for changes
+        self._lock = RWLock()
+
+        # file hashes not yet written: (nodeid, filename) --> row
+        self._file_hashes = {}
 
         # index state/capabilities
         self._need_index = False
@@ -74,6 +90,7 @@ class NoteBookIndex (NodeIndex):
     #-----------------------------------------
     # index connection
 
+    @write_locked
     def open(self, auto_clear=True):
         """Open connection to index"""
         try:
@@ -91,10 +108,12 @@ class NoteBookIndex (NodeIndex):
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
+    @write_locked
     def close(self):
         """Close connection to index"""
         if self.con is not None:
             try:
+                self._write_file_hashes()
                 self.con.commit()
                 self.con.close()
             except:
@@ -103,6 +122,7 @@ class NoteBookIndex (NodeIndex):
             self.con = None
             self.cur = None
 
+    @write_locked
     def save(self):
         """Save index"""
         try:
@@ -110,6 +130,7 @@ class NoteBookIndex (NodeIndex):
             self.con.execute(
                 """UPDATE NodeGraph SET mtime = ? WHERE nodeid = ?;""",
                 (mtime, self._nconn.get_rootid()))
+            self._write_file_hashes()
             try:
                 self.con.commit()
             except:
@@ -117,6 +138,7 @@ class NoteBookIndex (NodeIndex):
         except Exception as e:
             self._on_corrupt(e, sys.exc_info()[2])
 
+    @write_locked
     def clear(self):
         """Erases database file and reinitializes"""
 
@@ -144,6 +166,7 @@ class NoteBookIndex (NodeIndex):
         self.con.execute("INSERT INTO Version VALUES (?, datetime('now'));",
                          (version,))
 
+    @write_locked
     def init_index(self, auto_clear=True):
         """Initialize the tables in the index if they do not exist"""
         con = self.con
@@ -172,6 +195,16 @@ class NoteBookIndex (NodeIndex):
             con.execute("""CREATE INDEX IF NOT EXISTS IdxNodeGraphParentid
                            ON NodeGraph (parentid);""")
 
+            # init FileHashes table
+            con.execute("""CREATE TABLE IF NOT EXISTS FileHashes
+                           (nodeid TEXT,
+                            filename TEXT,
+                            size INTEGER,
+                            mtime FLOAT,
+                            hash TEXT,
+                            UNIQUE(nodeid, filename) ON CONFLICT REPLACE);
+                        """)
+
             # init attribute indexes
             self.init_attrs(self.cur)
 
@@ -220,6 +253,8 @@ class NoteBookIndex (NodeIndex):
         self.con.execute("DROP TABLE IF EXISTS NodeGraph")
         self.con.execute("DROP INDEX IF EXISTS IdxNodeGraphNodeid")
         self.con.execute("DROP INDEX IF EXISTS IdxNodeGraphParentid")
+        self.con.execute("DROP TABLE IF EXISTS FileHashes")
+        self._file_hashes.clear()
         self.drop_attrs(self.cur)
 
     def index_needed(self):
@@ -263,6 +298,7 @@ class NoteBookIndex (NodeIndex):
         # record index complete
         self._need_index = False
 
+    @write_locked
     def compact(self):
         """
         Try to compact the index by reclaiming space
@@ -271,17 +307,20 @@ class NoteBookIndex (NodeIndex):
         self.con.execute("VACUUM;")
         self.con.comment()
 
+    @read_locked
     def get_node_mtime(self, nodeid):
         """Get the last indexed mtime for a node"""
+        cur = self.con.cursor()
 
-        self.cur.execute("""SELECT mtime FROM NodeGraph
+        cur.execute("""SELECT mtime FROM NodeGraph
                              WHERE nodeid=?""", (nodeid,))
-        row = self.cur.fetchone()
+        row = cur.fetchone()
         if row:
             return row[0]
         else:
             return 0.0
 
+    @write_locked
     def set_node_mtime(self, nodeid, mtime=None, commit=False):
         """Set the last indexed mtime for a node"""
         if mtime is None:
@@ -297,6 +336,7 @@ class NoteBookIndex (NodeIndex):
         """Get last modification time of the index"""
         return os.stat(self._index_file).st_mtime
 
+    @write_locked
     def add_node(self, nodeid, parentid, basename, attr, mtime, commit=False):
         """Add a node to the index"""
         # TODO: remove single parent assumption
@@ -326,9 +366,14 @@ class NoteBookIndex (NodeIndex):
                                (nodeid, attr.get("title", "")))
             self._on_corrupt(e, sys.exc_info()[2])
 
+    @write_locked
     def remove_node(self, nodeid, commit=False):
         """Remove node from index using nodeid"""
 
+        for key in list(self._file_hashes):
+            if key[0] == nodeid:
+                del self._file_hashes[key]
+
         if self.con is None:
             return
 
@@ -336,6 +381,8 @@ class NoteBookIndex (NodeIndex):
             # delete node
             self.cur.execute(
                 "DELETE FROM NodeGraph WHERE nodeid=?", (nodeid,))
+            self.cur.execute(
+                "DELETE FROM FileHashes WHERE nodeid=?", (nodeid,))
 
             self.remove_node_attr(self.cur, nodeid)
 
@@ -345,11 +392,87 @@ class NoteBookIndex (NodeIndex):
         except sqlite.DatabaseError as e:
             self._on_corrupt(e, sys.exc_info()[2])
 
+    #-------------------------
+    # file hashes
+
+    @read_locked
+    def get_file_hash(self, nodeid, filename, size, mtime):
+        """Returns the stored hash of a file with (size, mtime) or None"""
+        row = self._file_hashes.get((nodeid, filename))
+        if row is None and self.con is not None:
+            try:
+                row = self.con.execute(
+                    """SELECT nodeid, filename, size, mtime, hash
+                       FROM FileHashes WHERE nodeid=? AND filename=?""",
+                    (nodeid, filename)).fetchone()
+            except sqlite.DatabaseError as e:
+                self._on_file_hash_error(e)
+                return None
+        if row and (row[2], row[3]) == (size, mtime):
+            return row[4]
+        return None
+
+    @write_locked
+    def set_file_hash(self, nodeid, filename, size, mtime, filehash):
+        """
+        Store the hash of a file with (size, mtime)
+
+        Hashes are written in batches and committed by save().
+        """
+        self._file_hashes[(nodeid, filename)] = (
+            nodeid, filename, size, mtime, filehash)
+        if len(self._file_hashes) >= FILE_HASH_BATCH:
+            self._write_file_hashes()
+
+    @write_locked
+    def remove_file_hash(self, nodeid, filename):
+        """Remove the stored hashes of a file or directory"""
+        for key in list(self._file_hashes):
+            if key[0] == nodeid and (key[1] == filename or (
+                    connlib.is_dir(filename) and
+                    key[1].startswith(filename))):
+                del self._file_hashes[key]
+
+        if self.con is None:
+            return
+        try:
+            if connlib.is_dir(filename):
+                self.cur.execute(
+                    """DELETE FROM FileHashes
+                       WHERE nodeid=? AND substr(filename, 1, ?)=?""",
+                    (nodeid, len(filename), filename))
+            else:
+                self.cur.execute(
+                    "DELETE FROM FileHashes WHERE nodeid=? AND filename=?",
+                    (nodeid, filename))
+        except sqlite.DatabaseError as e:
+            self._on_file_hash_error(e)
+
+    def _write_file_hashes(self):
+        """Write buffered file hashes (without committing)"""
+        if not self._file_hashes or self.con is None:
+            return
+        rows = list(self._file_hashes.values())
+        self._file_hashes.clear()
+        try:
+            self.cur.executemany(
+                "INSERT INTO FileHashes VALUES (?, ?, ?, ?, ?)", rows)
+        except sqlite.DatabaseError as e:
+            self._on_file_hash_error(e)
+
+    def _on_file_hash_error(self, error):
+        # Stored hashes are only a cache, so they are skipped while
+        # another connection holds the index.
+        if "database is locked" not in str(error):
+            self._on_corrupt(error, sys.exc_info()[2])
+
     #-------------------------
     # queries
 
+    @read_locked
     def get_node_path(self, nodeid):
         """Get node path for a nodeid"""
+        cur = self.con.cursor()
 
         # TODO: handle multiple parents
 
@@ -362,10 +485,10 @@ class NoteBookIndex (NodeIndex):
                 # continue to walk up parent
                 path.append(nodeid)
 
-                self.cur.execute("""SELECT nodeid, parentid, basename
+                cur.execute("""SELECT nodeid, parentid, basename
                                 FROM NodeGraph
                                 WHERE nodeid=?""", (nodeid,))
-                row = self.cur.fetchone()
+                row = cur.fetchone()
 
                 # nodeid is not index
                 if row is None:
@@ -388,8 +511,10 @@ class NoteBookIndex (NodeIndex):
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
+    @read_locked
     def get_node_filepath(self, nodeid):
         """Get node path for a nodeid"""
+        cur = self.con.cursor()
 
         # TODO: handle multiple parents
 
@@ -401,10 +526,10 @@ class NoteBookIndex (NodeIndex):
             while parentid != self._uniroot:
                 # continue to walk up parent
 
-                self.cur.execute("""SELECT nodeid, parentid, basename
+                cur.execute("""SELECT nodeid, parentid, basename
                                 FROM NodeGraph
                                 WHERE nodeid=?""", (nodeid,))
-                row = self.cur.fetchone()
+                row = cur.fetchone()
 
                 # nodeid is not index
                 if row is None:
@@ -429,16 +554,18 @@ class NoteBookIndex (NodeIndex):
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
+    @read_locked
     def get_node(self, nodeid):
         """Get node data for a nodeid"""
+        cur = self.con.cursor()
 
         # TODO: handle multiple parents
 
         try:
-            self.cur.execute("""SELECT nodeid, parentid, basename, mtime
+            cur.execute("""SELECT nodeid, parentid, basename, mtime
                                 FROM NodeGraph
                                 WHERE nodeid=?""", (nodeid,))
-            row = self.cur.fetchone()
+            row = cur.fetchone()
 
             # nodeid is not index
             if row is None:
@@ -453,48 +580,110 @@ class NoteBookIndex (NodeIndex):
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
+    @read_locked
     def get_attr(self, nodeid, attr):
         """Return a nodes's attribute value"""
-        return self.get_node_attr(self.cur, nodeid, attr)
+        cur = self.con.cursor()
+        return self.get_node_attr(cur, nodeid, attr)
 
+    @read_locked
     def has_node(self, nodeid):
         """Returns True if index has node"""
-        self.cur.execute("""SELECT nodeid, parentid, basename, mtime
+        cur = self.con.cursor()
+        cur.execute("""SELECT nodeid, parentid, basename, mtime
                              FROM NodeGraph
                              WHERE nodeid=?""", (nodeid,))
-        return self.cur.fetchone() is not None
+        return cur.fetchone() is not None
 
+    @read_locked
     def list_children(self, nodeid):
         """List children indexed for node"""
+        cur = self.con.cursor()
 
         try:
-            self.cur.execute("""SELECT nodeid, basename
+            cur.execute("""SELECT nodeid, basename
                                 FROM NodeGraph
                                 WHERE parentid=?""", (nodeid,))
-            return list(self.cur.fetchall())
+            return list(cur.fetchall())
 
         except sqlite.DatabaseError as e:
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
+    @read_locked
     def has_children(self, nodeid):
         """Returns True if node has children"""
+        cur = self.con.cursor()
 
         try:
-            self.cur.execute("""SELECT nodeid
+            cur.execute("""SELECT nodeid
                                 FROM NodeGraph
                                 WHERE parentid=?""", (nodeid,))
-            return self.cur.fetchone() is not None
+            return cur.fetchone() is not None
+
+        except sqlite.DatabaseError as e:
+            self._on_corrupt(e, sys.exc_info()[2])
+            raise
+
+    @read_locked
+    def get_node_tree(self, nodeid, depth=None):
+        """
+        Returns rows for the tree under a node from a single query
+
+        Rows are unordered; see connlib.make_tree_row() for their format.
+        Attrs that are not indexed are returned as None.
+        """
+        cur = self.con.cursor()
+
+        # join the indexed attrs that the rows report
+        columns = []
+        joins = []
+        for name in ("title", "content_type", "order"):
+            attrindex = self.get_attr_index(name)
+            if attrindex:
+                table = attrindex.get_table_name()
+                columns.append("%s.value" % table)
+                joins.append("LEFT JOIN %s ON %s.nodeid = tree.nodeid" %
+                             (table, table))
+            else:
+                columns.append("NULL")
+
+        if depth is None:
+            depth = sys.maxsize
+
+        try:
+            cur.execute("""WITH RECURSIVE tree(nodeid, parentid, depth) AS (
+                               SELECT nodeid, parentid, 0
+                               FROM NodeGraph WHERE nodeid=?
+                             UNION ALL
+                               SELECT NodeGraph.nodeid, NodeGraph.parentid,
+                                      tree.depth + 1
+                               FROM NodeGraph
+                               JOIN tree ON NodeGraph.parentid = tree.nodeid
+                               WHERE tree.depth < ?)
+                           SELECT tree.nodeid, tree.parentid, tree.depth,
+                                  %s,
+                                  EXISTS (SELECT 1 FROM NodeGraph AS child
+                                          WHERE child.parentid = tree.nodeid)
+                           FROM tree %s""" % (", ".join(columns),
+                                              " ".join(joins)),
+                        (nodeid, depth))
+            return [connlib.make_tree_row(
+                row[0], row[1] if row[1] != self._uniroot else None, row[2],
+                {"title": row[3], "content_type": row[4], "order": row[5]},
+                bool(row[6])) for row in cur.fetchall()]
 
         except sqlite.DatabaseError as e:
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
+    @read_locked
     def search_titles(self, title):
         """Search node titles"""
+        cur = self.con.cursor()
 
         try:
-            return self.search_node_titles(self.cur, title)
+            return self.search_node_titles(cur, title)
         except sqlite.DatabaseError as e:
             self._on_corrupt(e, sys.exc_info()[2])
             raise
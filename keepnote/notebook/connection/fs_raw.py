@@ -26,21 +26,25 @@
 #
 
 # python imports
+import json
 import logging
 import os
 import shutil
 import re
+import threading
 import uuid
 
 # keepnote imports
 from keepnote import sqlitedict
 from keepnote import trans
+from keepnote.notebook.connection import ConnectionError
 from keepnote.notebook.connection import NodeExists
 from keepnote.notebook.connection import NoteBookConnection
 from keepnote.notebook.connection import UnknownNode
 from keepnote.notebook.connection.fs import FileFS
 from keepnote.notebook.connection.fs import read_attr
 from keepnote.notebook.connection.fs import write_attr
+from keepnote.notebook.connection.fs.file import get_node_filename
 
 _ = trans.translate
 
@@ -56,10 +60,71 @@ XML_HEADER = """\
 NODE_META_FILE = "node.xml"
 NOTEBOOK_META_DIR = "__NOTEBOOK__"
 NODEDIR = "nodes"
+LAYOUT_FILE = "00_layout.json"
+DEFAULT_FANOUT = (2,)
+SHARD_DIR_PREFIX = "00_fanout_"
 MAX_LEN_NODE_FILENAME = 40
 NULL = object()
 
 
+def parse_fanout(text):
+    """Parse a fan-out such as '2/2' into a tuple of prefix lengths"""
+    try:
+        fanout = tuple(int(x) for x in text.split("/"))
+    except ValueError:
+        raise ConnectionError("invalid fan-out '%s'" % text)
+    if not fanout or min(fanout) < 1:
+        raise ConnectionError("invalid fan-out '%s'" % text)
+    return fanout
+
+
+def format_fanout(fanout):
+    return "/".join(str(x) for x in fanout)
+
+
+def read_layout(rootpath):
+    """Returns the stored layout of a node store or None"""
+    filename = os.path.join(rootpath, LAYOUT_FILE)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as infile:
+        layout = json.load(infile)
+    layout["fanout"] = tuple(layout["fanout"])
+    if layout.get("old_fanout"):
+        layout["old_fanout"] = tuple(layout["old_fanout"])
+    return layout
+
+
+def write_layout(rootpath, fanout, old_fanout=None):
+    """Store the layout of a node store"""
+    layout = {"fanout": list(fanout)}
+    if old_fanout:
+        layout["old_fanout"] = list(old_fanout)
+    filename = os.path.join(rootpath, LAYOUT_FILE)
+    tmpfile = filename + ".tmp"
+    with open(tmpfile, "w") as out:
+        json.dump(layout, out)
+    os.replace(tmpfile, filename)
+
+
+def split_nodeid(nodeid, fanout):
+    """
+    Split a nodeid into its prefix directories and remainder
+
+    Returns None if the nodeid is too short for the fan-out or a part
+    would be a special directory name.
+    """
+    parts = []
+    i = 0
+    for size in fanout:
+        parts.append(nodeid[i:i+size])
+        i += size
+    parts.append(nodeid[i:])
+    if len(nodeid) <= i or any(part in ('.', '..') for part in parts):
+        return None
+    return parts
+
+
 class NodeFSSimple(object):
     """
     Stores node directories in a directory structure organized by nodeid.
@@ -74,57 +139,119 @@ class NodeFSSimple(object):
         a-z 0-9 _ - . , <double quote> <single quote> <space>
       Uppercase is not allowed because some filesystems ignore case.
     - nodeids cannot be '??..' or '??.'
+
+    Node directories fan out over one directory level per entry of
+    'fanout', e.g. (2, 2) stores 'abcdef' in '00_fanout_2_2/ab/cd/ef'.
+    The fan-out of an existing store is kept in its layout file and can
+    be changed with reshard().
     """
 
     VALID_REGEX = re.compile(r'^[a-z0-9_\-., "\']+$')
 
-    def __init__(self, rootpath):
+    def __init__(self, rootpath, fanout=None):
         self._rootpath = str(rootpath)
-        self._fansize = 2
+        self._lock = threading.RLock()
+        self._old_fanout = None
+
+        layout = read_layout(self._rootpath)
+        if layout:
+            if fanout and tuple(fanout) != layout["fanout"]:
+                raise ConnectionError(
+                    "node store uses fan-out %s, use reshard() to change it"
+                    % format_fanout(layout["fanout"]))
+            self._set_fanout(layout["fanout"])
+            self._old_fanout = layout.get("old_fanout")
+        elif fanout and tuple(fanout) != DEFAULT_FANOUT:
+            # Stores without a layout file use the default fan-out.
+            if self._has_entries():
+                raise ConnectionError(
+                    "node store uses fan-out %s, use reshard() to change it"
+                    % format_fanout(DEFAULT_FANOUT))
+            if not os.path.exists(self._rootpath):
+                os.makedirs(self._rootpath)
+            write_layout(self._rootpath, fanout)
+            self._set_fanout(fanout)
+        else:
+            self._set_fanout(DEFAULT_FANOUT)
 
-    def _is_valid(self, nodeid):
-        """Return True if nodeid requires storing in others directory."""
-        return not (
-            # Contains invalid characters
-            not re.match(self.VALID_REGEX, nodeid) or
+    def _set_fanout(self, fanout):
+        self._fanout = tuple(fanout)
+        self._fansize = sum(self._fanout)
 
-            # Less than or equal to fansize
-            len(nodeid) <= self._fansize or
+    def _has_entries(self):
+        if not os.path.exists(self._rootpath):
+            return False
+        with os.scandir(self._rootpath) as entries:
+            for entry in entries:
+                return True
+        return False
+
+    def get_fanout(self):
+        """Returns the fan-out of the node store"""
+        return self._fanout
+
+    def _get_shard_root(self, fanout):
+        """
+        Return the directory holding the prefix directories of a fan-out
+
+        Each fan-out has its own directory so that the layouts never
+        overlap while nodes are re-sharded.  The default fan-out uses the
+        store root for compatibility.
+        """
+        if tuple(fanout) == DEFAULT_FANOUT:
+            return self._rootpath
+        return os.path.join(self._rootpath,
+                            SHARD_DIR_PREFIX + format_fanout(fanout)
+                            .replace("/", "_"))
+
+    def _is_valid(self, nodeid, fanout):
+        """Return True if nodeid can be stored."""
+        return (re.match(self.VALID_REGEX, nodeid) is not None and
+                split_nodeid(nodeid, fanout) is not None)
+
+    def _get_nodedir(self, nodeid, fanout):
+        """Return directory of nodeid for a given fan-out."""
+        if len(nodeid) <= sum(fanout) or len(nodeid) > 255:
+            raise Exception('Nodeid has invalid length: "%s"' % nodeid)
 
-            # Greater than fansize and ends with dots
-            (len(nodeid) == self._fansize + 1 and nodeid.endswith('.')) or
+        if not self._is_valid(nodeid, fanout):
+            raise Exception('Nodeid is not simple: "%s"' % nodeid)
 
-            (len(nodeid) == self._fansize + 2 and nodeid.endswith('..')))
+        return os.path.join(self._get_shard_root(fanout),
+                            *split_nodeid(nodeid, fanout))
 
     def get_nodedir(self, nodeid):
         """Return directory of nodeid."""
         if nodeid is None:
             return self._rootpath
 
-        if len(nodeid) <= self._fansize or len(nodeid) > 255:
-            raise Exception('Nodeid has invalid length: "%s"' % nodeid)
-
-        if not self._is_valid(nodeid):
-            raise Exception('Nodeid is not simple: "%s"' % nodeid)
-
-        return os.path.join(self._rootpath, self._othersdir, nodeid)
+        nodedir = self._get_nodedir(nodeid, self._fanout)
+        if self._old_fanout and not os.path.exists(nodedir):
+            # A re-shard is in progress and the node may not have moved yet.
+            with self._lock:
+                olddir = self._get_nodedir(nodeid, self._old_fanout)
+                if os.path.exists(olddir):
+                    return olddir
+        return nodedir
 
     def create_nodedir(self, nodeid, force=False):
         """Create directory of nodeid."""
-        nodedir = self.get_nodedir(nodeid)
-        if not os.path.exists(nodedir):
-            os.makedirs(nodedir)
-        else:
-            raise NodeExists()
+        with self._lock:
+            nodedir = self.get_nodedir(nodeid)
+            if not os.path.exists(nodedir):
+                os.makedirs(nodedir)
+            else:
+                raise NodeExists()
         return nodedir
 
     def delete_nodedir(self, nodeid, force=False):
         """Delete directory of nodeid."""
-        nodedir = self.get_nodedir(nodeid)
-        if os.path.exists(nodedir):
-            shutil.rmtree(nodedir)
-        else:
-            raise UnknownNode()
+        with self._lock:
+            nodedir = self.get_nodedir(nodeid)
+            if os.path.exists(nodedir):
+                shutil.rmtree(nodedir)
+            else:
+                raise UnknownNode()
 
     def has_nodedir(self, nodeid):
         """Returns True if nodeid exists."""
@@ -135,16 +262,109 @@ class NodeFSSimple(object):
         """Cease any more interaction with the filesystem."""
         pass
 
+    def _iter_fanout_nodeids(self, fanout):
+        """Iterates through the nodeids stored with a given fan-out."""
+        def walk(path, prefix, fanout):
+            try:
+                entries = os.scandir(path)
+            except OSError:
+                return
+            with entries:
+                for entry in entries:
+                    if not fanout:
+                        yield prefix + entry.name
+                    elif len(entry.name) == fanout[0] and entry.is_dir():
+                        # This is a nodeid prefix.
+                        yield from walk(entry.path, prefix + entry.name,
+                                        fanout[1:])
+
+        return walk(self._get_shard_root(fanout), "", fanout)
+
+    def _iter_stored_nodeids(self):
+        """Iterates through all stored nodeids."""
+        return self._iter_fanout_nodeids(self._fanout)
+
     def iter_nodeids(self):
         """Iterates through all stored nodeids."""
-        # List nodeid in general pool.
-        for filename in os.listdir(self._rootpath):
-            if len(filename) == self._fansize:
-                # This is a nodeid prefix.
-                path = os.path.join(self._rootpath, filename)
-                prefix = filename
-                for filename in os.listdir(path):
-                    yield prefix + filename
+        if not self._old_fanout:
+            for nodeid in self._iter_stored_nodeids():
+                yield nodeid
+            return
+
+        # Nodes may move between layouts while a re-shard is in progress.
+        seen = set()
+        for fanout in (self._old_fanout, self._fanout):
+            for nodeid in self._iter_fanout_nodeids(fanout):
+                if nodeid not in seen:
+                    seen.add(nodeid)
+                    yield nodeid
+        for nodeid in self._iter_other_nodeids():
+            if nodeid not in seen:
+                yield nodeid
+
+    def _iter_other_nodeids(self):
+        return iter(())
+
+    #==========================
+    # re-sharding
+
+    def reshard(self, fanout, progress=None):
+        """
+        Move all node directories to a new fan-out
+
+        The store must not be used by any other connection or thread while
+        nodes are moved (e.g. run the "reshard" command on a closed
+        notebook), since node files are read and written outside of the
+        store lock.  Nodes are still found through both layouts, so an
+        interrupted re-shard leaves a usable store and is resumed by
+        calling reshard() again with the same fan-out.  progress(nmoved)
+        is called periodically.  Returns the number of node directories
+        moved.
+        """
+        fanout = tuple(fanout)
+        with self._lock:
+            old_fanout = self._old_fanout or self._fanout
+            if fanout == old_fanout and not self._old_fanout:
+                return 0
+            write_layout(self._rootpath, fanout, old_fanout)
+            self._old_fanout = old_fanout
+            self._set_fanout(fanout)
+
+        nmoved = 0
+        for nodeid in list(self._iter_old_nodeids(old_fanout)):
+            with self._lock:
+                olddir = self._get_nodedir(nodeid, old_fanout)
+                newdir = self._get_nodedir(nodeid, fanout)
+                if olddir == newdir or not os.path.exists(olddir):
+                    continue
+                parent = os.path.dirname(newdir)
+                if not os.path.exists(parent):
+                    os.makedirs(parent)
+                os.rename(olddir, newdir)
+                self._remove_empty_dirs(os.path.dirname(olddir))
+            nmoved += 1
+            if progress and nmoved % 1000 == 0:
+                progress(nmoved)
+
+        with self._lock:
+            write_layout(self._rootpath, fanout)
+            self._old_fanout = None
+        if progress:
+            progress(nmoved)
+        return nmoved
+
+    def _iter_old_nodeids(self, fanout):
+        """Iterates through the nodeids stored with an old fan-out."""
+        return self._iter_fanout_nodeids(fanout)
+
+    def _remove_empty_dirs(self, path):
+        """Remove empty prefix directories up to the store root."""
+        while path != self._rootpath and path.startswith(self._rootpath):
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+            path = os.path.dirname(path)
 
 
 class NodeFSStandard(NodeFSSimple):
@@ -163,28 +383,18 @@ class NodeFSStandard(NodeFSSimple):
 
     BANNED_NODEIDS = ['.', '..']
 
-    def __init__(self, rootpath, others='00_extra'):
-        super(NodeFSStandard, self).__init__(rootpath)
+    def __init__(self, rootpath, others='00_extra', fanout=None):
+        super(NodeFSStandard, self).__init__(rootpath, fanout=fanout)
         self._othersdir = others
-        assert(len(self._othersdir) > self._fansize)
+        assert(len(self._othersdir) > max(self._fanout))
 
-    def _is_other(self, nodeid):
+    def _is_other(self, nodeid, fanout):
         """Return True if nodeid requires storing in others directory."""
+        # Nodeids that are too short or would make special directory names.
+        return split_nodeid(nodeid, fanout) is None
 
-        return (
-            # Less than or equal to fansize
-            len(nodeid) <= self._fansize or
-
-            # Greater than fansize and ends with dots
-            (len(nodeid) == self._fansize + 1 and nodeid.endswith('.')) or
-
-            (len(nodeid) == self._fansize + 2 and nodeid.endswith('..')))
-
-    def get_nodedir(self, nodeid):
-        """Return directory of nodeid."""
-        if nodeid is None:
-            return self._rootpath
-
+    def _get_nodedir(self, nodeid, fanout):
+        """Return directory of nodeid for a given fan-out."""
         if len(nodeid) < 1 or len(nodeid) > 255:
             raise Exception('Nodeid has invalid length: "%s"' % nodeid)
 
@@ -196,24 +406,39 @@ class NodeFSStandard(NodeFSSimple):
             raise Exception(
                 'Nodeid contains invalid characters: "%s"' % nodeid)
 
-        if not self._is_other(nodeid):
-            return os.path.join(self._rootpath,
-                                nodeid[:self._fansize],
-                                nodeid[self._fansize:])
+        if not self._is_other(nodeid, fanout):
+            return os.path.join(self._get_shard_root(fanout),
+                                *split_nodeid(nodeid, fanout))
         else:
             # Shorter nodeids go directly in the otherdir.
             return os.path.join(self._rootpath, self._othersdir, nodeid)
 
-    def iter_nodeids(self):
+    def _iter_other_nodeids(self):
+        """Iterates through the nodeids in the others directory."""
+        otherspath = os.path.join(self._rootpath, self._othersdir)
+        try:
+            entries = os.scandir(otherspath)
+        except OSError:
+            return
+        with entries:
+            for entry in entries:
+                yield entry.name
+
+    def _iter_stored_nodeids(self):
         """Iterates through all stored nodeids."""
-        for nodeid in super(NodeFSStandard, self).iter_nodeids():
+        for nodeid in super(NodeFSStandard, self)._iter_stored_nodeids():
             yield nodeid
 
         # List other nodeids.
-        otherspath = os.path.join(self._rootpath, self._othersdir)
-        if os.path.exists(otherspath):
-            for filename in os.listdir(otherspath):
-                yield filename
+        for nodeid in self._iter_other_nodeids():
+            yield nodeid
+
+    def _iter_old_nodeids(self, fanout):
+        """Iterates through the nodeids stored with an old fan-out."""
+        for nodeid in self._iter_fanout_nodeids(fanout):
+            yield nodeid
+        for nodeid in self._iter_other_nodeids():
+            yield nodeid
 
 
 class NodeFS(NodeFSStandard):
@@ -227,8 +452,8 @@ class NodeFS(NodeFSStandard):
 
     def __init__(self, rootpath, others='00_extra',
                  index='00_index.db', tablename='nodes',
-                 alt_tablename='alt_nodes'):
-        super(NodeFS, self).__init__(rootpath, others=others)
+                 alt_tablename='alt_nodes', fanout=None):
+        super(NodeFS, self).__init__(rootpath, others=others, fanout=fanout)
         self._indexfile = os.path.join(self._rootpath, index)
         self._index = sqlitedict.open(self._indexfile, tablename,
                                       flag='c', autocommit=True)
@@ -258,29 +483,24 @@ class NodeFS(NodeFSStandard):
             self._index_alt.commit()
         return alt_nodeid
 
-    def get_nodedir(self, nodeid):
-        """Return directory of nodeid."""
-        if nodeid is None:
-            return self._rootpath
-
+    def _get_nodedir(self, nodeid, fanout):
+        """Return directory of nodeid for a given fan-out."""
         if nodeid == "":
             raise Exception('Nodeid cannot not be zero-length.')
 
         if self._is_nonstandard(nodeid):
             # Use alt_nodeid to lookup in general node pool.
             alt_nodeid = self._get_alt_nodeid(nodeid)
-            return os.path.join(self._rootpath,
-                                alt_nodeid[:self._fansize],
-                                alt_nodeid[self._fansize:])
+            return os.path.join(self._get_shard_root(fanout),
+                                *split_nodeid(alt_nodeid, fanout))
 
-        elif self._is_other(nodeid):
+        elif self._is_other(nodeid, fanout):
             # Shorter nodeids go directly in the otherdir.
             return os.path.join(self._rootpath, self._othersdir, nodeid)
         else:
             # Simple nodeids.
-            return os.path.join(self._rootpath,
-                                nodeid[:self._fansize],
-                                nodeid[self._fansize:])
+            return os.path.join(self._get_shard_root(fanout),
+                                *split_nodeid(nodeid, fanout))
 
     def delete_nodedir(self, nodeid):
         """Delete directory of nodeid."""
@@ -308,9 +528,11 @@ class NodeFS(NodeFSStandard):
 
     def iter_nodeids(self):
         """Iterates through all stored nodeids."""
+        # Nonstandard nodeids are rare, so their alternates fit in memory.
+        alt_nodeids = set(self._index_alt.keys())
         for nodeid in super(NodeFS, self).iter_nodeids():
             # Do not yield alternate nodeids.
-            if nodeid not in self._index_alt:
+            if nodeid not in alt_nodeids:
                 yield nodeid
 
         # Iterate through nonstandard nodeids.
@@ -323,10 +545,11 @@ class NoteBookConnectionFSRaw (NoteBookConnection):
     Provides a NoteBookConnection using NodeFS as a backing.
     """
 
-    def __init__(self):
+    def __init__(self, fanout=None):
         self._rootid = None
 
         self._rootpath = None
+        self._fanout = fanout
         self._nodefs = None
         self._filefs = FileFS(self._get_node_path)
 
@@ -347,12 +570,24 @@ class NoteBookConnectionFSRaw (NoteBookConnection):
         self._rootpath = url
         if not os.path.exists(url):
             self._create_rootdir(url)
-        self._nodefs = NodeFS(self._rootpath)
+        self._nodefs = NodeFS(self._rootpath, fanout=self._fanout)
 
     def close(self):
         """Close connection."""
         self._nodefs.close()
 
+    def get_fanout(self):
+        """Returns the fan-out of node directories"""
+        return self._nodefs.get_fanout()
+
+    def reshard(self, fanout, progress=None):
+        """
+        Move node directories to a new fan-out, e.g. (2, 2)
+
+        The notebook must not be in use elsewhere while this runs.
+        """
+        return self._nodefs.reshard(fanout, progress=progress)
+
     def save(self):
         """Save any unsynced state."""
         pass
@@ -422,6 +657,11 @@ class NoteBookConnectionFSRaw (NoteBookConnection):
         """Return True if file exists."""
         return self._filefs.has_file(nodeid, filename, _path)
 
+    def get_file(self, nodeid, filename, _path=None):
+        """Return the local path of a node file."""
+        path = self._get_node_path(nodeid) if _path is None else _path
+        return get_node_filename(path, filename)
+
     #---------------------------------
     # indexing
 
@@ -437,6 +677,7 @@ class NoteBookConnectionFSRaw (NoteBookConnection):
         # ["has_fulltext"]
         # ["node_path", nodeid]
         # ["get_attr", nodeid, key]
+        # ["node_manifest", nodeid]
 
         if query[0] == "index_attr":
             return
@@ -475,6 +716,9 @@ class NoteBookConnectionFSRaw (NoteBookConnection):
         elif query[0] == "get_attr":
             return self.read_node(query[1])[query[2]]
 
+        elif query[0] == "node_manifest":
+            return self.get_node_manifest(query[1])
+
         # FS-specific
         elif query[0] == "init":
             return
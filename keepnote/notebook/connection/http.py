@@ -26,10 +26,14 @@
 #
 
 # python imports
+import codecs
+from collections import OrderedDict
 from collections import defaultdict
-import contextlib
 import http.client
-import json
+import mimetypes
+import tempfile
+import threading
+import time
 import urllib.request, urllib.parse, urllib.error
 import urllib.parse
 
@@ -37,12 +41,42 @@ import urllib.parse
 from keepnote import plist
 import keepnote.notebook.connection as connlib
 from keepnote.notebook.connection import NoteBookConnection
+from keepnote.notebook.connection import http_encoding
 
 
 XML_HEADER = """\
 <?xml version="1.0" encoding="UTF-8"?>
 """
 
+# connection pool defaults
+DEFAULT_POOL_SIZE = 4
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.1
+
+# methods that are safe to retry
+IDEMPOTENT_METHODS = set(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+
+# response bodies smaller than this are drained so the connection is reused
+MAX_DRAIN_SIZE = 1024*64
+
+# file uploads larger than this are spooled to disk
+MAX_SPOOL_SIZE = 1024*1024
+
+# size of raw chunks read when decompressing a streamed response
+DECOMPRESS_CHUNK_SIZE = 64*1024
+
+# seconds a change feed request waits on the server for new changes
+DEFAULT_POLL_TIMEOUT = 20.0
+
+# seconds between change feed requests to servers that cannot long-poll
+POLL_INTERVAL = 1.0
+
+# response cache limits
+DEFAULT_CACHE_SIZE = 1000
+DEFAULT_CACHE_BYTES = 16*1024*1024
+MAX_CACHE_FILE_SIZE = 256*1024
+
 
 #=============================================================================
 # Node URL scheme
@@ -96,84 +130,601 @@ def format_node_url(host, prefix, nodeid, filename=None, port=80):
                                format_node_path(prefix, nodeid, filename))
 
 
+#=============================================================================
+# HTTP connection pool
+
+
+class BufferedResponse (object):
+    """An HTTP response whose body has already been read"""
+
+    def __init__(self, response, data, status=None, headers=None):
+        self.status = response.status if status is None else status
+        self.reason = response.reason if response else "OK"
+        self.headers = response.headers if headers is None else headers
+        self._data = data
+        self._pos = 0
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._data) - self._pos
+        data = self._data[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+class PooledResponse (object):
+    """
+    A streaming HTTP response that holds a pooled connection
+
+    The connection is returned to the pool once the response is closed.
+    """
+
+    def __init__(self, pool, conn, response):
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+
+        # decompress encoded bodies as they are read
+        encoding = response.getheader("Content-Encoding")
+        self._decompressor = (http_encoding.Decompressor(encoding)
+                              if encoding else None)
+        self._buffer = b""
+        self._eof = False
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, size=-1):
+        if self._decompressor is None:
+            if size is None or size < 0:
+                return self._response.read()
+            return self._response.read(size)
+
+        while not self._eof and (size is None or size < 0 or
+                                 len(self._buffer) < size):
+            data = self._response.read(DECOMPRESS_CHUNK_SIZE)
+            if data:
+                self._buffer += self._decompressor.decompress(data)
+            else:
+                self._buffer += self._decompressor.flush()
+                self._eof = True
+
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn, self._response)
+            self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+def is_stale_error(error, sent):
+    """
+    Returns True if 'error' shows that a keep-alive connection was closed
+    by the server before it read the request
+
+    'sent' is True if the request was completely sent.
+    """
+    if sent:
+        return isinstance(error, http.client.RemoteDisconnected)
+    return isinstance(error, (BrokenPipeError, ConnectionResetError))
+
+
+class HttpConnectionPool (object):
+    """
+    A thread-safe pool of keep-alive HTTP connections to one host
+
+    Each request checks out a connection for the calling thread and
+    returns it to the pool when the response has been read.  Idempotent
+    requests are retried with exponential backoff.  Other requests are
+    only sent again, once, when a reused connection turns out to have been
+    closed by the server.  If 'compress' is True, compressed responses are
+    requested and transparently decoded.
+    """
+
+    def __init__(self, netloc, maxsize=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, compress=True):
+        self._netloc = netloc
+        self._compress = compress
+        self._maxsize = maxsize
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._idle = []
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "hits": 0,
+            "new_connections": 0,
+            "retries": 0,
+        }
+
+    def _incr(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def get_stats(self):
+        """Returns a dict of pool statistics"""
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle))
+
+    def checkout(self):
+        """
+        Returns (conn, reused) for an idle or new connection
+        """
+        with self._lock:
+            if self._idle:
+                self._stats["hits"] += 1
+                return self._idle.pop(), True
+            self._stats["new_connections"] += 1
+        return (http.client.HTTPConnection(self._netloc,
+                                           timeout=self._timeout), False)
+
+    def release(self, conn, response=None):
+        """Return a connection to the pool"""
+        if response is not None and not response.isclosed():
+            # drain small bodies so the connection can be reused
+            if (response.length is not None and
+                    response.length <= MAX_DRAIN_SIZE):
+                response.read()
+            else:
+                conn.close()
+                return
+
+        if response is not None and response.will_close:
+            conn.close()
+            return
+
+        with self._lock:
+            if len(self._idle) < self._maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn in idle:
+            conn.close()
+
+    def request(self, method, url, body=None, headers={}, stream=False):
+        """
+        Perform a request and return its response
+
+        If 'stream' is True, the response holds its connection until it
+        is closed.  Otherwise, the body is read and the connection is
+        immediately returned to the pool.
+        """
+        self._incr("requests")
+        attempt = 0
+        body_pos = body.tell() if hasattr(body, "seek") else None
+        if self._compress and "Accept-Encoding" not in headers:
+            headers = dict(headers)
+            headers["Accept-Encoding"] = (
+                http_encoding.format_accept_encoding())
+
+        resent = False
+        while True:
+            conn, reused = self.checkout()
+            sent = False
+            try:
+                if body_pos is not None:
+                    # rewind streamed bodies before each attempt
+                    body.seek(body_pos)
+                conn.request(method, url, body, headers)
+                sent = True
+                response = conn.getresponse()
+                if not stream:
+                    data = response.read()
+            except (http.client.HTTPException, OSError) as error:
+                conn.close()
+
+                if method not in IDEMPOTENT_METHODS:
+                    # The server may already have processed the request,
+                    # unless a reused connection was found closed before
+                    # the request was read.  That is retried once.
+                    if resent or not reused or not is_stale_error(error,
+                                                                  sent):
+                        raise
+                    resent = True
+                    self._incr("retries")
+                    continue
+
+                if attempt >= self._retries:
+                    raise
+                self._incr("retries")
+                if not reused:
+                    time.sleep(self._backoff * 2 ** attempt)
+                attempt += 1
+                continue
+
+            if stream:
+                return PooledResponse(self, conn, response)
+            else:
+                self.release(conn, response)
+                encoding = response.getheader("Content-Encoding")
+                if encoding:
+                    data = http_encoding.decompress(data, encoding)
+                return BufferedResponse(response, data)
+
+
+class HttpFile (object):
+    """
+    A writable node file that is uploaded when closed
+
+    Written data is spooled to a temporary file, so memory use is bounded
+    for large files.  The upload streams the spooled data with a
+    Content-Length header.
+    """
+
+    def __init__(self, on_close, codec=None):
+        self._spool = tempfile.SpooledTemporaryFile(max_size=MAX_SPOOL_SIZE)
+        self._on_close = on_close
+        self._codec = codec
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode(self._codec or "utf-8")
+        self._spool.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            size = self._spool.tell()
+            self._spool.seek(0)
+            self._on_close(self._spool, size)
+        finally:
+            self._spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
 #=============================================================================
 # NoteBook HTTP client
 
 class NoteBookConnectionHttp (NoteBookConnection):
+    """
+    A notebook connection to a notebook HTTP server
+
+    version -- attr encoding: 1 (plist), 2 (JSON) or 3 (msgpack, falling
+               back to JSON if msgpack is not available)
+    """
 
-    def __init__(self, version=2):
+    def __init__(self, version=2, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 cache_size=DEFAULT_CACHE_SIZE, compress=True):
         self._netloc = ""
         self._prefix = "/"
-        self._conn = None
+        self._pool = None
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._retries = retries
         self._title_cache = NodeTitleCache()
+        self._cache_size = cache_size
+        self._cache = HttpCache(cache_size)
+        self._compress = compress
+        self._server_encodings = set()
+
+        # change feed state
+        self._change_lock = threading.RLock()
+        self._change_logid = None
+        self._change_seq = 0
+        self._watcher = None
         self._version = version
+        self._url = None
 
     def connect(self, url):
+        self._url = url
         parts = urllib.parse.urlsplit(url)
 
         self._netloc = parts.netloc
         self._prefix = parts.path + 'nodes/'
         self._notebook_prefix = parts.path
-        self._conn = http.client.HTTPConnection(self._netloc)
+        self._pool = HttpConnectionPool(
+            self._netloc, maxsize=self._pool_size, timeout=self._timeout,
+            retries=self._retries, compress=self._compress)
         self._title_cache.clear()
-        #self._conn.set_debuglevel(1)
+        self._cache.clear()
+        self._server_encodings = set()
+        self._change_logid = None
+        self._change_seq = 0
 
     def close(self):
-        self._conn.close()
+        self.stop_watching()
+        self._pool.clear()
+        self._cache.clear()
+
+    def clone(self):
+        """Returns a new connection to the same notebook"""
+        conn = NoteBookConnectionHttp(
+            self._version, pool_size=self._pool_size, timeout=self._timeout,
+            retries=self._retries, cache_size=self._cache_size,
+            compress=self._compress)
+        conn.connect(self._url)
+        return conn
+
+    def get_pool_stats(self):
+        """Returns connection pool statistics for monitoring"""
+        return self._pool.get_stats()
+
+    def get_cache_stats(self):
+        """Returns response cache statistics for monitoring"""
+        return self._cache.get_stats()
 
     def save(self):
         # POST http://host/prefix/?save
 
         self._request(
             'POST', format_node_path(self._notebook_prefix) + "?save")
-        self._conn.getresponse()
         pass
 
-    def _request(self, action, url, body=None, headers={}):
+    def _request(self, action, url, body=None, headers={}, stream=False):
+        if self._version >= 3 and "Accept" not in headers:
+            headers = dict(headers)
+            headers["Accept"] = ", ".join(http_encoding.get_data_types())
+        result = self._pool.request(action, url, body, headers, stream=stream)
+
+        # The server advertises the encodings it accepts for request bodies.
+        if not self._server_encodings and self._compress:
+            self._server_encodings = http_encoding.parse_accept_encoding(
+                result.getheader("Accept-Encoding"))
+        return result
+
+    def _request_encoding(self):
+        """Returns the encoding to use for request bodies or None"""
+        if not self._compress:
+            return None
+        for encoding in http_encoding.get_encodings():
+            if encoding in self._server_encodings:
+                return encoding
+        return None
+
+    def _data_request(self, action, url, data):
+        """Perform a request whose body is encoded attr data"""
+        body, content_type = self.dumps_data(data)
+        headers = {"Content-Type": content_type}
+        encoding = self._request_encoding()
+        if encoding and len(body) >= http_encoding.MIN_COMPRESS_SIZE:
+            body = http_encoding.compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+        return self._request(action, url, body, headers)
+
+    def _file_request(self, url, filename, spool, size):
+        """Upload a spooled file, compressing it if worthwhile"""
+        headers = {}
+        encoding = self._request_encoding()
+        mime = mimetypes.guess_type(filename, strict=False)[0] or "text"
+        if (encoding and size >= http_encoding.MIN_COMPRESS_SIZE and
+                http_encoding.is_compressible(mime)):
+            compressed = tempfile.SpooledTemporaryFile(
+                max_size=MAX_SPOOL_SIZE)
+            compressor = http_encoding.Compressor(encoding)
+            while True:
+                data = spool.read(DECOMPRESS_CHUNK_SIZE)
+                if not data:
+                    break
+                compressed.write(compressor.compress(data))
+            compressed.write(compressor.flush())
+            size = compressed.tell()
+            compressed.seek(0)
+            spool = compressed
+            headers["Content-Encoding"] = encoding
+        headers["Content-Length"] = str(size)
+        try:
+            return self._request('POST', url, spool, headers)
+        finally:
+            if "Content-Encoding" in headers:
+                spool.close()
+
+    def _cached_get(self, url, stream=False):
+        """
+        GET a url, revalidating any cached copy with its ETag
+
+        Streamed responses are only cached when they are small.
+        """
+        entry = self._cache.get(url)
+        if entry and entry.trusted and self.is_watching():
+            # The change feed would have dropped this entry if it changed.
+            self._cache.add_hit()
+            return entry.get_response()
+
+        seq = self._change_seq
+        headers = {"If-None-Match": entry.etag} if entry else {}
+        result = self._request('GET', url, headers=headers, stream=stream)
+
+        if result.status == http.client.NOT_MODIFIED and entry:
+            result.close()
+            self._cache.add_hit()
+            entry.trusted = (seq == self._change_seq)
+            return entry.get_response()
+        self._cache.add_miss()
+
+        etag = result.getheader("ETag")
+        if result.status != http.client.OK or not etag:
+            self._cache.remove(url)
+            return result
+
+        if stream:
+            size = result.getheader("Content-Length")
+            if size is None or int(size) > MAX_CACHE_FILE_SIZE:
+                self._cache.remove(url)
+                return result
+            data = result.read()
+            result.close()
+            result = BufferedResponse(result, data)
+        else:
+            data = result.read()
+            result = BufferedResponse(result, data)
+        # Entries fetched while changes arrived may already be stale.
+        self._cache.put(url, CacheEntry(
+            etag, data, result.getheader("Content-Type"),
+            trusted=(seq == self._change_seq)))
+        return result
+
+    def _invalidate_node(self, nodeid):
+        """Drop cached responses for a node and its files"""
+        self._cache.remove_node(format_node_path(self._prefix, nodeid))
+
+    #===========================================
+    # change feed
+
+    def get_changes(self, since=0, timeout=0):
+        """
+        Returns notebook changes after sequence number 'since'
+
+        The server waits up to 'timeout' seconds for a change.
+        """
+        # GET /changes?since=N&timeout=T
+        url = (format_node_path(self._notebook_prefix) +
+               "changes?since=%d&timeout=%g" % (since, timeout))
+        result = self._request('GET', url)
+        if result.status != http.client.OK:
+            raise connlib.ConnectionError("cannot read changes")
         try:
-            return self._conn.request(action, url, body, headers)
-        except http.client.ImproperConnectionState:
-            # restart connection
-            self._conn = http.client.HTTPConnection(self._netloc)
-            return self._request(action, url, body, headers)
-
-    def load_data(self, stream):
-        if self._version == 2:
-            return json.loads(stream.read())
+            return self.load_data(result)
+        except Exception as e:
+            raise connlib.ConnectionError(
+                "unexpected response '%s'" % str(e), e)
+
+    def sync_changes(self, timeout=0):
+        """
+        Fetch new changes from the server and invalidate cached data
+
+        Returns the list of changes.
+        """
+        data = self.get_changes(self._change_seq, timeout)
+        self.apply_changes(data)
+        return data["changes"]
+
+    def apply_changes(self, data):
+        """Invalidate cached data for changes from the change feed"""
+        with self._change_lock:
+            if data["reset"] or data["logid"] != self._change_logid:
+                # Changes may have been missed, so start over.
+                self._cache.clear()
+                self._title_cache.clear()
+                self._title_cache.set_complete(False)
+            else:
+                updated = []
+                for change in data["changes"]:
+                    nodeid = change["nodeid"]
+                    self._invalidate_node(nodeid)
+                    for parentid in change.get("parentids") or []:
+                        self._invalidate_node(parentid)
+                    if change["type"] == "delete_node":
+                        self._title_cache.remove(nodeid)
+                    elif change["type"] != "file":
+                        updated.append(nodeid)
+
+                # Refresh titles of changed nodes in one request.
+                if updated and self._title_cache.is_complete():
+                    updated = list(set(updated))
+                    for nodeid, attr in zip(updated, self.read_nodes(updated)):
+                        if attr is None:
+                            self._title_cache.remove(nodeid)
+
+            self._change_logid = data["logid"]
+            self._change_seq = data["seq"]
+
+    def start_watching(self, timeout=DEFAULT_POLL_TIMEOUT):
+        """
+        Follow the server change feed in a background thread
+
+        While the feed is being followed, cached data is used without
+        revalidating it with the server.
+        """
+        if self._watcher is None:
+            self._watcher = ChangeWatcher(self, timeout)
+            self._watcher.start()
+
+    def stop_watching(self):
+        """Stop following the server change feed"""
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def is_watching(self):
+        """Returns True if the change feed is being followed"""
+        watcher = self._watcher
+        return watcher is not None and watcher.is_live()
+
+    def _get_data_type(self):
+        if self._version >= 3:
+            return http_encoding.get_data_types()[0]
+        return http_encoding.JSON_TYPE
+
+    def load_data(self, result):
+        if self._version >= 2:
+            return http_encoding.loads_data(
+                result.read(), result.getheader("Content-Type"))
         else:
-            return plist.load(stream)
+            return plist.load(result)
 
-    def loads_data(self, data):
-        if self._version == 2:
-            return json.loads(data)
+    def loads_data(self, data, content_type=None):
+        if self._version >= 2:
+            return http_encoding.loads_data(data, content_type)
         else:
             return plist.loads(data)
 
     def dumps_data(self, data):
-        if self._version == 2:
-            return json.dumps(data)
+        """Returns (body, content_type) for attr data"""
+        if self._version >= 2:
+            content_type = self._get_data_type()
+            return http_encoding.dumps_data(data, content_type), content_type
         else:
-            return plist.dumps(data)
+            return plist.dumps(data).encode("utf8"), "text/xml"
 
     #===========================================
 
     def create_node(self, nodeid, attr):
 
-        body_content = self.dumps_data(attr).encode("utf8")
-        self._request('POST', format_node_path(self._prefix, nodeid),
-                      body_content)
-        result = self._conn.getresponse()
+        result = self._data_request(
+            'POST', format_node_path(self._prefix, nodeid), attr)
         if result.status == http.client.FORBIDDEN:
             raise connlib.NodeExists()
         elif result.status != http.client.OK:
             raise connlib.ConnectionError("unexpected error")
 
+        self._invalidate_node(nodeid)
         self._title_cache.update_attr(attr)
 
     def read_node(self, nodeid):
 
-        self._request('GET', format_node_path(self._prefix, nodeid))
-        result = self._conn.getresponse()
+        result = self._cached_get(format_node_path(self._prefix, nodeid))
         if result.status == http.client.OK:
             try:
                 attr = self.load_data(result)
@@ -185,41 +736,61 @@ class NoteBookConnectionHttp (NoteBookConnection):
         else:
             raise connlib.UnknownNode(nodeid)
 
+    def read_nodes(self, nodeids):
+        """Read the attrs of several nodes in one request"""
+
+        # POST /nodes/?batch
+        nodeids = list(nodeids)
+        result = self._data_request(
+            'POST', format_node_path(self._prefix) + "?batch", nodeids)
+        if result.status == http.client.OK:
+            try:
+                attrs = self.load_data(result)["nodes"]
+            except Exception as e:
+                raise connlib.ConnectionError(
+                    "unexpected error '%s'" % str(e), e)
+            for attr in attrs:
+                if attr is not None:
+                    self._title_cache.update_attr(attr)
+            return attrs
+        else:
+            # fallback to reading nodes one at a time
+            return NoteBookConnection.read_nodes(self, nodeids)
+
     def update_node(self, nodeid, attr):
 
-        body_content = self.dumps_data(attr).encode("utf8")
-        self._request('PUT', format_node_path(self._prefix, nodeid),
-                      body_content)
-        result = self._conn.getresponse()
+        result = self._data_request(
+            'PUT', format_node_path(self._prefix, nodeid), attr)
         if result.status == http.client.NOT_FOUND:
             raise connlib.UnknownNode()
         elif result.status != http.client.OK:
             raise connlib.ConnectionError()
+        self._invalidate_node(nodeid)
         self._title_cache.update_attr(attr)
 
     def delete_node(self, nodeid):
 
-        self._request('DELETE', format_node_path(self._prefix, nodeid))
-        result = self._conn.getresponse()
+        result = self._request(
+            'DELETE', format_node_path(self._prefix, nodeid))
         if result.status == http.client.NOT_FOUND:
             raise connlib.UnknownNode()
         elif result.status != http.client.OK:
             raise connlib.ConnectionError()
+        self._invalidate_node(nodeid)
         self._title_cache.remove(nodeid)
 
     def has_node(self, nodeid):
         """Returns True if node exists"""
 
-        # HEAD nodeid/filename
-        self._request('HEAD', format_node_path(self._prefix, nodeid))
-        result = self._conn.getresponse()
+        # GET nodeid, answered from the attr cache when possible
+        result = self._cached_get(format_node_path(self._prefix, nodeid))
+        result.close()
         return result.status == http.client.OK
 
     def get_rootid(self):
         """Returns nodeid of notebook root node"""
         # GET /
-        self._request('GET', format_node_path(self._prefix))
-        result = self._conn.getresponse()
+        result = self._request('GET', format_node_path(self._prefix))
 
         if result.status == http.client.NOT_FOUND:
             raise connlib.UnknownNode()
@@ -241,64 +812,39 @@ class NoteBookConnectionHttp (NoteBookConnection):
         # write: POST nodeid/file
         # append: POST nodeid/file?mode=a
 
-        class HttpFile (object):
-            def __init__(self, codec=None):
-                self.data = []
-                self.codec = codec
-
-            def write(self, data):
-                if codec:
-                    data = data.encode(codec)
-                self.data.append(data)
-
-            def close(self):
-                pass
-
-            def __enter__(self):
-                return self
-
-            def __exit__(self, type, value, tb):
-                self.close()
-
         # Cannot open directories.
         if filename.endswith("/"):
             raise connlib.FileError()
 
+        binary = mode.endswith("b")
+        mode = mode.rstrip("b")
+        url = format_node_path(self._prefix, nodeid, filename)
+
         if mode == "r":
-            self._request(
-                'GET', format_node_path(self._prefix, nodeid, filename))
-            result = self._conn.getresponse()
-            if result.status == http.client.OK:
-                stream = contextlib.closing(result)
-                stream.read = result.read
-                stream.close = result.close
-                return stream
-            else:
+            result = self._cached_get(url, stream=True)
+            if result.status != http.client.OK:
+                result.close()
                 raise connlib.FileError()
-
-        elif mode == "w":
-            stream = HttpFile(codec)
-
-            def on_close():
-                body_content = "".join(stream.data)
-                self._request(
-                    'POST', format_node_path(self._prefix, nodeid, filename),
-                    body_content)
-                self._conn.getresponse()
-            stream.close = on_close
-            return stream
-
-        elif mode == "a":
-            stream = HttpFile(codec)
-
-            def on_close():
-                body_content = "".join(stream.data)
-                self._request(
-                    'POST', format_node_path(self._prefix, nodeid, filename) +
-                    "?mode=a", body_content)
-                self._conn.getresponse()
-            stream.close = on_close
-            return stream
+            if binary:
+                return result
+            return codecs.getreader(codec or "utf-8")(result)
+
+        elif mode in ("w", "a"):
+            if mode == "a":
+                url += "?mode=a"
+
+            def on_close(body, size):
+                # Reads during the upload may cache the old contents, so
+                # the node is invalidated again once the server responds.
+                self._invalidate_node(nodeid)
+                try:
+                    result = self._file_request(url, filename, body, size)
+                finally:
+                    self._invalidate_node(nodeid)
+                if result.status != http.client.OK:
+                    raise connlib.FileError(
+                        "cannot write file '%s' '%s'" % (nodeid, filename))
+            return HttpFile(on_close, codec)
 
         else:
             raise connlib.FileError("unknown mode '%s'" % mode)
@@ -307,9 +853,12 @@ class NoteBookConnectionHttp (NoteBookConnection):
         """Open a file contained within a node"""
 
         # DELETE nodeid/file
-        self._request(
-            'DELETE', format_node_path(self._prefix, nodeid, filename))
-        result = self._conn.getresponse()
+        self._invalidate_node(nodeid)
+        try:
+            result = self._request(
+                'DELETE', format_node_path(self._prefix, nodeid, filename))
+        finally:
+            self._invalidate_node(nodeid)
         if result.status != http.client.OK:
             raise connlib.FileError()
 
@@ -320,9 +869,12 @@ class NoteBookConnectionHttp (NoteBookConnection):
             raise connlib.FileError()
 
         # PUT nodeid/dir/
-        self._request(
-            'PUT', format_node_path(self._prefix, nodeid, filename))
-        result = self._conn.getresponse()
+        self._invalidate_node(nodeid)
+        try:
+            result = self._request(
+                'PUT', format_node_path(self._prefix, nodeid, filename))
+        finally:
+            self._invalidate_node(nodeid)
         if result.status != http.client.OK:
             raise connlib.FileError()
 
@@ -335,9 +887,8 @@ class NoteBookConnectionHttp (NoteBookConnection):
             raise connlib.FileError()
 
         # GET nodeid/dir/
-        self._request(
-            'GET', format_node_path(self._prefix, nodeid, filename))
-        result = self._conn.getresponse()
+        result = self._cached_get(
+            format_node_path(self._prefix, nodeid, filename))
         if result.status == http.client.OK:
             try:
                 if self._version == 1:
@@ -354,9 +905,8 @@ class NoteBookConnectionHttp (NoteBookConnection):
     def has_file(self, nodeid, filename):
 
         # HEAD nodeid/filename
-        self._request(
+        result = self._request(
             'HEAD', format_node_path(self._prefix, nodeid, filename))
-        result = self._conn.getresponse()
         return result.status == http.client.OK
 
     #---------------------------------
@@ -365,11 +915,9 @@ class NoteBookConnectionHttp (NoteBookConnection):
     def index_raw(self, query):
         # POST /?index
         # query plist encoded
-        body_content = self.dumps_data(query).encode("utf8")
-        self._request(
+        result = self._data_request(
             'POST', format_node_path(self._notebook_prefix) + "?index",
-            body_content)
-        result = self._conn.getresponse()
+            query)
         if result.status == http.client.OK:
             try:
                 return self.load_data(result)
@@ -465,3 +1013,151 @@ class NodeTitleCache (object):
         self._titles.clear()
         self._nodeids.clear()
         self._complete = False
+
+
+class CacheEntry (object):
+    """
+    A cached response body
+
+    An entry is 'trusted' if no changes arrived on the change feed while
+    it was fetched, so it may be used without revalidation.
+    """
+
+    def __init__(self, etag, data, content_type=None, trusted=False):
+        self.etag = etag
+        self.data = data
+        self.content_type = content_type
+        self.trusted = trusted
+
+    def get_response(self):
+        headers = {}
+        if self.content_type:
+            headers["Content-Type"] = self.content_type
+        return BufferedResponse(None, self.data, http.client.OK, headers)
+
+
+class HttpCache (object):
+    """
+    A bounded LRU cache of GET responses keyed by url
+
+    Entries are always revalidated with their ETag, so a hit costs a
+    bodyless 304 response and stale data is never returned.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE,
+                 maxbytes=DEFAULT_CACHE_BYTES):
+        self._maxsize = maxsize
+        self._maxbytes = maxbytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._stats = defaultdict(int)
+
+    def get(self, url):
+        """Returns the CacheEntry for a url or None"""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def put(self, url, entry):
+        with self._lock:
+            self._remove(url)
+            if self._maxsize <= 0 or len(entry.data) > self._maxbytes:
+                return
+            self._entries[url] = entry
+            self._nbytes += len(entry.data)
+
+            # evict least recently used entries
+            while (len(self._entries) > self._maxsize or
+                   self._nbytes > self._maxbytes):
+                url2, entry2 = self._entries.popitem(last=False)
+                self._nbytes -= len(entry2.data)
+                self._stats["evictions"] += 1
+
+    def remove(self, url):
+        with self._lock:
+            self._remove(url)
+
+    def remove_node(self, node_url):
+        """Remove a node url and all urls beneath it"""
+        with self._lock:
+            for url in list(self._entries):
+                if url == node_url or url.startswith(node_url + "/"):
+                    self._remove(url)
+
+    def _remove(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self._nbytes -= len(entry.data)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def add_hit(self):
+        with self._lock:
+            self._stats["hits"] += 1
+
+    def add_miss(self):
+        with self._lock:
+            self._stats["misses"] += 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.setdefault("hits", 0)
+            stats.setdefault("misses", 0)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._nbytes
+            return stats
+
+
+class ChangeWatcher (object):
+    """
+    Follows a server change feed with long-polling in a background thread
+    """
+
+    def __init__(self, conn, timeout=DEFAULT_POLL_TIMEOUT):
+        self._conn = conn
+        self._timeout = timeout
+        self._live = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._live = False
+
+    def is_live(self):
+        """Returns True if the feed is currently being followed"""
+        return self._live
+
+    def _run(self):
+        attempt = 0
+        while not self._stopped.is_set():
+            try:
+                # the first request returns at once to catch up
+                timeout = self._timeout if self._live else 0
+                start = time.time()
+                changes = self._conn.sync_changes(timeout)
+                self._live = not self._stopped.is_set()
+                attempt = 0
+
+                # Servers without long-polling answer at once.
+                if (timeout and not changes and
+                        time.time() - start < timeout / 2):
+                    self._stopped.wait(POLL_INTERVAL)
+            except Exception:
+                # The feed is not followed until the server is back.
+                self._live = False
+                self._stopped.wait(min(DEFAULT_BACKOFF * 2 ** attempt,
+                                       self._timeout))
+                attempt += 1
@@ -0,0 +1,216 @@
+"""
+
+    KeepNote
+
+    Content encodings for the notebook HTTP protocol
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+# python imports
+import json
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# content types of encoded attr data
+JSON_TYPE = "application/json"
+MSGPACK_TYPE = "application/x-msgpack"
+
+# bodies smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 512
+
+# compression level used for gzip and deflate
+COMPRESS_LEVEL = 6
+
+
+#=============================================================================
+# Content-Encoding
+
+def get_encodings():
+    """Returns the supported content encodings in order of preference"""
+    if brotli:
+        return ["br", "gzip", "deflate"]
+    else:
+        return ["gzip", "deflate"]
+
+
+def format_accept_encoding():
+    """Returns an Accept-Encoding header for the supported encodings"""
+    return ", ".join(get_encodings())
+
+
+def parse_accept_encoding(header):
+    """Returns the set of encodings accepted by an Accept-Encoding header"""
+    encodings = set()
+    if not header:
+        return encodings
+    for part in header.split(","):
+        fields = part.strip().split(";")
+        name = fields[0].strip().lower()
+        quality = 1.0
+        for param in fields[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name and quality > 0:
+            encodings.add(name)
+    return encodings
+
+
+def choose_encoding(header):
+    """
+    Choose a content encoding for an Accept-Encoding header
+
+    Returns None if no supported encoding is accepted.
+    """
+    accepted = parse_accept_encoding(header)
+    for encoding in get_encodings():
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+def is_compressible(content_type):
+    """Returns True if a content type is worth compressing"""
+    if not content_type:
+        return False
+    content_type = content_type.split(";")[0].strip().lower()
+    return (content_type == "text" or
+            content_type.startswith("text/") or
+            content_type.endswith("json") or
+            content_type.endswith("xml") or
+            content_type == "application/javascript")
+
+
+class Compressor (object):
+    """An incremental compressor for a content encoding"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor()
+            self._compress = self._compressor.process
+        elif encoding == "gzip":
+            self._compressor = zlib.compressobj(
+                COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._compress = self._compressor.compress
+        elif encoding == "deflate":
+            self._compressor = zlib.compressobj(COMPRESS_LEVEL)
+            self._compress = self._compressor.compress
+        else:
+            raise ValueError("unknown encoding '%s'" % encoding)
+
+    def compress(self, data):
+        return self._compress(data)
+
+    def flush(self):
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class Decompressor (object):
+    """An incremental decompressor for a content encoding"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            if not brotli:
+                raise ValueError("brotli is not installed")
+            self._decompressor = brotli.Decompressor()
+            self._decompress = self._decompressor.process
+        elif encoding == "gzip":
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._decompress = self._decompressor.decompress
+        elif encoding == "deflate":
+            self._decompressor = zlib.decompressobj()
+            self._decompress = self._decompressor.decompress
+        else:
+            raise ValueError("unknown encoding '%s'" % encoding)
+
+    def decompress(self, data):
+        return self._decompress(data)
+
+    def flush(self):
+        if self.encoding == "br":
+            return b""
+        return self._decompressor.flush()
+
+
+def compress(data, encoding):
+    """Compress a complete body"""
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, encoding):
+    """Decompress a complete body"""
+    decompressor = Decompressor(encoding)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+#=============================================================================
+# Attr data encoding
+
+def get_data_types():
+    """Returns the supported attr data content types in order of preference"""
+    if msgpack:
+        return [MSGPACK_TYPE, JSON_TYPE]
+    else:
+        return [JSON_TYPE]
+
+
+def choose_data_type(accept):
+    """Choose an attr data content type for an Accept header"""
+    if msgpack and accept and MSGPACK_TYPE in accept:
+        return MSGPACK_TYPE
+    return JSON_TYPE
+
+
+def dumps_data(data, content_type=JSON_TYPE):
+    """Encode attr data as bytes"""
+    if content_type == MSGPACK_TYPE:
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data).encode("utf8")
+
+
+def loads_data(data, content_type=JSON_TYPE):
+    """Decode attr data from bytes"""
+    if content_type:
+        content_type = content_type.split(";")[0].strip()
+    if content_type == MSGPACK_TYPE:
+        if not msgpack:
+            raise ValueError("msgpack is not installed")
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
@@ -0,0 +1,296 @@
+"""
+
+    KeepNote
+
+    Thread-safe access to notebook connections
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+# python imports
+from contextlib import contextmanager
+import functools
+import threading
+
+# keepnote imports
+from keepnote.notebook.connection import NoteBookConnection
+
+
+# index queries that only read the index
+READ_QUERIES = set([
+    "search", "search_fulltext", "has_fulltext", "node_path", "get_attr",
+    "node_manifest", "node_tree", "index_needed",
+])
+
+
+#=============================================================================
+# Reader/writer lock
+
+class RWLock (object):
+    """
+    A reader/writer lock
+
+    Any number of readers may hold the lock at once, while a writer holds
+    it exclusively.  Waiting writers take priority over new readers.  The
+    lock is reentrant: a thread holding the write lock may acquire either
+    lock again, and a reader may acquire the read lock again.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writer_count = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers[me] = 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+            else:
+                del self._readers[me]
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_count += 1
+                return
+            if me in self._readers:
+                raise RuntimeError("cannot upgrade a read lock")
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writer_count = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer_count -= 1
+            if not self._writer_count:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read_lock(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_lock(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+def materialize(result):
+    """Returns an iterator result as a list so it can leave the lock"""
+    if hasattr(result, "__next__"):
+        return list(result)
+    return result
+
+
+def read_locked(func):
+    """Decorate a method to hold its object's read lock ('_lock')"""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kargs):
+        with self._lock.read_lock():
+            return func(self, *args, **kargs)
+    return wrapper
+
+
+def write_locked(func):
+    """Decorate a method to hold its object's write lock ('_lock')"""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kargs):
+        with self._lock.write_lock():
+            return func(self, *args, **kargs)
+    return wrapper
+
+
+#=============================================================================
+# Locked connection
+
+class LockedConnection (NoteBookConnection):
+    """
+    Serializes access to a notebook connection shared between threads
+
+    Reads share a reader/writer lock and writes hold it exclusively.
+    File streams are opened under the lock, but read and written after
+    it is released; node files are replaced atomically when a written
+    stream is closed.
+    """
+
+    def __init__(self, conn, lock=None):
+        self._conn = conn
+        self._lock = lock if lock else RWLock()
+
+    def get_lock(self):
+        return self._lock
+
+    def get_connection(self):
+        return self._conn
+
+    #======================
+    # connection API
+
+    @write_locked
+    def connect(self, url):
+        return self._conn.connect(url)
+
+    @write_locked
+    def close(self):
+        return self._conn.close()
+
+    @write_locked
+    def save(self):
+        return self._conn.save()
+
+    #======================
+    # node I/O API
+
+    @write_locked
+    def create_node(self, nodeid, attr):
+        return self._conn.create_node(nodeid, attr)
+
+    @read_locked
+    def read_node(self, nodeid):
+        return self._conn.read_node(nodeid)
+
+    @read_locked
+    def read_nodes(self, nodeids):
+        return self._conn.read_nodes(nodeids)
+
+    @write_locked
+    def update_node(self, nodeid, attr):
+        return self._conn.update_node(nodeid, attr)
+
+    @write_locked
+    def delete_node(self, nodeid):
+        return self._conn.delete_node(nodeid)
+
+    @read_locked
+    def has_node(self, nodeid):
+        return self._conn.has_node(nodeid)
+
+    @read_locked
+    def get_rootid(self):
+        return self._conn.get_rootid()
+
+    #===============
+    # file API
+
+    def open_file(self, nodeid, filename, mode="r", codec=None):
+        if mode.startswith("r"):
+            with self._lock.read_lock():
+                return self._conn.open_file(nodeid, filename, mode, codec)
+        else:
+            with self._lock.write_lock():
+                return self._conn.open_file(nodeid, filename, mode, codec)
+
+    @write_locked
+    def delete_file(self, nodeid, filename):
+        return self._conn.delete_file(nodeid, filename)
+
+    @write_locked
+    def create_dir(self, nodeid, filename):
+        return self._conn.create_dir(nodeid, filename)
+
+    @read_locked
+    def list_dir(self, nodeid, filename="/"):
+        return materialize(self._conn.list_dir(nodeid, filename))
+
+    @read_locked
+    def has_file(self, nodeid, filename):
+        return self._conn.has_file(nodeid, filename)
+
+    @write_locked
+    def move_file(self, nodeid1, filename1, nodeid2, filename2):
+        return self._conn.move_file(nodeid1, filename1, nodeid2, filename2)
+
+    @write_locked
+    def copy_file(self, nodeid1, filename1, nodeid2, filename2):
+        return self._conn.copy_file(nodeid1, filename1, nodeid2, filename2)
+
+    @read_locked
+    def get_file_stat(self, nodeid, filename):
+        return self._conn.get_file_stat(nodeid, filename)
+
+    @read_locked
+    def get_file_hash(self, nodeid, filename, size=None, mtime=None):
+        return self._conn.get_file_hash(nodeid, filename, size, mtime)
+
+    @read_locked
+    def get_node_manifest(self, nodeid, attr=None):
+        return self._conn.get_node_manifest(nodeid, attr)
+
+    #---------------------------------
+    # indexing
+
+    def index(self, query):
+        # Results must not be iterated after the lock is released.
+        if query and query[0] in READ_QUERIES:
+            with self._lock.read_lock():
+                return materialize(self._conn.index(query))
+        else:
+            with self._lock.write_lock():
+                return materialize(self._conn.index(query))
+
+    #================================
+    # Filesystem-specific API
+
+    @read_locked
+    def get_node_path(self, nodeid):
+        return self._conn.get_node_path(nodeid)
+
+    @read_locked
+    def get_node_basename(self, nodeid):
+        return self._conn.get_node_basename(nodeid)
+
+    @write_locked
+    def get_file(self, nodeid, filename, _path=None):
+        return self._conn.get_file(nodeid, filename)
+
+    @read_locked
+    def get_local_file(self, nodeid, filename, _path=None):
+        return self._conn.get_local_file(nodeid, filename)
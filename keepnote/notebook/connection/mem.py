@@ -27,40 +27,118 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
 #
 
-from io import StringIO
+# python imports
+from collections import OrderedDict
+import io
+import threading
 
 # keepnote imports
 import keepnote.notebook.connection as connlib
 from keepnote.notebook.connection import NoteBookConnection
 
 
+def get_attr_size(attr):
+    """Returns the approximate size of node attr in bytes"""
+    return len(repr(attr))
+
+
 #=============================================================================
 
 class Node (object):
+    """Attrs and file contents of a node"""
+
+    __slots__ = ("attr", "files", "size")
+
     def __init__(self, attr={}):
         self.attr = dict(attr)
-        self.files = {}
+        self.files = {}  # filename --> bytes, or None for directories
+        self.size = get_attr_size(self.attr)
 
 
-class File (StringIO):
-    def close(self):
-        self.closed = True
+class FileReader (io.RawIOBase):
+    """Reads file contents through a memoryview without copying them"""
+
+    def __init__(self, data):
+        io.RawIOBase.__init__(self)
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buf):
+        size = min(len(buf), len(self._view) - self._pos)
+        buf[:size] = self._view[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(len(self._view), self._pos + size)
+        data = self._view[self._pos:end].tobytes()
+        self._pos = end
+        return data
+
+    read1 = read
+
+    def readall(self):
+        return self.read()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
 
-    def reopen(self):
-        self.closed = False
-        self.seek(0)
 
-    def __enter__(self):
-        return self
+class FileWriter (io.BytesIO):
+    """Buffers file contents until the file is closed"""
 
-    def __exit__(self, *args):
-        self.close()
+    def __init__(self, on_close, data=b""):
+        io.BytesIO.__init__(self, data)
+        self.seek(0, io.SEEK_END)
+        self._on_close = on_close
+
+    def close(self):
+        if self._on_close:
+            on_close = self._on_close
+            self._on_close = None
+            on_close(self.getvalue())
+        io.BytesIO.close(self)
 
 
 class NoteBookConnectionMem (NoteBookConnection):
-    def __init__(self):
-        self._nodes = {}
+    """
+    NoteBook connection that keeps nodes in memory
+
+    If a 'backing' connection is given, this connection is a write-through
+    cache in front of it.  Writes go to both connections, reads are served
+    from memory when possible, and the least recently used nodes are
+    evicted once cached attrs and files exceed 'max_size' bytes.
+    """
+
+    def __init__(self, backing=None, max_size=None):
+        NoteBookConnection.__init__(self)
+        if max_size is not None and backing is None:
+            raise connlib.ConnectionError(
+                "a size limit requires a backing connection")
+
+        self._nodes = OrderedDict()
         self._rootid = None
+        self._backing = backing
+        self._max_size = max_size
+        self._size = 0
+        self._lock = threading.RLock()
 
     #======================
     # connection API
@@ -71,114 +149,274 @@ class NoteBookConnectionMem (NoteBookConnection):
 
     def close(self):
         """Close connection"""
-        pass
+        with self._lock:
+            self._nodes.clear()
+            self._size = 0
+        if self._backing:
+            self._backing.close()
 
     def save(self):
         """Save any unsynced state"""
-        pass
+        if self._backing:
+            self._backing.save()
+
+    def get_size(self):
+        """Returns the approximate number of bytes held in memory"""
+        return self._size
+
+    def get_backing(self):
+        return self._backing
+
+    #======================
+    # cached nodes
+
+    def _get_node(self, nodeid):
+        """Returns a node, loading it from the backing connection"""
+        node = self._nodes.get(nodeid)
+        if node is not None:
+            if self._backing:
+                self._nodes.move_to_end(nodeid)
+            return node
+        if self._backing is None:
+            raise connlib.UnknownNode()
+        return self._add_node(nodeid, self._backing.read_node(nodeid))
+
+    def _add_node(self, nodeid, attr):
+        node = self._nodes[nodeid] = Node(attr)
+        self._size += node.size
+        self._evict(nodeid)
+        return node
+
+    def _remove_node(self, nodeid):
+        node = self._nodes.pop(nodeid, None)
+        if node is not None:
+            self._size -= node.size
+
+    def _resize(self, node, size):
+        self._size += size - node.size
+        node.size = size
+
+    def _evict(self, keepid):
+        """Evict least recently used nodes until the cache fits"""
+        if self._max_size is None or self._size <= self._max_size:
+            return
+        for nodeid in list(self._nodes):
+            if self._size <= self._max_size:
+                break
+            if nodeid != keepid:
+                self._remove_node(nodeid)
 
     #======================
     # Node I/O API
 
     def create_node(self, nodeid, attr):
         """Create a node"""
-        if nodeid in self._nodes:
-            raise connlib.NodeExists()
-        if self._rootid is None:
-            self._rootid = nodeid
-        self._nodes[nodeid] = Node(attr)
+        with self._lock:
+            if nodeid in self._nodes:
+                raise connlib.NodeExists()
+            if self._backing:
+                self._backing.create_node(nodeid, attr)
+                self._refresh_attrs(attr.get("parentids", ()))
+                return
+            if self._rootid is None:
+                self._rootid = nodeid
+            self._add_node(nodeid, attr)
 
     def read_node(self, nodeid):
         """Read a node attr"""
-        node = self._nodes.get(nodeid)
-        if node is None:
-            raise connlib.UnknownNode()
-        return node.attr
+        with self._lock:
+            return self._get_node(nodeid).attr
 
     def update_node(self, nodeid, attr):
         """Write node attr"""
-        node = self._nodes.get(nodeid)
-        if node is None:
-            raise connlib.UnknownNode()
-        node.attr = dict(attr)
+        with self._lock:
+            if self._backing:
+                # The backing connection may derive attrs such as
+                # childrenids, so affected nodes are read back from it.
+                node = self._nodes.get(nodeid)
+                old_parentids = node.attr.get("parentids", ()) if node else ()
+                self._backing.update_node(nodeid, attr)
+                self._refresh_attrs([nodeid] + list(old_parentids) +
+                                    list(attr.get("parentids", ())))
+                return
+
+            node = self._nodes.get(nodeid)
+            if node is None:
+                raise connlib.UnknownNode()
+            self._set_attr(node, attr)
 
     def delete_node(self, nodeid):
         """Delete node"""
-        node = self._nodes.get(nodeid)
-        if node is None:
-            raise connlib.UnknownNode()
-        del self._nodes[nodeid]
+        with self._lock:
+            if self._backing:
+                node = self._nodes.get(nodeid)
+                self._backing.delete_node(nodeid)
+                self._remove_node(nodeid)
+                if node:
+                    self._refresh_attrs(node.attr.get("parentids", ()))
+                return
+            if nodeid not in self._nodes:
+                raise connlib.UnknownNode()
+            self._remove_node(nodeid)
+
+    def _set_attr(self, node, attr):
+        old_size = get_attr_size(node.attr)
+        node.attr = dict(attr)
+        self._resize(node, node.size - old_size + get_attr_size(node.attr))
+
+    def _refresh_attrs(self, nodeids):
+        """Read the attrs of cached nodes back from the backing connection"""
+        for nodeid in nodeids:
+            node = self._nodes.get(nodeid)
+            if node is None:
+                continue
+            try:
+                self._set_attr(node, self._backing.read_node(nodeid))
+            except connlib.UnknownNode:
+                self._remove_node(nodeid)
 
     def has_node(self, nodeid):
         """Returns True if node exists"""
-        return nodeid in self._nodes
+        with self._lock:
+            if nodeid in self._nodes:
+                return True
+        return self._backing is not None and self._backing.has_node(nodeid)
 
     def get_rootid(self):
         """Returns nodeid of notebook root node"""
+        if self._backing:
+            return self._backing.get_rootid()
         return self._rootid
 
     #===============
     # file API
 
+    def _read_data(self, nodeid, filename):
+        """Returns the contents of a node file"""
+        with self._lock:
+            node = self._get_node(nodeid)
+            data = node.files.get(filename)
+            if data is not None:
+                return data
+            if self._backing is None:
+                raise connlib.UnknownFile(
+                    "cannot open file '%s' '%s'" % (nodeid, filename))
+
+        with self._backing.open_file(nodeid, filename, "rb") as infile:
+            data = infile.read()
+        with self._lock:
+            node = self._nodes.get(nodeid)
+            if node is not None:
+                self._set_data(nodeid, node, filename, data)
+        return data
+
+    def _write_data(self, nodeid, filename, data):
+        """Store the contents of a node file"""
+        if self._backing:
+            with self._backing.open_file(nodeid, filename, "wb") as out:
+                out.write(data)
+        with self._lock:
+            node = self._nodes.get(nodeid)
+            if node is not None:
+                self._make_parent_dirs(node, filename)
+                self._set_data(nodeid, node, filename, data)
+
+    def _set_data(self, nodeid, node, filename, data):
+        old = node.files.get(filename)
+        node.files[filename] = data
+        self._resize(node, node.size + len(data) - (len(old) if old else 0))
+        self._evict(nodeid)
+
+    def _make_parent_dirs(self, node, filename):
+        # the node root is not stored as a file
+        parts = filename.lstrip("/").split("/")
+        for i in range(len(parts)-1):
+            node.files.setdefault("/".join(parts[:i+1]) + "/", None)
+
     def open_file(self, nodeid, filename, mode="r", codec=None):
         """
         Open a file contained within a node
 
         nodeid   -- node to open a file from
         filename -- filename of file to open
-        mode     -- can be "r" (read), "w" (write), "a" (append)
-        codec    -- read or write with an encoding (default: None)
+        mode     -- can be "r" (read), "w" (write), "a" (append), with
+                    "b" for binary
+        codec    -- read or write with an encoding (default: utf-8)
         """
-        node = self._nodes.get(nodeid)
-        if node is None:
-            raise connlib.UnknownNode()
+        if mode not in ("r", "w", "a", "rb", "wb", "ab"):
+            raise connlib.FileError(
+                "mode must be 'r', 'w', 'a', 'rb', 'wb', or 'ab'")
         if filename.endswith("/"):
             raise connlib.FileError()
-        stream = node.files.get(filename)
-        if stream is None:
-            i = filename.rfind("/")
-            if i != -1:
-                self.create_dir(nodeid, filename[:i+1])
-            stream = node.files[filename] = File()
+        with self._lock:
+            self._get_node(nodeid)
+
+        if mode.startswith("r"):
+            stream = FileReader(self._read_data(nodeid, filename))
         else:
-            stream.reopen()
-        return stream
+            data = b""
+            if mode.startswith("a"):
+                try:
+                    data = self._read_data(nodeid, filename)
+                except connlib.FileError:
+                    pass
+            stream = FileWriter(
+                lambda data: self._write_data(nodeid, filename, data), data)
+
+        if "b" in mode:
+            return stream
+        return io.TextIOWrapper(stream, encoding=codec or "utf-8")
 
     def delete_file(self, nodeid, filename):
         """Delete a file contained within a node"""
-        node = self._nodes.get(nodeid)
-        if node is None:
-            raise connlib.UnknownNode()
-        try:
-            del node.files[filename]
-        except KeyError:
-            pass
+        with self._lock:
+            if self._backing:
+                self._backing.delete_file(nodeid, filename)
+                node = self._nodes.get(nodeid)
+                if node is None:
+                    return
+            else:
+                node = self._get_node(nodeid)
+
+            if connlib.is_dir(filename):
+                names = [name for name in node.files
+                         if name.startswith(filename)]
+            else:
+                names = [filename]
+            for name in names:
+                data = node.files.pop(name, None)
+                if data:
+                    self._resize(node, node.size - len(data))
 
     def create_dir(self, nodeid, filename):
         """Create directory within node"""
-        node = self._nodes.get(nodeid)
-        if node is None:
-            raise connlib.UnknownNode()
         if not filename.endswith("/"):
             raise connlib.FileError()
-
-        # Create all directory parts.
-        parts = filename.split("/")
-        for i in range(len(parts)-1):
-            node.files["/".join(parts[:i+1]) + "/"] = None
+        with self._lock:
+            node = self._get_node(nodeid)
+            if self._backing:
+                self._backing.create_dir(nodeid, filename)
+            self._make_parent_dirs(node, filename)
 
     def list_dir(self, nodeid, filename="/"):
         """
         List data files in node
         """
-        node = self._nodes.get(nodeid)
-        if node is None:
-            raise connlib.UnknownNode()
         if not filename.endswith("/"):
             raise connlib.FileError()
-
-        seen = set()
-        for name in node.files.keys():
+        if self._backing:
+            return self._backing.list_dir(nodeid, filename)
+        with self._lock:
+            names = list(self._get_node(nodeid).files.keys())
+        return self._list_dir(names, filename)
+
+    def _list_dir(self, names, filename):
+        # Node filenames are relative to the node, without a leading '/'.
+        if filename == "/":
+            filename = ""
+        # never list the directory itself
+        seen = set([filename or "/"])
+        for name in names:
             if name.startswith(filename) and name != filename:
                 part = name[len(filename):]
                 index = part.find('/')
@@ -191,16 +429,31 @@ class NoteBookConnectionMem (NoteBookConnection):
                     seen.add(fullname)
 
     def has_file(self, nodeid, filename):
-        node = self._nodes.get(nodeid)
-        if node is None:
-            raise connlib.UnknownNode()
-        return filename in node.files
+        with self._lock:
+            if filename in self._get_node(nodeid).files:
+                return True
+        return (self._backing is not None and
+                self._backing.has_file(nodeid, filename))
+
+    def copy_file(self, nodeid1, filename1, nodeid2, filename2):
+        """Copy a file between two nodes"""
+        if (nodeid1 is None or nodeid2 is None or
+                connlib.is_dir(filename1)):
+            return NoteBookConnection.copy_file(
+                self, nodeid1, filename1, nodeid2, filename2)
+
+        # File contents are immutable, so copies share them.
+        self._write_data(nodeid2, filename2,
+                         self._read_data(nodeid1, filename1))
 
     #---------------------------------
     # indexing
 
     def index(self, query):
 
+        if self._backing:
+            return self._backing.index(query)
+
         # TODO: make this plugable
         # also plug-ability will ensure safer fall back to unhandeled queries
 
@@ -211,6 +464,7 @@ class NoteBookConnectionMem (NoteBookConnection):
         # ["has_fulltext"]
         # ["node_path", nodeid]
         # ["get_attr", nodeid, key]
+        # ["node_manifest", nodeid]
 
         if query[0] == "index_attr":
             return
@@ -243,7 +497,13 @@ class NoteBookConnectionMem (NoteBookConnection):
             return path
 
         elif query[0] == "get_attr":
-            return self._nodes[query[1]][query[2]]
+            return self._nodes[query[1]].attr[query[2]]
+
+        elif query[0] == "node_manifest":
+            return self.get_node_manifest(query[1])
+
+        elif query[0] == "node_tree":
+            return NoteBookConnection.index(self, query)
 
         # FS-specific
         elif query[0] == "init":
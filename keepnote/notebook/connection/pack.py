@@ -0,0 +1,630 @@
+"""
+
+    KeepNote
+
+    Low-level Create-Read-Update-Delete (CRUD) interface for notebooks.
+
+    This module stores a whole notebook in a single SQLite file.
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+# python imports
+import hashlib
+import io
+import json
+import os
+import sqlite3 as sqlite
+import threading
+import time
+import urllib.parse
+import zlib
+
+# keepnote imports
+import keepnote.notebook
+import keepnote.notebook.connection as connlib
+from keepnote.notebook.connection import NoteBookConnection
+from keepnote.notebook.connection.index import AttrIndex
+from keepnote.notebook.connection.index import NodeIndex
+
+
+# url scheme of packed notebooks
+PACK_SCHEME = "pack"
+
+# version of the database schema
+PACK_VERSION = 1
+
+# file encodings
+ENCODING_NONE = ""
+ENCODING_DEFLATE = "deflate"
+
+# files smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 256
+
+# compressed files are only kept if they are at most this fraction
+# of their original size
+MAX_COMPRESS_RATIO = 0.9
+
+COMPRESS_LEVEL = 6
+
+# the page file whose text is indexed for full text search
+PAGE_DATA_FILE = "page.html"
+
+
+def get_pack_filename(url):
+    """Returns the local filename of a packed notebook url"""
+    if url.startswith(PACK_SCHEME + "://"):
+        return urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+    return url
+
+
+def compress_data(data):
+    """Returns (encoding, data) for storing a file"""
+    if len(data) >= MIN_COMPRESS_SIZE:
+        compressed = zlib.compress(data, COMPRESS_LEVEL)
+        if len(compressed) <= MAX_COMPRESS_RATIO * len(data):
+            return ENCODING_DEFLATE, compressed
+    return ENCODING_NONE, data
+
+
+def decompress_data(encoding, data):
+    """Returns the contents of a stored file"""
+    if encoding == ENCODING_DEFLATE:
+        return zlib.decompress(data)
+    return bytes(data)
+
+
+class PackFile (io.BytesIO):
+    """A node file buffer that is stored in the pack when closed"""
+
+    def __init__(self, on_close, data=b""):
+        io.BytesIO.__init__(self, data)
+        self.seek(0, io.SEEK_END)
+        self._on_close = on_close
+
+    def close(self):
+        if self._on_close:
+            on_close = self._on_close
+            self._on_close = None
+            on_close(self.getvalue())
+        io.BytesIO.close(self)
+
+
+class PackIndex (NodeIndex):
+    """Attr and full text indexes kept in the pack database"""
+
+    def __init__(self, conn, cur):
+        NodeIndex.__init__(self, conn)
+        self.cur = cur
+        self.init_attrs(cur)
+
+
+#=============================================================================
+
+
+class BaseNoteBookConnectionPack (NoteBookConnection):
+    """
+    NoteBook connection that stores a notebook in a single SQLite file
+
+    Node attrs are stored as JSON and node files as (optionally deflated)
+    blobs.  Childrenids are derived from the parentids of other nodes.
+    This base class enforces no attr schema.
+    """
+
+    def __init__(self):
+        NoteBookConnection.__init__(self)
+        self._filename = None
+        self._con = None
+        self._index = None
+        self._rootid = None
+        self._lock = threading.RLock()
+
+    #======================
+    # connection API
+
+    def connect(self, url):
+        """Make a new connection"""
+        self._filename = get_pack_filename(url)
+        dirname = os.path.dirname(self._filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        with self._lock:
+            self._con = sqlite.connect(self._filename,
+                                       check_same_thread=False)
+            self._con.execute("PRAGMA journal_mode=WAL")
+            self._con.execute("PRAGMA synchronous=NORMAL")
+            self._init_tables()
+            self._index = PackIndex(self, self._con.cursor())
+            self._con.commit()
+
+            row = self._con.execute(
+                "SELECT value FROM Meta WHERE key='rootid'").fetchone()
+            self._rootid = row[0] if row else None
+
+    def _init_tables(self):
+        con = self._con
+        con.execute("""CREATE TABLE IF NOT EXISTS Meta
+                       (key TEXT PRIMARY KEY,
+                        value TEXT);""")
+        row = con.execute(
+            "SELECT value FROM Meta WHERE key='version'").fetchone()
+        if row and int(row[0]) > PACK_VERSION:
+            raise connlib.ConnectionError(
+                "unsupported notebook pack version %s" % row[0])
+        con.execute("INSERT OR IGNORE INTO Meta VALUES ('version', ?)",
+                    (str(PACK_VERSION),))
+
+        con.execute("""CREATE TABLE IF NOT EXISTS Nodes
+                       (nodeid TEXT PRIMARY KEY,
+                        parentid TEXT,
+                        attr TEXT);""")
+        con.execute("""CREATE INDEX IF NOT EXISTS IdxNodesParentid
+                       ON Nodes (parentid);""")
+        con.execute("""CREATE TABLE IF NOT EXISTS Files
+                       (nodeid TEXT,
+                        filename TEXT,
+                        encoding TEXT,
+                        size INTEGER,
+                        mtime FLOAT,
+                        hash TEXT,
+                        data BLOB,
+                        PRIMARY KEY (nodeid, filename));""")
+
+    def close(self):
+        """Close connection"""
+        with self._lock:
+            if self._con:
+                self._con.commit()
+                self._con.close()
+                self._con = None
+                self._index = None
+
+    def save(self):
+        """Save any unsynced state"""
+        with self._lock:
+            self._con.commit()
+
+    def get_filename(self):
+        return self._filename
+
+    #======================
+    # Node I/O API
+
+    def _clean_attr(self, nodeid, attr):
+        """Returns attr as it should be stored"""
+        return attr
+
+    def _encode_attr(self, attr):
+        attr = dict(attr)
+        if "childrenids" in attr:
+            # children are derived from the parentids of other nodes
+            attr["childrenids"] = []
+        return json.dumps(attr)
+
+    def _decode_attr(self, nodeid, data):
+        attr = json.loads(data)
+        if "childrenids" in attr:
+            attr["childrenids"] = self._list_children_nodeids(nodeid)
+        return attr
+
+    def _get_parentid(self, attr):
+        parentids = attr.get("parentids")
+        return parentids[0] if parentids else None
+
+    def create_node(self, nodeid, attr):
+        """Create a node"""
+        if nodeid is None:
+            nodeid = attr.get("nodeid") or keepnote.notebook.new_nodeid()
+        attr = self._clean_attr(nodeid, attr)
+
+        with self._lock:
+            try:
+                self._con.execute(
+                    "INSERT INTO Nodes VALUES (?, ?, ?)",
+                    (nodeid, self._get_parentid(attr),
+                     self._encode_attr(attr)))
+            except sqlite.IntegrityError:
+                raise connlib.NodeExists()
+
+            # first node is root
+            if self._rootid is None:
+                self._rootid = nodeid
+                self._con.execute(
+                    "INSERT OR REPLACE INTO Meta VALUES ('rootid', ?)",
+                    (nodeid,))
+
+            self._index.add_node_attr(self._index.cur, nodeid, attr)
+            self._con.commit()
+        return nodeid
+
+    def read_node(self, nodeid):
+        """Read a node attr"""
+        with self._lock:
+            row = self._con.execute(
+                "SELECT attr FROM Nodes WHERE nodeid=?", (nodeid,)).fetchone()
+            if row is None:
+                raise connlib.UnknownNode()
+            return self._decode_attr(nodeid, row[0])
+
+    def read_nodes(self, nodeids):
+        """Read the attrs of several nodes"""
+        attrs = {}
+        with self._lock:
+            for i in range(0, len(nodeids), 500):
+                chunk = nodeids[i:i+500]
+                for nodeid, data in self._con.execute(
+                        "SELECT nodeid, attr FROM Nodes WHERE nodeid IN (%s)"
+                        % ",".join("?" * len(chunk)), chunk):
+                    attrs[nodeid] = self._decode_attr(nodeid, data)
+        return [attrs.get(nodeid) for nodeid in nodeids]
+
+    def update_node(self, nodeid, attr):
+        """Write node attr"""
+        attr = self._clean_attr(nodeid, attr)
+        with self._lock:
+            cur = self._con.execute(
+                "UPDATE Nodes SET parentid=?, attr=? WHERE nodeid=?",
+                (self._get_parentid(attr), self._encode_attr(attr), nodeid))
+            if cur.rowcount == 0:
+                raise connlib.UnknownNode()
+            self._index.add_node_attr(self._index.cur, nodeid, attr,
+                                      fulltext=False)
+            self._con.commit()
+
+    def delete_node(self, nodeid):
+        """Delete a node and its descendants"""
+        with self._lock:
+            if not self.has_node(nodeid):
+                raise connlib.UnknownNode()
+            nodeids = [row[0] for row in self._con.execute(
+                """WITH RECURSIVE tree(nodeid) AS (
+                       SELECT ?
+                     UNION ALL
+                       SELECT Nodes.nodeid FROM Nodes
+                       JOIN tree ON Nodes.parentid = tree.nodeid)
+                   SELECT nodeid FROM tree""", (nodeid,))]
+            for nodeid in nodeids:
+                self._con.execute("DELETE FROM Nodes WHERE nodeid=?",
+                                  (nodeid,))
+                self._con.execute("DELETE FROM Files WHERE nodeid=?",
+                                  (nodeid,))
+                self._index.remove_node_attr(self._index.cur, nodeid)
+            self._con.commit()
+
+    def has_node(self, nodeid):
+        """Returns True if node exists"""
+        with self._lock:
+            return self._con.execute(
+                "SELECT 1 FROM Nodes WHERE nodeid=?",
+                (nodeid,)).fetchone() is not None
+
+    def get_rootid(self):
+        """Returns nodeid of notebook root node"""
+        return self._rootid
+
+    def _list_children_nodeids(self, nodeid):
+        with self._lock:
+            return [row[0] for row in self._con.execute(
+                "SELECT nodeid FROM Nodes WHERE parentid=? ORDER BY rowid",
+                (nodeid,))]
+
+    #===============
+    # file API
+
+    def _check_node(self, nodeid):
+        if not self.has_node(nodeid):
+            raise connlib.UnknownNode()
+
+    def _read_file(self, nodeid, filename):
+        """Returns the contents of a node file"""
+        row = self._con.execute(
+            """SELECT encoding, data FROM Files
+               WHERE nodeid=? AND filename=?""",
+            (nodeid, filename)).fetchone()
+        if row is None or row[1] is None:
+            raise connlib.UnknownFile(
+                "cannot open file '%s' '%s'" % (nodeid, filename))
+        return decompress_data(row[0], row[1])
+
+    def _write_file(self, nodeid, filename, data):
+        """Store the contents of a node file"""
+        encoding, stored = compress_data(data)
+        with self._lock:
+            self._make_parent_dirs(nodeid, filename)
+            self._con.execute(
+                "INSERT OR REPLACE INTO Files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (nodeid, filename, encoding, len(data), time.time(),
+                 hashlib.sha1(data).hexdigest(), sqlite.Binary(stored)))
+
+            if (filename == PAGE_DATA_FILE and
+                    self._index.has_fulltext_search()):
+                row = self._con.execute(
+                    "SELECT attr FROM Nodes WHERE nodeid=?",
+                    (nodeid,)).fetchone()
+                if row:
+                    self._index.add_node_attr(
+                        self._index.cur, nodeid, json.loads(row[0]))
+            self._con.commit()
+
+    def _make_parent_dirs(self, nodeid, filename):
+        parts = filename.split("/")
+        for i in range(1, len(parts)):
+            self._con.execute(
+                """INSERT OR IGNORE INTO Files
+                   VALUES (?, ?, '', NULL, ?, NULL, NULL)""",
+                (nodeid, "/".join(parts[:i]) + "/", time.time()))
+
+    def open_file(self, nodeid, filename, mode="r", codec=None):
+        """Open a node file"""
+        if mode not in ("r", "w", "a", "rb", "wb", "ab"):
+            raise connlib.FileError(
+                "mode must be 'r', 'w', 'a', 'rb', 'wb', or 'ab'")
+        if filename.endswith("/"):
+            raise connlib.FileError(
+                "filename '%s' cannot end with '/'" % filename)
+        filename = filename.lstrip("/")
+
+        with self._lock:
+            self._check_node(nodeid)
+            if mode.startswith("r"):
+                stream = io.BytesIO(self._read_file(nodeid, filename))
+            else:
+                data = b""
+                if mode.startswith("a"):
+                    try:
+                        data = self._read_file(nodeid, filename)
+                    except connlib.UnknownFile:
+                        pass
+                stream = PackFile(
+                    lambda data: self._write_file(nodeid, filename, data),
+                    data)
+
+        if "b" in mode:
+            return stream
+        return io.TextIOWrapper(stream, encoding=codec or "utf-8")
+
+    def delete_file(self, nodeid, filename):
+        """Delete a node file or directory"""
+        filename = filename.lstrip("/")
+        with self._lock:
+            self._check_node(nodeid)
+            if connlib.is_dir(filename):
+                self._con.execute(
+                    """DELETE FROM Files WHERE nodeid=? AND
+                       substr(filename, 1, ?)=?""",
+                    (nodeid, len(filename), filename))
+            else:
+                self._con.execute(
+                    "DELETE FROM Files WHERE nodeid=? AND filename=?",
+                    (nodeid, filename))
+            self._con.commit()
+
+    def create_dir(self, nodeid, filename):
+        """Create directory within node"""
+        if not filename.endswith("/"):
+            raise connlib.FileError(
+                "filename '%s' does not end with '/'" % filename)
+        filename = filename.lstrip("/")
+        with self._lock:
+            self._check_node(nodeid)
+            self._make_parent_dirs(nodeid, filename + "x")
+            self._con.commit()
+
+    def list_dir(self, nodeid, filename="/"):
+        """List data files in node"""
+        if not filename.endswith("/"):
+            raise connlib.FileError(
+                "filename '%s' does not end with '/'" % filename)
+        prefix = filename.lstrip("/")
+        with self._lock:
+            self._check_node(nodeid)
+            if prefix and not self.has_file(nodeid, prefix):
+                raise connlib.UnknownFile(
+                    "cannot find file '%s' '%s'" % (nodeid, filename))
+            names = [row[0] for row in self._con.execute(
+                """SELECT filename FROM Files WHERE nodeid=? AND
+                   substr(filename, 1, ?)=? AND filename != ?""",
+                (nodeid, len(prefix), prefix, prefix))]
+
+        for name in names:
+            part = name[len(prefix):]
+            # only list the immediate contents of the directory and hide
+            # meta files, as the directory format does
+            if "/" not in part[:-1] and not part.startswith("__"):
+                yield name
+
+    def has_file(self, nodeid, filename):
+        """Return True if file exists"""
+        with self._lock:
+            return self._con.execute(
+                "SELECT 1 FROM Files WHERE nodeid=? AND filename=?",
+                (nodeid, filename.lstrip("/"))).fetchone() is not None
+
+    def move_file(self, nodeid1, filename1, nodeid2, filename2):
+        """Rename a node file"""
+        with self._lock:
+            self.copy_file(nodeid1, filename1, nodeid2, filename2)
+            self.delete_file(nodeid1, filename1)
+
+    def copy_file(self, nodeid1, filename1, nodeid2, filename2):
+        """
+        Copy a file between two nodes
+
+        If nodeid is None, filename is assumed to be a local file.
+        """
+        if nodeid1 is None:
+            with open(filename1, "rb") as infile:
+                self._write_file(nodeid2, filename2.lstrip("/"),
+                                 infile.read())
+            return
+        if nodeid2 is None:
+            with self._lock:
+                data = self._read_file(nodeid1, filename1.lstrip("/"))
+            with open(filename2, "wb") as out:
+                out.write(data)
+            return
+
+        filename1 = filename1.lstrip("/")
+        filename2 = filename2.lstrip("/")
+        with self._lock:
+            self._check_node(nodeid2)
+            if connlib.is_dir(filename1):
+                self.delete_file(nodeid2, filename2)
+            self._make_parent_dirs(nodeid2, filename2)
+            self._con.execute(
+                """INSERT OR REPLACE INTO Files
+                   SELECT ?, ? || substr(filename, ?), encoding, size,
+                          mtime, hash, data
+                   FROM Files WHERE nodeid=? AND
+                   (filename=? OR (? AND substr(filename, 1, ?)=?))""",
+                (nodeid2, filename2, len(filename1) + 1, nodeid1, filename1,
+                 connlib.is_dir(filename1), len(filename1), filename1))
+            self._con.commit()
+
+    def get_file_stat(self, nodeid, filename):
+        """Returns (size, mtime) of a node file"""
+        with self._lock:
+            row = self._con.execute(
+                "SELECT size, mtime FROM Files WHERE nodeid=? AND filename=?",
+                (nodeid, filename.lstrip("/"))).fetchone()
+        return tuple(row) if row else (None, None)
+
+    def get_file_hash(self, nodeid, filename, size=None, mtime=None):
+        """Returns the content hash of a node file"""
+        with self._lock:
+            row = self._con.execute(
+                "SELECT hash FROM Files WHERE nodeid=? AND filename=?",
+                (nodeid, filename.lstrip("/"))).fetchone()
+        if row is None or row[0] is None:
+            raise connlib.UnknownFile()
+        return row[0]
+
+    def get_pack_stats(self):
+        """Returns the stored and original sizes of all node files"""
+        with self._lock:
+            nfiles, size, stored = self._con.execute(
+                """SELECT COUNT(*), SUM(size), SUM(length(data))
+                   FROM Files WHERE data IS NOT NULL""").fetchone()
+        return {"files": nfiles, "bytes": size or 0,
+                "bytes_stored": stored or 0}
+
+    #---------------------------------
+    # indexing
+
+    def index(self, query):
+
+        with self._lock:
+            cur = self._index.cur
+
+            if query[0] == "index_attr":
+                index_value = query[3] if len(query) == 4 else False
+                return self._index_attr(query[1], query[2], index_value)
+
+            elif query[0] == "search":
+                assert query[1] == "title"
+                return self._index.search_node_titles(cur, query[2])
+
+            elif query[0] == "search_fulltext":
+                return list(self._index.search_node_contents(cur, query[1]))
+
+            elif query[0] == "has_fulltext":
+                return self._index.has_fulltext_search()
+
+            elif query[0] == "enable_fulltext":
+                return self._index.enable_fulltext_search(query[1])
+
+            elif query[0] == "node_path":
+                return self._get_node_path_by_id(query[1])
+
+            elif query[0] == "get_attr":
+                return self.read_node(query[1]).get(query[2])
+
+            elif query[0] == "node_manifest":
+                return self.get_node_manifest(query[1])
+
+            elif query[0] == "node_tree":
+                return NoteBookConnection.index(self, query)
+
+            elif query[0] == "index_needed":
+                return False
+
+            elif query[0] in ("init", "clear", "index_all", "compact"):
+                return
+
+            else:
+                raise NotImplementedError(
+                    "unknown index query '%s'" % query[0])
+
+    def _index_attr(self, key, datatype, index_value=False):
+        if not isinstance(datatype, str):
+            datatype = {str: "TEXT", int: "INTEGER",
+                        float: "FLOAT"}.get(datatype)
+            if datatype is None:
+                raise Exception("unknown attr datatype '%s'" % repr(datatype))
+
+        attrindex = AttrIndex(key, datatype, index_value=index_value)
+        exists = self._con.execute(
+            "SELECT 1 FROM sqlite_master WHERE name=?",
+            (attrindex.get_table_name(),)).fetchone()
+        self._index.add_attr(attrindex)
+
+        # index existing nodes the first time an attr is indexed
+        if not exists:
+            for nodeid, data in self._con.execute(
+                    "SELECT nodeid, attr FROM Nodes").fetchall():
+                attrindex.add_node(self._index.cur, nodeid, json.loads(data))
+        self._con.commit()
+
+    def _get_node_path_by_id(self, nodeid):
+        path = []
+        while nodeid is not None:
+            row = self._con.execute(
+                "SELECT parentid FROM Nodes WHERE nodeid=?",
+                (nodeid,)).fetchone()
+            if row is None:
+                break
+            path.append(nodeid)
+            nodeid = row[0]
+        path.reverse()
+        return path
+
+
+class NoteBookConnectionPack (BaseNoteBookConnectionPack):
+    """
+    NoteBook connection that stores a notebook in a single SQLite file
+
+    This connection enforces a schema where the following attr fields
+    are always present:
+      - nodeid
+      - version
+      - parentids
+      - childrenids
+    """
+
+    def _clean_attr(self, nodeid, attr):
+        """Ensure attributes follow the notebook schema"""
+        attr = dict(attr)
+        attr.setdefault("nodeid", nodeid)
+        attr.setdefault("version", keepnote.notebook.NOTEBOOK_FORMAT_VERSION)
+        attr.setdefault("parentids", [])
+        attr.setdefault("childrenids", [])
+        return attr
@@ -25,28 +25,115 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
 #
 
+# python imports
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
+# keepnote imports
+from keepnote.notebook.connection import ConnectionError
+from keepnote.notebook.connection import hash_attr
+from keepnote.notebook.connection import is_dir
 from keepnote.notebook.connection import NodeExists
+from keepnote.notebook.connection import NoteBookConnection
 from keepnote.notebook.connection import path_join
 from keepnote.notebook.connection import UnknownNode
 
 
+# default number of worker threads for parallel syncing
+SYNC_WORKERS = 4
+
+
+class SyncCanceled (ConnectionError):
+    def __init__(self, msg="sync canceled"):
+        ConnectionError.__init__(self, msg)
+
+
+#=============================================================================
+# manifests
+
+
+def get_manifest(conn, nodeid, attr=None):
+    """
+    Returns the manifest of node 'nodeid' in connection 'conn'
+
+    The connection is asked to build the manifest itself through the
+    "node_manifest" index query, so that remote connections can compute
+    file hashes on the server without transferring file contents.  If
+    'attr' is given, it overrides the stored attr when hashing.
+    """
+    try:
+        manifest = conn.index(["node_manifest", nodeid])
+    except NotImplementedError:
+        # the connection does not support the query
+        manifest = None
+
+    if manifest is None:
+        # fallback to computing the manifest on the client side
+        manifest = NoteBookConnection.get_node_manifest(conn, nodeid)
+
+    if attr is not None:
+        manifest["attr_hash"] = hash_attr(attr)
+    return manifest
+
+
+def manifests_equal(manifest1, manifest2):
+    """
+    Returns True if two manifests describe the same node contents
+
+    Sizes and mtimes are local to each connection and are not compared.
+    """
+    return (manifest1["attr_hash"] == manifest2["attr_hash"] and
+            get_manifest_files(manifest1) == get_manifest_files(manifest2))
+
+
+def get_manifest_files(manifest):
+    """Returns a dict of filename to content hash for a manifest"""
+    return dict((row[0], row[3]) for row in manifest["files"])
+
+
+def diff_manifest_files(manifest1, manifest2):
+    """
+    Returns the file changes needed to make manifest2 match manifest1
+
+    Returns (copies, deletes) where 'copies' is a list of filenames that
+    are new or changed in manifest1 and 'deletes' is a list of filenames
+    that only exist in manifest2.  Directories end with a '/'.
+    """
+    files1 = get_manifest_files(manifest1)
+    files2 = get_manifest_files(manifest2)
+
+    copies = [filename for filename, filehash in files1.items()
+              if filename not in files2 or files2[filename] != filehash]
+
+    # deleting a directory also deletes its contents
+    deletes = []
+    for filename in sorted(set(files2) - set(files1)):
+        if not any(filename.startswith(d) for d in deletes if is_dir(d)):
+            deletes.append(filename)
+
+    copies.sort()
+    return copies, deletes
+
+
 #=============================================================================
 # syncing
 
 
-def on_conflict_reject(nodeid, conn1, conn2, attr1=None, attr2=None):
+def on_conflict_reject(nodeid, conn1, conn2, attr1=None, attr2=None,
+                       manifest1=None, manifest2=None):
     """
     Existing node (conn2) always wins conflict
     """
     pass
 
 
-def on_conflict_newer(nodeid, conn1, conn2, attr1=None, attr2=None):
+def on_conflict_newer(nodeid, conn1, conn2, attr1=None, attr2=None,
+                      manifest1=None, manifest2=None):
     """
     Node with newer modified_time wins conflict
 
-    conn2 wins ties
+    conn2 wins ties.  If given, the manifests of both nodes are used to
+    copy the files of a winning conn1 node.
     """
     if attr1 is None:
         attr1 = conn1.read_node(nodeid)
@@ -56,10 +143,13 @@ def on_conflict_newer(nodeid, conn1, conn2, attr1=None, attr2=None):
         except UnknownNode:
             conn2.create_node(nodeid, attr1)
             sync_files(conn1, nodeid, conn2, nodeid)
+            return
 
     if attr1.get("modified_time", 0) > attr2.get("modified_time", 0):
-        conn2.update_node(nodeid, attr1)
-        sync_files(conn1, nodeid, conn2, nodeid)
+        if hash_attr(attr1) != hash_attr(attr2):
+            conn2.update_node(nodeid, attr1)
+        sync_files(conn1, nodeid, conn2, nodeid,
+                   manifest1=manifest1, manifest2=manifest2)
     else:
         # leave node in conn2 unchanged
         pass
@@ -83,38 +173,105 @@ def sync_node(nodeid, conn1, conn2, attr=None,
         on_conflict(nodeid, conn1, conn2, attr)
 
 
-def sync_files(conn1, nodeid1, conn2, nodeid2, path1="/", path2="/"):
-    """Sync files from conn1.nodeid1 to conn2.nodeid2"""
-    files = list(conn1.list_dir(nodeid1, path1))
+def sync_tree(nodeid, conn1, conn2, attr=None,
+              on_conflict=on_conflict_newer):
+    """
+    Sync the subtree rooted at 'nodeid' from connection 'conn1' to 'conn2'
+
+    Nodes whose attr and files already match in both connections are
+    skipped without reading or transferring any file contents.  Returns
+    a list of the nodeids that were new or differed between connections.
+    """
+    synced = []
+
+    def walk(nodeid, attr):
+        # children are always listed from the stored attr
+        stored_attr = conn1.read_node(nodeid)
+        if attr is None:
+            attr = stored_attr
+
+        if not conn2.has_node(nodeid):
+            conn2.create_node(nodeid, attr)
+            sync_files(conn1, nodeid, conn2, nodeid)
+            synced.append(nodeid)
+        else:
+            manifest1 = get_manifest(conn1, nodeid, attr)
+            manifest2 = get_manifest(conn2, nodeid)
+            if manifest1["attr_hash"] != manifest2["attr_hash"]:
+                # on_conflict decides which node wins, files included
+                attr2 = conn2.read_node(nodeid)
+                on_conflict(nodeid, conn1, conn2, attr, attr2,
+                            manifest1, manifest2)
+                synced.append(nodeid)
+            elif (get_manifest_files(manifest1) !=
+                    get_manifest_files(manifest2)):
+                # with identical attr, the files of conn1 are copied
+                sync_files(conn1, nodeid, conn2, nodeid,
+                           manifest1=manifest1, manifest2=manifest2)
+                synced.append(nodeid)
+
+        for childid in stored_attr.get("childrenids", ()):
+            walk(childid, None)
+
+    walk(nodeid, attr)
+    return synced
+
+
+def sync_files(conn1, nodeid1, conn2, nodeid2, path1="/", path2="/",
+               manifest1=None, manifest2=None):
+    """
+    Sync files from conn1.nodeid1 to conn2.nodeid2
+
+    Only files whose content hash differs are copied.  Returns the list
+    of filenames (relative to path2) that were copied.
+    """
+    if manifest1 is None:
+        manifest1 = get_manifest(conn1, nodeid1)
+    if manifest2 is None:
+        manifest2 = get_manifest(conn2, nodeid2)
+
+    # restrict manifests to the requested paths
+    prefix1 = "" if path1 == "/" else path1
+    prefix2 = "" if path2 == "/" else path2
+    files1 = [[row[0][len(prefix1):]] + row[1:]
+              for row in manifest1["files"]
+              if row[0].startswith(prefix1) and row[0] != prefix1]
+    files2 = [[row[0][len(prefix2):]] + row[1:]
+              for row in manifest2["files"]
+              if row[0].startswith(prefix2) and row[0] != prefix2]
+    copies, deletes = diff_manifest_files({"files": files1},
+                                          {"files": files2})
 
     # ensure target path exists
     if not conn2.has_file(nodeid2, path2):
         conn2.create_dir(nodeid2, path2)
 
     # remove files in node2 that don't exist in node1
-    for f in list(conn2.list_dir(nodeid2, path2)):
-        f2 = path_join(path2, f)
-        if not conn1.has_file(nodeid1, f2):
-            conn2.delete_file(nodeid2, f2)
-
-    # copy files from node1 to node2
-    for f in files:
-        file1 = f
-        file2 = path_join(path2, f[len(path1):])
+    for f in deletes:
+        conn2.delete_file(nodeid2, path_join(path2, f))
 
-        if f.endswith("/"):
-            # recurse into directories
-            sync_files(conn1, nodeid1, conn2, nodeid2, file1, file2)
-            continue
+    # copy new or changed files from node1 to node2
+    for f in copies:
+        if is_dir(f):
+            conn2.create_dir(nodeid2, path_join(path2, f))
+        else:
+            copy_file(conn1, nodeid1, path_join(path1, f),
+                      conn2, nodeid2, path_join(path2, f))
 
-        copy_file(conn1, nodeid1, file1, conn2, nodeid2, file2)
+    return copies
 
 
 def copy_file(conn1, nodeid1, file1, conn2, nodeid2, file2):
     """Copy a file from conn1.nodeid1.file1 to conn2.nodeid2.file2"""
 
-    stream1 = conn1.open_file(nodeid1, file1, "r")
-    stream2 = conn2.open_file(nodeid2, file2, "w")
+    # let a connection copy its own files, e.g. by sharing stored blobs
+    if conn1 is conn2:
+        conn1.copy_file(nodeid1, file1, nodeid2, file2)
+        return
+
+    # copy bytes so that binary files such as images survive unchanged
+    stream1 = conn1.open_file(nodeid1, file1, "rb")
+    stream2 = conn2.open_file(nodeid2, file2, "wb")
 
     while True:
         data = stream1.read(1024*4)
@@ -124,3 +281,209 @@ def copy_file(conn1, nodeid1, file1, conn2, nodeid2, file2):
 
     stream1.close()
     stream2.close()
+
+
+#=============================================================================
+# parallel syncing
+
+
+class SyncScheduler (object):
+    """
+    Syncs many nodes from 'conn1' to 'conn2' using a pool of worker threads
+
+    Node creation and attr updates happen on the calling thread in
+    topological order (parents before children), while the files of
+    independent nodes are copied concurrently by the workers.
+
+    connect -- function(conn) returning a new connection to the same
+               notebook as 'conn'.  Each worker thread uses its own pair
+               of connections.  If None, connections that define clone()
+               are cloned and all others are shared.  Access to shared
+               connections is serialized.
+
+    Notebook directories (NoteBookConnectionFS) cannot be cloned, since
+    their index allows only one writer, so files are copied between them
+    one node at a time.  The workers only overlap transfers when both
+    connections can be cloned, as with HTTP connections.
+
+    If the sync is canceled, the nodes it created are removed again.
+    """
+
+    def __init__(self, conn1, conn2, nworkers=SYNC_WORKERS, connect=None,
+                 on_conflict=on_conflict_newer):
+        self._conn1 = conn1
+        self._conn2 = conn2
+        self._nworkers = nworkers
+        self._connect = connect
+        self._on_conflict = on_conflict
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shared_lock = threading.RLock()
+        self._worker_conns = []
+
+    def _get_worker_conns(self):
+        """Returns the connections of the current worker thread"""
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = (self._new_conn(self._conn1),
+                                         self._new_conn(self._conn2))
+            with self._lock:
+                self._worker_conns.extend(
+                    conn for conn, orig in zip(
+                        conns, (self._conn1, self._conn2))
+                    if conn is not orig)
+        return conns
+
+    def _new_conn(self, conn):
+        if self._connect:
+            return self._connect(conn)
+        elif hasattr(conn, "clone"):
+            return conn.clone()
+        else:
+            return conn
+
+    def _close_worker_conns(self):
+        for conn in self._worker_conns:
+            conn.close()
+        self._worker_conns = []
+
+    def sync_tree(self, nodeid, attr=None, task=None):
+        """
+        Sync the subtree rooted at 'nodeid'
+
+        If given, 'attr' overrides the stored attr of the root node.
+        """
+        def walk(nodeid, attr):
+            stored_attr = self._conn1.read_node(nodeid)
+            yield nodeid, (stored_attr if attr is None else attr)
+            for childid in stored_attr.get("childrenids", ()):
+                for item in walk(childid, None):
+                    yield item
+
+        return self.sync_nodes(list(walk(nodeid, attr)), task=task)
+
+    def sync_nodes(self, nodes, task=None):
+        """
+        Sync a list of (nodeid, attr) pairs given in topological order
+
+        Progress and cancellation are reported through 'task', a
+        tasklib.Task.  Returns the list of nodeids that were synced.
+        """
+        nodes = list(nodes)
+        nnodes = max(len(nodes), 1)
+        ndone = [0]
+        synced = []
+
+        def on_done(nodeid):
+            with self._lock:
+                ndone[0] += 1
+                synced.append(nodeid)
+                percent = ndone[0] / float(nnodes)
+            if task:
+                task.set_percent(percent)
+
+        def copy_files(nodeid):
+            if task and task.aborted():
+                raise SyncCanceled()
+            conn1, conn2 = self._get_worker_conns()
+            if conn1 is self._conn1 or conn2 is self._conn2:
+                with self._shared_lock:
+                    sync_files(conn1, nodeid, conn2, nodeid)
+            else:
+                sync_files(conn1, nodeid, conn2, nodeid)
+            on_done(nodeid)
+
+        if task:
+            task.set_message(("text", "Syncing %d notes..." % len(nodes)))
+
+        pool = ThreadPoolExecutor(max_workers=self._nworkers)
+        futures = []
+        created_nodes = []
+        try:
+            for nodeid, attr in nodes:
+                if task and task.aborted():
+                    raise SyncCanceled()
+                if task:
+                    task.set_message(("detail", attr.get("title", "")))
+
+                with self._shared_lock:
+                    try:
+                        self._conn2.create_node(nodeid, attr)
+                        created = True
+                    except NodeExists:
+                        # conflicts are resolved on this thread since they
+                        # may move node directories
+                        self._on_conflict(nodeid, self._conn1, self._conn2,
+                                          attr)
+                        created = False
+
+                if created:
+                    created_nodes.append(nodeid)
+                    futures.append(pool.submit(copy_files, nodeid))
+                else:
+                    on_done(nodeid)
+
+            # wait for file transfers and raise the first error
+            for future in futures:
+                future.result()
+
+        except SyncCanceled:
+            # do not leave nodes without their files behind
+            pool.shutdown(wait=True, cancel_futures=True)
+            self._remove_nodes(created_nodes)
+            raise
+
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            self._close_worker_conns()
+
+        if task:
+            task.set_message(("detail", ""))
+
+        return synced
+
+    def _remove_nodes(self, nodeids):
+        """Remove nodes created in 'conn2', children first"""
+        for nodeid in reversed(nodeids):
+            with self._shared_lock:
+                try:
+                    self._conn2.delete_node(nodeid)
+                except UnknownNode:
+                    pass
+
+
+#=============================================================================
+# whole notebooks
+
+
+# notebook meta directories of the root node that are copied with a notebook
+NOTEBOOK_META_DIRS = ("__NOTEBOOK__/icons/",)
+
+
+def copy_dir_files(conn1, nodeid1, conn2, nodeid2, path):
+    """Copy a node directory that is not part of the node manifest"""
+    if not conn1.has_file(nodeid1, path):
+        return
+    conn2.create_dir(nodeid2, path)
+    for filename in conn1.list_dir(nodeid1, path):
+        if is_dir(filename):
+            copy_dir_files(conn1, nodeid1, conn2, nodeid2, filename)
+        else:
+            copy_file(conn1, nodeid1, filename, conn2, nodeid2, filename)
+
+
+def copy_notebook(conn1, conn2, task=None, nworkers=SYNC_WORKERS,
+                  meta_dirs=NOTEBOOK_META_DIRS):
+    """
+    Copy a whole notebook from 'conn1' into 'conn2'
+
+    This converts notebooks between storage formats, e.g. from a notebook
+    directory into a single-file pack.  Returns the synced nodeids.
+    """
+    rootid = conn1.get_rootid()
+    synced = SyncScheduler(conn1, conn2, nworkers=nworkers).sync_tree(
+        rootid, task=task)
+    for path in meta_dirs:
+        copy_dir_files(conn1, rootid, conn2, rootid, path)
+    conn2.save()
+    return synced
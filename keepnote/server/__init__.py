@@ -26,19 +26,26 @@
 #
 
 # python imports
-from io import StringIO
+import codecs
 from http.client import BAD_REQUEST
 from http.client import FORBIDDEN
 from http.client import NOT_FOUND
-import json
+from http.client import NOT_MODIFIED
+import hashlib
+import html
+import itertools
 import mimetypes
 import os
+import socketserver
+import tempfile
 import urllib.request, urllib.parse, urllib.error
+import wsgiref.simple_server
 
 # bottle imports
 from . import bottle
 from .bottle import Bottle
 from .bottle import abort
+from .bottle import http_date
 from .bottle import request
 from .bottle import response
 from .bottle import static_file
@@ -48,6 +55,8 @@ from .bottle import template
 import keepnote
 from keepnote.notebook import new_nodeid
 import keepnote.notebook.connection as connlib
+from keepnote.notebook.connection import http_encoding
+from keepnote.notebook.connection.changes import ChangeLogConnection
 
 # Server directories.
 BASE_DIR = os.path.dirname(__file__)
@@ -55,6 +64,22 @@ STATIC_DIR = os.path.join(BASE_DIR, 'static')
 TEMPLATES_DIR = os.path.join(BASE_DIR, 'templates')
 
 
+# Size of chunks used when streaming file contents.
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Compressed responses up to this size are sent with a Content-Length.
+MAX_BUFFERED_COMPRESS_SIZE = 1024 * 1024
+
+# Decompressed request bodies larger than this are spooled to disk.
+MAX_SPOOL_SIZE = 1024 * 1024
+
+# Longest time a change feed request waits for new changes.
+MAX_CHANGES_TIMEOUT = 60.0
+
+# Number of levels shown by default when rendering a node tree.
+DEFAULT_TREE_DEPTH = 3
+
+
 #=============================================================================
 # Node URL scheme
 
@@ -80,42 +105,288 @@ def format_node_url(host, prefix, nodeid, filename=None, port=80):
 # Notebook HTTP Server
 
 
-def write_node_tree(out, conn, nodeid=None):
-    if not nodeid:
-        nodeid = conn.get_rootid()
+def make_etag(data):
+    """Returns a strong ETag for a response body."""
+    return '"%s"' % hashlib.sha1(data).hexdigest()
+
+
+def make_file_etag(stat):
+    """Returns an ETag for a file derived from its size and mtime."""
+    return '"%x-%x"' % (stat.st_size, int(stat.st_mtime * 1000000))
+
 
-    attr = conn.read_node(nodeid)
+def etag_matches(header, etag):
+    """Returns True if an If-None-Match header matches an ETag."""
+    if not header:
+        return False
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag or tag == "*":
+            return True
+    return False
 
-    # TODO: needs escape
-    if attr.get("content_type", "") == "text/xhtml+xml":
-        url = format_node_path("", nodeid, "page.html")
-    elif "payload_filename" in attr:
-        url = format_node_path("", nodeid,
-                               attr["payload_filename"])
+
+def iter_file(stream, chunk_size=FILE_CHUNK_SIZE):
+    """
+    Iterate through the contents of a file stream in chunks.
+
+    The stream is closed once iteration finishes.
+    """
+    try:
+        while True:
+            data = stream.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        stream.close()
+
+
+def copy_body(body, stream, chunk_size=FILE_CHUNK_SIZE):
+    """
+    Copy a request body into a node file stream in chunks.
+
+    Text-mode streams receive utf8 decoded data.
+    """
+    decoder = None
+    while True:
+        data = body.read(chunk_size)
+        if not data:
+            break
+        if decoder:
+            stream.write(decoder.decode(data))
+            continue
+        try:
+            stream.write(data)
+        except TypeError:
+            decoder = codecs.getincrementaldecoder("utf8")()
+            stream.write(decoder.decode(data))
+    if decoder:
+        stream.write(decoder.decode(b"", final=True))
+
+
+def get_tree_row_url(row):
+    """Returns the url of a node in a tree relative to the node prefix."""
+    if row["content_type"] == "text/xhtml+xml":
+        return format_node_path("", row["nodeid"], "page.html")
     else:
-        url = format_node_path("", nodeid, "")
-    out.write(
-        "<a href='%s'>%s</a>" % (
-            url, attr.get("title", "page").encode("utf8")))
-    out.write("<ul>")
+        return format_node_path("", row["nodeid"], "")
 
-    for childid in attr.get("childrenids", ()):
-        out.write("<li>")
-        write_node_tree(out, conn, childid)
-        out.write("</li>")
 
+def iter_node_tree(rows):
+    """
+    Iterate through the HTML of a node tree in chunks.
+
+    'rows' are node tree rows in preorder (see conn.get_node_tree()).
+    Nodes whose children were cut off by the depth limit link to their
+    own tree, so that large notebooks can be browsed a level at a time.
+    """
+    top = prev = None
+    for row in rows:
+        if prev is not None:
+            yield close_tree_row(prev, row["depth"])
+        else:
+            top = row["depth"]
+        prev = row
+        yield "<li><a href='%s'>%s</a>" % (
+            html.escape(get_tree_row_url(row)),
+            html.escape(row["title"] or "page"))
+
+    if prev is not None:
+        yield close_tree_row(prev, top)
+
+
+def close_tree_row(row, depth):
+    """Returns the HTML that follows a tree row given the next depth."""
+    if depth > row["depth"]:
+        return "<ul>"
+    chunk = ""
+    if row["has_children"]:
+        chunk += " <a href='%s?all'>...</a>" % html.escape(
+            format_node_path("", row["nodeid"]))
+    return chunk + "</li>" + "</ul></li>" * (row["depth"] - depth)
+
+
+def write_node_tree(out, conn, nodeid=None, depth=None):
+    """Write the HTML of the tree under a node to a text stream."""
+    if not nodeid:
+        nodeid = conn.get_rootid()
+    out.write("<ul>")
+    for chunk in iter_node_tree(conn.get_node_tree(nodeid, depth)):
+        out.write(chunk)
     out.write("</ul>")
 
 
+#=============================================================================
+# Content encoding
+
+class CompressionMiddleware(object):
+    """
+    WSGI middleware for compressed request and response bodies.
+
+    Responses are compressed with the best encoding the client accepts.
+    Request bodies with a Content-Encoding are decompressed before they
+    reach the app.  Every response advertises the accepted encodings, so
+    clients know they may compress their requests.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING')
+        if encoding:
+            try:
+                self.decompress_body(environ, encoding)
+            except (ValueError, IOError) as e:
+                accept = http_encoding.format_accept_encoding()
+                start_response('415 Unsupported Media Type', [
+                    ('Content-Type', 'text/plain'),
+                    ('Accept-Encoding', accept),
+                ])
+                return [str(e).encode('utf8')]
+
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+
+        result = self.app(environ, capture)
+        status, headers, exc_info = captured
+        headers = [(key, value) for key, value in headers
+                   if key.lower() != 'accept-encoding']
+        headers.append(
+            ('Accept-Encoding', http_encoding.format_accept_encoding()))
+
+        encoding = self.get_response_encoding(environ, status, headers)
+        if not encoding:
+            start_response(status, headers, exc_info)
+            return result
+
+        headers = self.set_encoding_headers(headers, encoding)
+        length = get_header(headers, 'Content-Length')
+        if length is not None and int(length) <= MAX_BUFFERED_COMPRESS_SIZE:
+            # Compress small bodies at once, keeping a Content-Length.
+            compressor = http_encoding.Compressor(encoding)
+            try:
+                data = [compressor.compress(chunk) for chunk in result]
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            data.append(compressor.flush())
+            data = b''.join(data)
+            headers = [(key, value) for key, value in headers
+                       if key.lower() != 'content-length']
+            headers.append(('Content-Length', str(len(data))))
+            start_response(status, headers, exc_info)
+            return [data]
+
+        headers = [(key, value) for key, value in headers
+                   if key.lower() != 'content-length']
+        start_response(status, headers, exc_info)
+        return self.iter_compress(result, encoding)
+
+    def get_response_encoding(self, environ, status, headers):
+        """Returns the encoding for a response or None."""
+        if (environ.get('REQUEST_METHOD') == 'HEAD' or
+                not status.startswith('200') or
+                get_header(headers, 'Content-Encoding') or
+                not http_encoding.is_compressible(
+                    get_header(headers, 'Content-Type'))):
+            return None
+        length = get_header(headers, 'Content-Length')
+        if (length is not None and
+                int(length) < http_encoding.MIN_COMPRESS_SIZE):
+            return None
+        return http_encoding.choose_encoding(
+            environ.get('HTTP_ACCEPT_ENCODING'))
+
+    def set_encoding_headers(self, headers, encoding):
+        """Returns response headers for an encoded body."""
+        result = []
+        for key, value in headers:
+            if key.lower() == 'etag' and not value.startswith('W/'):
+                # The encoded body is not byte-identical to the resource.
+                value = 'W/' + value
+            elif key.lower() == 'vary':
+                continue
+            result.append((key, value))
+        result.append(('Content-Encoding', encoding))
+        result.append(('Vary', 'Accept-Encoding'))
+        return result
+
+    def iter_compress(self, result, encoding):
+        """Compress a response body as it is iterated."""
+        compressor = http_encoding.Compressor(encoding)
+        try:
+            for chunk in result:
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    def decompress_body(self, environ, encoding):
+        """Replace a compressed request body with its decompressed data."""
+        decompressor = http_encoding.Decompressor(encoding)
+        infile = environ['wsgi.input']
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = tempfile.SpooledTemporaryFile(max_size=MAX_SPOOL_SIZE)
+        while length > 0:
+            data = infile.read(min(length, FILE_CHUNK_SIZE))
+            if not data:
+                break
+            length -= len(data)
+            body.write(decompressor.decompress(data))
+        body.write(decompressor.flush())
+
+        environ['CONTENT_LENGTH'] = str(body.tell())
+        body.seek(0)
+        environ['wsgi.input'] = body
+        del environ['HTTP_CONTENT_ENCODING']
+
+
+def get_header(headers, name):
+    """Returns the value of a header in a WSGI header list or None."""
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+#=============================================================================
+# Notebook server
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn,
+                          wsgiref.simple_server.WSGIServer):
+    """A WSGI server that handles each request in a new thread."""
+    daemon_threads = True
+
+
 class BaseNoteBookHttpServer(object):
+    """
+    Serve a notebook connection over HTTP.
+
+    If 'threaded' is True, requests are handled concurrently.  The
+    connection is always accessed through a ChangeLogConnection, so that
+    reads may run in parallel while writes are exclusive, and every
+    change is published on the change feed.
+    """
 
-    def __init__(self, conn, host="", port=8000):
-        self.conn = conn
+    def __init__(self, conn, host="", port=8000, threaded=False):
+        self.conn = ChangeLogConnection(conn)
         self.host = host
         self.port = port
+        self.threaded = threaded
         self.notebook_prefixes = ['notebook/']
 
         self.app = Bottle()
+        self.wsgi_app = CompressionMiddleware(self.app)
         self.server = None
 
         # Setup web app routes.
@@ -126,12 +397,14 @@ class BaseNoteBookHttpServer(object):
         # Notebook node routes.
         self.app.post('/notebook/',
                       callback=self.command_view)
+        self.app.get('/notebook/changes',
+                     callback=self.changes_view)
         self.app.get('/notebook/nodes/',
                      callback=self.read_root_view)
         self.app.get('/notebook/nodes/<nodeid:re:[^/]+>',
                      callback=self.read_node_view)
         self.app.post('/notebook/nodes/',
-                      callback=self.create_node_view)
+                      callback=self.post_nodes_view)
         self.app.post('/notebook/nodes/<nodeid:re:[^/]+>',
                       callback=self.create_node_view)
         self.app.put('/notebook/nodes/<nodeid:re:[^/]+>',
@@ -160,10 +433,13 @@ class BaseNoteBookHttpServer(object):
         if os.environ.get("KEEPNOTE_DEBUG"):
             debug = True
 
+        options = {}
+        if self.threaded:
+            options['server_class'] = ThreadingWSGIServer
         self.server = bottle.WSGIRefServer(
-            host=self.host, port=self.port, debug=debug)
-        self.app.run(
-            host=self.host, port=self.port, server=self.server,
+            host=self.host, port=self.port, debug=debug, **options)
+        bottle.run(
+            self.wsgi_app, host=self.host, port=self.port, server=self.server,
             debug=debug, reloader=debug)
 
     def shutdown(self):
@@ -175,10 +451,41 @@ class BaseNoteBookHttpServer(object):
 
     def json_response(self, data):
         """
-        Return a JSON response.
+        Return an attr data response.
+
+        Data is JSON encoded unless the client accepts msgpack.
+        """
+        content_type = http_encoding.choose_data_type(
+            request.get_header('Accept'))
+        response.content_type = content_type
+        return http_encoding.dumps_data(data, content_type)
+
+    def read_request_data(self):
+        """
+        Return the attr data of the request body.
+        """
+        try:
+            return http_encoding.loads_data(
+                request.body.read(), request.content_type)
+        except ValueError as e:
+            abort(BAD_REQUEST, 'Invalid request data ' + str(e))
+
+    def cached_json_response(self, data, mtime=None):
         """
-        response.content_type = 'application/json'
-        return json.dumps(data).encode('utf8')
+        Return a JSON response with an ETag.
+
+        An empty 304 response is returned if the client already has the
+        current version.
+        """
+        body = self.json_response(data)
+        etag = make_etag(body)
+        response.set_header('ETag', etag)
+        if mtime is not None:
+            response.set_header('Last-Modified', http_date(mtime))
+        if etag_matches(request.get_header('If-None-Match'), etag):
+            response.status = NOT_MODIFIED
+            return b''
+        return body
 
     def home_view(self):
         """
@@ -197,8 +504,7 @@ class BaseNoteBookHttpServer(object):
 
         elif 'index' in request.query:
             # Query notebook index.
-            data = request.body.read()
-            query = json.loads(data)
+            query = self.read_request_data()
             result = self.conn.index(query)
 
             # Build list if needed.
@@ -207,6 +513,25 @@ class BaseNoteBookHttpServer(object):
 
             return self.json_response(result)
 
+    def changes_view(self):
+        """
+        Return notebook changes after sequence number 'since'.
+
+        With 'timeout', the request long-polls until a change occurs.
+        Long-polling is only supported by the threaded server.
+        """
+        try:
+            since = int(request.query.get('since', 0))
+            timeout = float(request.query.get('timeout', 0))
+        except ValueError:
+            abort(BAD_REQUEST, 'Invalid change feed query')
+
+        if not self.threaded:
+            timeout = 0
+        timeout = max(0, min(timeout, MAX_CHANGES_TIMEOUT))
+        return self.json_response(
+            self.conn.changes.get_changes(since, timeout))
+
     def read_root_view(self):
         """
         Return notebook root nodeid.
@@ -217,12 +542,21 @@ class BaseNoteBookHttpServer(object):
         }
         return self.json_response(result)
 
-    def render_node_tree(self, nodeid):
-        body = StringIO()
-        body.write("<html><body>")
-        write_node_tree(body, self.conn, nodeid)
-        body.write("</body></html>")
-        return body.getvalue()
+    def get_tree_depth(self, default):
+        """Returns the depth limit of a tree request."""
+        try:
+            return max(0, int(request.query.get('depth', default)))
+        except ValueError:
+            abort(BAD_REQUEST, 'depth must be an integer')
+
+    def render_node_tree(self, nodeid, depth=None):
+        """Returns an iterator of the HTML of the tree under a node."""
+        rows = self.conn.get_node_tree(nodeid, depth)
+        if not rows:
+            abort(NOT_FOUND, 'node not found ' + nodeid)
+
+        return itertools.chain(["<html><body><ul>"], iter_node_tree(rows),
+                               ["</ul></body></html>"])
 
     def read_node_view(self, nodeid):
         """
@@ -232,8 +566,20 @@ class BaseNoteBookHttpServer(object):
 
         if 'all' in request.query:
             # Render a simple tree
-            response.content_type = 'text/html'
-            return self.render_node_tree(nodeid)
+            depth = self.get_tree_depth(DEFAULT_TREE_DEPTH)
+            body = self.render_node_tree(nodeid, depth)
+            response.content_type = 'text/html; charset=utf-8'
+            return body
+
+        if 'tree' in request.query:
+            # Return the tree rows used for lazily expanding a tree.
+            depth = self.get_tree_depth(1)
+            rows = self.conn.get_node_tree(nodeid, depth)
+            if not rows:
+                abort(NOT_FOUND, 'node not found ' + nodeid)
+            for row in rows:
+                row['url'] = get_tree_row_url(row)
+            return self.json_response({'nodes': rows})
 
         try:
             # return node attr
@@ -241,12 +587,44 @@ class BaseNoteBookHttpServer(object):
             if attr.get("parentids") == [None]:
                 del attr["parentids"]
 
-            return self.json_response(attr)
+            mtime = attr.get("modified_time")
+            if not isinstance(mtime, (int, float)):
+                mtime = None
+            return self.cached_json_response(attr, mtime)
 
         except connlib.UnknownNode as e:
             keepnote.log_error()
             abort(NOT_FOUND, 'node not found ' + str(e))
 
+    def read_nodes_view(self):
+        """
+        Read the attrs of several notebook nodes.
+
+        The request body is a list of nodeids.  Unknown nodes are returned
+        as null.
+        """
+        nodeids = self.read_request_data()
+        if not isinstance(nodeids, list):
+            abort(BAD_REQUEST, 'batch read expects a list of nodeids')
+
+        attrs = self.conn.read_nodes(nodeids)
+        for attr in attrs:
+            if attr is not None and attr.get("parentids") == [None]:
+                del attr["parentids"]
+
+        return self.json_response({
+            'nodes': attrs,
+        })
+
+    def post_nodes_view(self):
+        """
+        Create a new notebook node or batch read nodes.
+        """
+        if 'batch' in request.query:
+            return self.read_nodes_view()
+        else:
+            return self.create_node_view()
+
     def create_node_view(self, nodeid=None):
         """
         Create new notebook node.
@@ -256,8 +634,7 @@ class BaseNoteBookHttpServer(object):
         else:
             nodeid = new_nodeid()
 
-        data = request.body.read()
-        attr = json.loads(data)
+        attr = self.read_request_data()
 
         try:
             self.conn.create_node(nodeid, attr)
@@ -272,8 +649,7 @@ class BaseNoteBookHttpServer(object):
         nodeid = urllib.parse.unquote(nodeid)
 
         # update node
-        data = request.body.read()
-        attr = json.loads(data)
+        attr = self.read_request_data()
 
         try:
             self.conn.update_node(nodeid, attr)
@@ -314,19 +690,37 @@ class BaseNoteBookHttpServer(object):
             if filename.endswith("/"):
                 # list directory
                 files = list(self.conn.list_dir(nodeid, filename))
-                return self.json_response({
+                return self.cached_json_response({
                     'files': files,
                 })
 
             else:
                 # return node file
-                with self.conn.open_file(nodeid, filename) as stream:
-                    mime, encoding = mimetypes.guess_type(
-                        filename, strict=False)
-                    response.content_type = (mime if mime else default_mime)
-
-                    # TODO: return stream.
-                    return stream.read()
+                mime, encoding = mimetypes.guess_type(filename, strict=False)
+                mime = (mime if mime else default_mime)
+
+                # Local files are served directly, which supports Range,
+                # Content-Length and Last-Modified.
+                path = self._get_local_file(nodeid, filename)
+                if path:
+                    etag = make_file_etag(os.stat(path))
+                    if etag_matches(request.get_header('If-None-Match'),
+                                    etag):
+                        response.set_header('ETag', etag)
+                        response.status = NOT_MODIFIED
+                        return b''
+                    result = static_file(os.path.basename(path),
+                                         root=os.path.dirname(path),
+                                         mimetype=mime)
+                    result.set_header('ETag', etag)
+                    return result
+
+                response.content_type = mime
+                try:
+                    stream = self.conn.open_file(nodeid, filename, "rb")
+                except connlib.FileError:
+                    stream = self.conn.open_file(nodeid, filename, "r")
+                return iter_file(stream)
 
         except connlib.UnknownNode as e:
             keepnote.log_error()
@@ -354,14 +748,20 @@ class BaseNoteBookHttpServer(object):
         else:
             # Write file.
             try:
-                if request.query.get("mode", "w") == ["a"]:
+                if request.query.get("mode", "w") == "a":
                     if request.method == 'PUT':
                         abort(BAD_REQUEST, 'Invalid method for file append')
-                    stream = self.conn.open_file(nodeid, filename, "a")
+                    mode = "a"
                 else:
-                    stream = self.conn.open_file(nodeid, filename, "w")
-                stream.write(request.body.read())
-                stream.close()
+                    mode = "w"
+                try:
+                    stream = self.conn.open_file(nodeid, filename, mode + "b")
+                except connlib.FileError:
+                    stream = self.conn.open_file(nodeid, filename, mode)
+                try:
+                    copy_body(request.body, stream)
+                finally:
+                    stream.close()
 
             except connlib.UnknownNode as e:
                 keepnote.log_error()
@@ -401,6 +801,18 @@ class BaseNoteBookHttpServer(object):
         if not self.conn.has_file(nodeid, filename):
             abort(NOT_FOUND, 'file not found')
 
+    def _get_local_file(self, nodeid, filename):
+        """
+        Returns the local path of a node file or None if not available.
+        """
+        try:
+            path = self.conn.get_local_file(nodeid, filename)
+        except (NotImplementedError, connlib.ConnectionError):
+            return None
+        if path and os.path.isfile(path):
+            return path
+        return None
+
     # get static files
     def static_file_view(self, filename):
         return static_file(filename, root=STATIC_DIR)
@@ -417,8 +829,7 @@ class NoteBookHttpServer(BaseNoteBookHttpServer):
         else:
             nodeid = new_nodeid()
 
-        data = request.body.read()
-        attr = json.loads(data)
+        attr = self.read_request_data()
 
         # Enforce notebook scheme, nodeid is required.
         attr['nodeid'] = nodeid
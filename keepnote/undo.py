@@ -29,29 +29,66 @@ import sys
 from keepnote.linked_list import LinkedList
 
 
-def cat_funcs(funcs):
-    """Concatenate a list of functions [f,g,h,...] that take no arguments
-       into one function: cat = { lambda: f(); g(); h(); }
-    """
+# approximate memory (bytes) of an undo action, not counting its data
+ACTION_SIZE = 200
 
-    funcs = list(funcs)
 
-    if len(funcs) == 1:
-        return funcs[0]
+class UndoAction (object):
+    """An action on the UndoStack"""
 
-    def f():
-        for func in funcs:
-            func()
-    return f
+    def do(self):
+        """Perform (or redo) the action"""
+        pass
+
+    def undo(self):
+        """Undo the action"""
+        pass
+
+    def get_size(self):
+        """Returns the approximate memory used by the action in bytes"""
+        return ACTION_SIZE
+
+    def can_merge(self, action):
+        """Returns True if 'action' directly continues this action"""
+        return False
+
+    def merge(self, action):
+        """
+        Extend this action with 'action'
+
+        Only called when can_merge(action) is True, so actions that never
+        merge need not override it.
+        """
+        pass
+
+
+class FuncAction (UndoAction):
+    """An action given as a pair of functions"""
+
+    def __init__(self, action, undo, size=ACTION_SIZE):
+        self.do = action
+        self.undo = undo
+        self._size = size
+
+    def get_size(self):
+        return self._size
+
+
+def get_actions_size(actions):
+    """Returns the memory used by a group of actions"""
+    return sum(action.get_size() for action in actions)
 
 
 class UndoStack (object):
     """UndoStack for maintaining undo and redo actions"""
 
-    def __init__(self, maxsize=sys.maxsize):
-        """maxsize -- maximum size of undo list"""
+    def __init__(self, maxsize=sys.maxsize, max_memory=None):
+        """
+        maxsize    -- maximum size of undo list
+        max_memory -- maximum memory (bytes) of undo actions
+        """
 
-        # stacks maintaining (undo,redo) pairs
+        # stacks maintaining groups (lists) of actions
         self._undo_actions = LinkedList()
         self._redo_actions = []
 
@@ -64,63 +101,99 @@ class UndoStack (object):
 
         # maximum size undo stack
         self._maxsize = maxsize
+        self._max_memory = max_memory
+        self._memory = 0
+
+        # whether the last group may be extended by the next one
+        self._mergeable = False
 
         self._in_progress = False
 
     def do(self, action, undo, execute=True):
         """Perform action() (if execute=True) and place (action,undo) pair
            on stack"""
+        self.do_action(FuncAction(action, undo), execute)
+
+    def do_action(self, action, execute=True):
+        """Perform an UndoAction (if execute=True) and place it on stack"""
 
         if self._suppress_counter > 0:
             return
 
+        self._redo_actions = []
         if self._group_counter == 0:
-            # grouping is not active, push action pair and clear redo stack
-            self._undo_actions.append((action, undo))
-            self._redo_actions = []
+            # grouping is not active, push action
+            self._push([action])
 
             # TODO: should stack be suppressed at this time?
             if execute:
-                action()
-
-            # maintain proper undo size
-            while len(self._undo_actions) > self._maxsize:
-                self._undo_actions.pop_front()
+                action.do()
         else:
-            # grouping is active, place action pair on pending stack
-            self._pending_actions.append((action, undo))
-            self._redo_actions = []
+            # grouping is active, place action on pending stack
+            self._pending_actions.append(action)
             if execute:
-                action()
+                action.do()
+
+    def _push(self, actions):
+        """Push a group of actions, merging it into the last group if
+           possible"""
+        last = (self._undo_actions.get_tail().get_item()
+                if self._mergeable and len(self._undo_actions) > 0
+                else None)
+
+        if (last is not None and len(last) == len(actions) and
+                all(action1.can_merge(action2)
+                    for action1, action2 in zip(last, actions))):
+            self._memory -= get_actions_size(last)
+            for action1, action2 in zip(last, actions):
+                action1.merge(action2)
+            self._memory += get_actions_size(last)
+        else:
+            self._undo_actions.append(actions)
+            self._memory += get_actions_size(actions)
+        self._mergeable = True
+        self._trim()
+
+    def _trim(self):
+        """Maintain proper undo size, dropping oldest actions first"""
+        while (len(self._undo_actions) > self._maxsize or
+               (self._max_memory is not None and
+                self._memory > self._max_memory and
+                len(self._undo_actions) > 1)):
+            self._memory -= get_actions_size(self._undo_actions.pop_front())
 
     def undo(self):
         """Undo last action on stack"""
         assert self._group_counter == 0
 
         if len(self._undo_actions) > 0:
-            action, undo = self._undo_actions.pop()
+            actions = self._undo_actions.pop()
+            self._memory -= get_actions_size(actions)
+            self._mergeable = False
             self.suppress()
             self._in_progress = True
-            undo()
+            for action in reversed(actions):
+                action.undo()
             self._in_progress = False
             self.resume()
-            self._redo_actions.append((action, undo))
+            self._redo_actions.append(actions)
 
     def redo(self):
         """Redo last action on stack"""
         assert self._group_counter == 0
 
         if len(self._redo_actions) > 0:
-            action, undo = self._redo_actions.pop()
+            actions = self._redo_actions.pop()
+            self._mergeable = False
             self.suppress()
             self._in_progress = True
-            action()
+            for action in actions:
+                action.do()
             self._in_progress = False
             self.resume()
-            self._undo_actions.append((action, undo))
-
-            while len(self._undo_actions) > self._maxsize:
-                self._undo_actions.pop_front()
+            self._undo_actions.append(actions)
+            self._memory += get_actions_size(actions)
+            self._trim()
 
     def begin_action(self):
         """
@@ -138,14 +211,9 @@ class UndoStack (object):
 
         if self._group_counter == 0:
             if len(self._pending_actions) > 0:
-                actions, undos = list(zip(*self._pending_actions))
-
-                self._undo_actions.append((cat_funcs(actions),
-                                           cat_funcs(reversed(undos))))
+                actions = self._pending_actions
                 self._pending_actions = []
-
-                while len(self._undo_actions) > self._maxsize:
-                    self._undo_actions.pop_front()
+                self._push(actions)
 
     def abort_action(self):
         """
@@ -178,7 +246,22 @@ class UndoStack (object):
         self._group_counter = 0
         self._pending_actions = []
         self._suppress_counter = 0
+        self._memory = 0
+        self._mergeable = False
 
     def is_in_progress(self):
         """Returns True if undo or redo is in progress"""
         return self._in_progress
+
+    def set_max_memory(self, max_memory):
+        """Sets the maximum memory (bytes) of undo actions (None for no
+           limit)"""
+        self._max_memory = max_memory
+        self._trim()
+
+    def get_memory(self):
+        """Returns the approximate memory (bytes) of the undo actions"""
+        return self._memory
+
+    def __len__(self):
+        return len(self._undo_actions)
@@ -0,0 +1,102 @@
+
+# python imports
+import unittest
+
+# keepnote imports
+from keepnote.cache import LRUDict
+from keepnote.notebook.connection import caching
+from keepnote.notebook.connection import fs_raw
+from keepnote.notebook.connection import mem
+
+from .test_notebook_conn import TestConnBase
+from . import make_clean_dir, TMP_DIR
+
+
+class LRU (unittest.TestCase):
+
+    def test_lru_dict(self):
+        """Least recently used items are evicted."""
+        cache = LRUDict(3)
+        for i in range(4):
+            cache[i] = i
+        self.assertEqual(list(cache), [1, 2, 3])
+
+        # Reads update recency.
+        self.assertEqual(cache[1], 1)
+        self.assertEqual(cache.get(2), 2)
+        cache[4] = 4
+        self.assertEqual(list(cache), [1, 2, 4])
+        self.assertEqual(cache.get(3, 'missing'), 'missing')
+
+
+class Caching (TestConnBase):
+
+    def test_api(self):
+        filename = TMP_DIR + '/notebook_caching/n1'
+        make_clean_dir(TMP_DIR + '/notebook_caching')
+
+        conn = caching.CachingConnection(fs_raw.NoteBookConnectionFSRaw())
+        conn.connect(filename)
+        self._test_api(conn)
+        conn.close()
+
+    def test_notebook(self):
+        conn = caching.CachingConnection(mem.NoteBookConnectionMem())
+        self._test_notebook(conn, 'n2')
+
+    def test_invalidate(self):
+        """Writes invalidate cached reads."""
+        inner = mem.NoteBookConnectionMem()
+        conn = caching.CachingConnection(inner, max_file_size=10)
+        conn.create_node('node1', {'nodeid': 'node1', 'title': 'a'})
+
+        # Cached attrs are not changed by callers.
+        conn.read_node('node1')['title'] = 'changed'
+        self.assertEqual(conn.read_node('node1')['title'], 'a')
+        conn.update_node('node1', {'nodeid': 'node1', 'title': 'b'})
+        self.assertEqual(conn.read_node('node1')['title'], 'b')
+
+        with conn.open_file('node1', 'small', 'w') as out:
+            out.write('hello')
+        self.assertEqual(conn.open_file('node1', 'small').read(), 'hello')
+        self.assertEqual(conn.open_file('node1', 'small').read(), 'hello')
+        with conn.open_file('node1', 'small', 'w') as out:
+            out.write('bye')
+        self.assertEqual(conn.open_file('node1', 'small').read(), 'bye')
+        self.assertEqual(list(conn.list_dir('node1')), ['small'])
+
+        # Large files are read through without caching.
+        with conn.open_file('node1', 'large', 'wb') as out:
+            out.write(b'x' * 100)
+        self.assertEqual(conn.open_file('node1', 'large', 'rb').read(),
+                         b'x' * 100)
+        self.assertEqual(sorted(conn.list_dir('node1')), ['large', 'small'])
+
+        conn.delete_file('node1', 'small')
+        self.assertFalse(conn.has_file('node1', 'small'))
+        conn.delete_node('node1')
+        self.assertFalse(conn.has_node('node1'))
+
+        stats = conn.get_cache_stats()
+        self.assertEqual(stats['nodes']['hits'], 1)
+        self.assertEqual(stats['files']['hits'], 1)
+        self.assertEqual(stats['files']['entries'], 0)
+
+    def test_concurrent_write(self):
+        """Reads racing a write are not cached."""
+        inner = mem.NoteBookConnectionMem()
+        conn = caching.CachingConnection(inner)
+        conn.create_node('node1', {'nodeid': 'node1', 'title': 'a'})
+
+        # Update the node while its old attrs are being read.
+        read_node = inner.read_node
+
+        def racing_read_node(nodeid):
+            attr = read_node(nodeid)
+            inner.read_node = read_node
+            conn.update_node('node1', {'nodeid': 'node1', 'title': 'b'})
+            return attr
+        inner.read_node = racing_read_node
+
+        self.assertEqual(conn.read_node('node1')['title'], 'a')
+        self.assertEqual(conn.read_node('node1')['title'], 'b')
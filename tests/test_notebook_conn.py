@@ -32,6 +32,7 @@ class TestConnBase (unittest.TestCase):
         self._test_update_node(conn)
         self._test_delete_node(conn)
         self._test_unknown_node(conn)
+        self._test_read_nodes(conn)
 
     def _test_create_read_node(self, conn):
 
@@ -121,6 +122,17 @@ class TestConnBase (unittest.TestCase):
         self.assertRaises(connlib.UnknownNode,
                           lambda: conn.delete_node('unknown_node'))
 
+    def _test_read_nodes(self, conn):
+        # Create nodes.
+        attrs = [{'key1': i, 'title': 'batch%d' % i} for i in range(3)]
+        for i, attr in enumerate(attrs):
+            conn.create_node('batch%d' % i, attr)
+
+        # Batch read should keep order and return None for unknown nodes.
+        attrs2 = conn.read_nodes(['batch2', 'unknown_node', 'batch0'])
+        self.assertEqual(attrs2, [attrs[2], None, attrs[0]])
+        self.assertEqual(conn.read_nodes([]), [])
+
     def _test_files(self, conn):
 
         # Create empty node.
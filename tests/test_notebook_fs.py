@@ -6,6 +6,7 @@ import os
 from keepnote.notebook import NOTEBOOK_FORMAT_VERSION
 import keepnote.notebook.connection as connlib
 from keepnote.notebook.connection import fs
+from keepnote.notebook.connection.fs import blobs as blobslib
 
 from .test_notebook_conn import TestConnBase
 from . import clean_dir
@@ -197,3 +198,170 @@ class TestConnFS (TestConnBase):
 
         # Clean up.
         conn.close()
+
+    def test_file_hashes(self):
+        """File hashes should be kept in the index across connections."""
+        notebook_file = _tmpdir + '/notebook_hashes'
+        clean_dir(notebook_file)
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        rootid = conn.create_node(None, {})
+        nodeid = conn.create_node(None, {'parentids': [rootid]})
+        with conn.open_file(nodeid, 'file.txt', 'w') as out:
+            out.write('hello')
+        manifest = conn.get_node_manifest(nodeid)
+        conn.close()
+
+        hashed = []
+        hash_stream = connlib.hash_stream
+
+        def count_hash(stream):
+            hashed.append(stream)
+            return hash_stream(stream)
+        connlib.hash_stream = count_hash
+        try:
+            conn = fs.NoteBookConnectionFS()
+            conn.connect(notebook_file)
+            self.assertEqual(conn.get_node_manifest(nodeid), manifest)
+            self.assertEqual(hashed, [])
+
+            # Changed and deleted files are hashed again.
+            with conn.open_file(nodeid, 'file.txt', 'w') as out:
+                out.write('changed')
+            self.assertNotEqual(conn.get_node_manifest(nodeid), manifest)
+            self.assertEqual(len(hashed), 1)
+            conn.delete_file(nodeid, 'file.txt')
+            self.assertEqual(conn._index.con.execute(
+                "SELECT COUNT(*) FROM FileHashes WHERE nodeid=?",
+                (nodeid,)).fetchone()[0], 0)
+        finally:
+            connlib.hash_stream = hash_stream
+        conn.close()
+
+    def test_blobs(self):
+        """Large files should be shared through the blob store."""
+        notebook_file = _tmpdir + '/notebook_blobs'
+        clean_dir(notebook_file)
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        rootid = conn.create_node(None, {})
+        conn.enable_blob_store()
+        self._test_api(conn)
+
+        data = os.urandom(3 * blobslib.MIN_BLOB_SIZE)
+        local_file = _tmpdir + '/blob.bin'
+        with open(local_file, 'wb') as out:
+            out.write(data)
+
+        # Attach the same file to several nodes.
+        nodeids = [conn.create_node(None, {'parentids': [rootid]})
+                   for i in range(3)]
+        conn.copy_file(None, local_file, nodeids[0], 'a.bin')
+        with conn.open_file(nodeids[1], 'b.bin', 'wb') as out:
+            out.write(data)
+        conn.copy_file(nodeids[1], 'b.bin', nodeids[2], 'c.bin')
+        with conn.open_file(nodeids[2], 'small.txt', 'w') as out:
+            out.write('small')
+
+        blobs = conn.get_blob_store()
+        stats = blobs.get_stats()
+        self.assertEqual((stats['blobs'], stats['refs']), (1, 3))
+        self.assertEqual(stats['bytes_saved'], 2 * len(data))
+        c_file = conn.get_node_path(nodeids[2]) + '/c.bin'
+        self.assertFalse(os.path.exists(c_file))
+        self.assertTrue(os.path.getsize(blobslib.get_ref_file(c_file)) <=
+                        blobslib.MAX_REF_SIZE)
+        self.assertTrue(conn.has_file(nodeids[2], 'c.bin'))
+        self.assertEqual(sorted(conn.list_dir(nodeids[2])),
+                         ['c.bin', 'small.txt'])
+
+        # References are resolved transparently.
+        with conn.open_file(nodeids[2], 'c.bin', 'rb') as infile:
+            self.assertEqual(infile.read(), data)
+        with open(conn.get_local_file(nodeids[0], 'a.bin'), 'rb') as infile:
+            self.assertEqual(infile.read(), data)
+        self.assertEqual(conn.get_file_stat(nodeids[0], 'a.bin')[0],
+                         len(data))
+        conn.copy_file(nodeids[0], 'a.bin', None, _tmpdir + '/out.bin')
+        with open(_tmpdir + '/out.bin', 'rb') as infile:
+            self.assertEqual(infile.read(), data)
+
+        # Appending gives a node its own copy.
+        with conn.open_file(nodeids[1], 'b.bin', 'ab') as out:
+            out.write(b'tail')
+        with conn.open_file(nodeids[1], 'b.bin', 'rb') as infile:
+            self.assertEqual(infile.read(), data + b'tail')
+        self.assertEqual(blobs.get_stats()['blobs'], 2)
+
+        # Unreferenced blobs are collected.
+        conn.delete_file(nodeids[1], 'b.bin')
+        conn.delete_node(nodeids[2])
+        self.assertEqual(conn.collect_blobs(),
+                         {'blobs': 1, 'bytes': len(data) + 4})
+        with conn.open_file(nodeids[0], 'a.bin', 'rb') as infile:
+            self.assertEqual(infile.read(), data)
+        key = blobslib.get_blob_key(blobslib.hash_file(local_file)[0],
+                                    local_file)
+        self.assertEqual(blobs.get_refs(key), 1)
+
+        # Blob files keep the extension of the node file.
+        self.assertTrue(
+            conn.get_local_file(nodeids[0], 'a.bin').endswith('.bin'))
+
+        # File contents cannot pose as references.
+        with conn.open_file(nodeids[0], 'fake.bin', 'wb') as out:
+            out.write(blobslib.REF_HEADER + ('%s 1\n' % key).encode('ascii'))
+        with conn.open_file(nodeids[0], 'fake.bin', 'rb') as infile:
+            self.assertTrue(infile.read().startswith(blobslib.REF_HEADER))
+        self.assertRaises(connlib.FileError, conn.open_file, nodeids[0],
+                          blobslib.REF_PREFIX + 'a.bin', 'wb')
+
+        # Files in the notebook meta directory keep their blobs.
+        thumbnail = fs.NOTEBOOK_META_DIR + '/thumbnails/t.png'
+        with conn.open_file(rootid, thumbnail, 'wb') as out:
+            out.write(data[::-1])
+        self.assertEqual(conn.collect_blobs(), {'blobs': 0, 'bytes': 0})
+        with conn.open_file(rootid, thumbnail, 'rb') as infile:
+            self.assertEqual(infile.read(), data[::-1])
+
+        # Files handed out by path are private copies.
+        filename = conn.get_file(nodeids[0], 'a.bin')
+        self.assertEqual(filename, os.path.join(
+            conn.get_node_path(nodeids[0]), 'a.bin'))
+        with open(filename, 'ab') as out:
+            out.write(b'edit')
+        self.assertEqual(blobs.get_refs(key), 0)
+        with open(blobs.get_blob_file(key), 'rb') as infile:
+            self.assertEqual(infile.read(), data)
+        conn.close()
+
+    def test_blobs_migrate(self):
+        """Existing notebooks should migrate to the blob store."""
+        notebook_file = _tmpdir + '/notebook_blobs_migrate'
+        clean_dir(notebook_file)
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        rootid = conn.create_node(None, {})
+        data = os.urandom(2 * blobslib.MIN_BLOB_SIZE)
+        nodeids = []
+        for i in range(4):
+            nodeid = conn.create_node(None, {'parentids': [rootid]})
+            with conn.open_file(nodeid, 'image.png', 'wb') as out:
+                out.write(data)
+            nodeids.append(nodeid)
+        self.assertEqual(conn.get_blob_store(), None)
+
+        self.assertEqual(conn.migrate_blobs(), 4)
+        self.assertEqual(conn.migrate_blobs(), 0)
+        stats = conn.get_blob_store().get_stats()
+        self.assertEqual((stats['blobs'], stats['refs']), (1, 4))
+        self.assertEqual(stats['bytes_saved'], 3 * len(data))
+        conn.close()
+
+        # The store is used when the notebook is opened again.
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        self.assertNotEqual(conn.get_blob_store(), None)
+        with conn.open_file(nodeids[3], 'image.png', 'rb') as infile:
+            self.assertEqual(infile.read(), data)
+        conn.close()
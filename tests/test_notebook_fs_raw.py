@@ -212,3 +212,75 @@ class FSRaw (TestConnBase):
             nodedirs.create_nodedir(nodeid)
 
         nodedirs.close()
+
+    def test_fanout(self):
+        """Store nodedirs with a multi-level fan-out."""
+
+        filename = TMP_DIR + '/notebook_fs_raw/nodedirs_fanout'
+        make_clean_dir(filename)
+
+        nodedirs = fs_raw.NodeFS(filename, fanout=(2, 2))
+        dir1 = nodedirs.create_nodedir('abcdefg')
+        nodedirs.create_nodedir('abcd')
+        nodedirs.create_nodedir('ab..cd')
+        nodedirs.create_nodedir('ABC')
+        self.assertEqual(
+            dir1, os.path.join(filename, '00_fanout_2_2', 'ab', 'cd', 'efg'))
+        self.assertEqual(
+            set(nodedirs.iter_nodeids()),
+            set(['abcdefg', 'abcd', 'ab..cd', 'ABC']))
+        nodedirs.close()
+
+        # The fan-out is stored with the nodedirs.
+        nodedirs = fs_raw.NodeFS(filename)
+        self.assertEqual(nodedirs.get_fanout(), (2, 2))
+        self.assertTrue(nodedirs.has_nodedir('abcdefg'))
+        nodedirs.close()
+        self.assertRaises(fs_raw.ConnectionError,
+                          lambda: fs_raw.NodeFS(filename, fanout=(3,)))
+
+    def test_reshard(self):
+        """Re-shard nodedirs while they are in use."""
+
+        filename = TMP_DIR + '/notebook_fs_raw/nodedirs_reshard'
+        make_clean_dir(filename)
+
+        nodedirs = fs_raw.NodeFS(filename)
+        nodeids = [str(uuid.uuid4()) for i in range(100)]
+        nodeids += ['abc', 'abcd', 'a', 'ABC', 'x' * 256]
+        for nodeid in nodeids:
+            nodedir = nodedirs.create_nodedir(nodeid)
+            with open(os.path.join(nodedir, 'file'), 'w') as out:
+                out.write(nodeid)
+
+        # Nodes are found in either layout while a re-shard is in progress.
+        fs_raw.write_layout(filename, (2, 2), (2,))
+        nodedirs.close()
+        nodedirs = fs_raw.NodeFS(filename)
+        self.assertTrue(all(nodedirs.has_nodedir(nodeid)
+                            for nodeid in nodeids))
+        self.assertEqual(sorted(nodedirs.iter_nodeids()), sorted(nodeids))
+        newdir = nodedirs.create_nodedir('newnode')
+        self.assertEqual(
+            newdir, os.path.join(filename, '00_fanout_2_2', 'ne', 'wn', 'ode'))
+        nodeids.append('newnode')
+
+        self.assertEqual(nodedirs.reshard((2, 2)), 104)
+        self.assertEqual(nodedirs.reshard((2, 2)), 0)
+        self.assertEqual(sorted(nodedirs.iter_nodeids()), sorted(nodeids))
+        for nodeid in nodeids[:-1]:
+            with open(os.path.join(nodedirs.get_nodedir(nodeid),
+                                   'file')) as infile:
+                self.assertEqual(infile.read(), nodeid)
+
+        # Old prefix directories are removed.
+        self.assertEqual(
+            sorted(name for name in os.listdir(filename)
+                   if len(name) == 2), [])
+
+        # Re-shard back to the default fan-out.
+        nodedirs.reshard((2,))
+        self.assertEqual(sorted(nodedirs.iter_nodeids()), sorted(nodeids))
+        self.assertFalse(os.path.exists(
+            os.path.join(filename, '00_fanout_2_2')))
+        nodedirs.close()
@@ -1,15 +1,26 @@
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 import json
+import os
 import socket
+import threading
+import time
 import _thread
+import unittest
 import urllib.request, urllib.parse, urllib.error
 
 from keepnote import notebook as notebooklib
+from keepnote.notebook.connection import http_encoding
+from keepnote.notebook.connection.http import HttpConnectionPool
 from keepnote.notebook.connection.http import NoteBookConnectionHttp
+from keepnote.notebook.connection import fs
+from keepnote.notebook.connection import fs_raw
 from keepnote.notebook.connection import mem
 from keepnote.server import BaseNoteBookHttpServer
 from keepnote.server import NoteBookHttpServer
 
 from .test_notebook_conn import TestConnBase
+from . import make_clean_dir, TMP_DIR
 
 
 class TestHttp(TestConnBase):
@@ -88,3 +99,365 @@ class TestHttp(TestConnBase):
 
         # Close server.
         server.shutdown()
+
+    def test_stream_files(self):
+        """Large binary files should stream in both directions."""
+        make_clean_dir(TMP_DIR + '/notebook_http')
+        self.conn = fs_raw.NoteBookConnectionFSRaw()
+        self.conn.connect(TMP_DIR + '/notebook_http/n1')
+        self.conn.create_node('n1', {'nodeid': 'n1'})
+
+        self.port = 8126
+        url = "http://localhost:%d/notebook/" % self.port
+        server = BaseNoteBookHttpServer(self.conn, port=self.port)
+        _thread.start_new_thread(server.serve_forever, ())
+
+        self.conn2 = NoteBookConnectionHttp()
+        self.conn2.connect(url)
+        self.wait_for_server(self.conn2)
+
+        # Round trip a file larger than the upload spool.
+        data = os.urandom(3 * 1024 * 1024)
+        with self.conn2.open_file('n1', 'big.bin', 'wb') as out:
+            out.write(data[:1000])
+            out.write(data[1000:])
+        with self.conn2.open_file('n1', 'big.bin', 'rb') as infile:
+            self.assertEqual(infile.read(), data)
+
+        with self.conn2.open_file('n1', 'big.bin', 'ab') as out:
+            out.write(b'tail')
+
+        # Byte ranges of local files.
+        result = self.conn2._request(
+            'GET', '/notebook/nodes/n1/big.bin',
+            headers={'Range': 'bytes=10-19'})
+        self.assertEqual(result.status, 206)
+        self.assertEqual(result.read(), data[10:20])
+        result = self.conn2._request(
+            'GET', '/notebook/nodes/n1/big.bin',
+            headers={'Range': 'bytes=-4'})
+        self.assertEqual(result.read(), b'tail')
+
+        self.conn2.close()
+        self.conn.close()
+        server.shutdown()
+
+    def test_cache(self):
+        """Repeated reads should be revalidated with 304 responses."""
+        make_clean_dir(TMP_DIR + '/notebook_http')
+        self.conn = fs_raw.NoteBookConnectionFSRaw()
+        self.conn.connect(TMP_DIR + '/notebook_http/n2')
+        self.conn.create_node('n1', {'nodeid': 'n1', 'title': 'one'})
+
+        self.port = 8127
+        url = "http://localhost:%d/notebook/" % self.port
+        server = BaseNoteBookHttpServer(self.conn, port=self.port)
+        _thread.start_new_thread(server.serve_forever, ())
+
+        self.conn2 = NoteBookConnectionHttp()
+        self.conn2.connect(url)
+        self.wait_for_server(self.conn2)
+
+        with self.conn2.open_file('n1', 'file.txt', 'w') as out:
+            out.write('hello')
+        for i in range(3):
+            self.assertEqual(self.conn2.read_node('n1')['title'], 'one')
+            self.assertEqual(self.conn2.list_dir('n1'), ['file.txt'])
+            with self.conn2.open_file('n1', 'file.txt') as infile:
+                self.assertEqual(infile.read(), 'hello')
+        stats = self.conn2.get_cache_stats()
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['hits'], 6)
+
+        # Changes made elsewhere are seen on revalidation.
+        self.conn.update_node('n1', {'nodeid': 'n1', 'title': 'two'})
+        with self.conn.open_file('n1', 'file.txt', 'w') as out:
+            out.write('bye')
+        self.assertEqual(self.conn2.read_node('n1')['title'], 'two')
+        with self.conn2.open_file('n1', 'file.txt') as infile:
+            self.assertEqual(infile.read(), 'bye')
+
+        self.conn2.close()
+        self.conn.close()
+        server.shutdown()
+
+    def test_compression(self):
+        """Bodies should be compressed when both sides support it."""
+        make_clean_dir(TMP_DIR + '/notebook_http')
+        self.conn = fs_raw.NoteBookConnectionFSRaw()
+        self.conn.connect(TMP_DIR + '/notebook_http/n3')
+        self.conn.create_node('n1', {'nodeid': 'n1', 'body': 'x' * 2000})
+
+        self.port = 8128
+        url = "http://localhost:%d/notebook/" % self.port
+        server = BaseNoteBookHttpServer(self.conn, port=self.port)
+        _thread.start_new_thread(server.serve_forever, ())
+
+        self.conn2 = NoteBookConnectionHttp(version=3)
+        self.conn2.connect(url)
+        self.wait_for_server(self.conn2)
+
+        page = '<html><body>%s</body></html>' % ('<p>hello</p>' * 5000)
+        with self.conn2.open_file('n1', 'page.html', 'w') as out:
+            out.write(page)
+        with self.conn2.open_file('n1', 'page.html') as infile:
+            self.assertEqual(infile.read(), page)
+        self.assertEqual(self.conn2.read_node('n1')['body'], 'x' * 2000)
+        self.conn2.update_node('n1', {'nodeid': 'n1', 'body': 'y' * 2000})
+        self.assertEqual(self.conn.read_node('n1')['body'], 'y' * 2000)
+
+        # Check the encoding on the wire.
+        result = self.conn2._pool.request(
+            'GET', '/notebook/nodes/n1/page.html',
+            headers={'Accept-Encoding': 'gzip'}, stream=True)
+        self.assertEqual(result.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(result.read().decode('utf8'), page)
+        result.close()
+
+        self.conn2.close()
+        self.conn.close()
+        server.shutdown()
+
+    def test_threaded(self):
+        """The threaded server should handle concurrent clients."""
+        make_clean_dir(TMP_DIR + '/notebook_http')
+        self.conn = fs_raw.NoteBookConnectionFSRaw()
+        self.conn.connect(TMP_DIR + '/notebook_http/n4')
+        self.conn.create_node('n1', {'nodeid': 'n1'})
+
+        self.port = 8129
+        url = "http://localhost:%d/notebook/" % self.port
+        server = BaseNoteBookHttpServer(self.conn, port=self.port,
+                                        threaded=True)
+        _thread.start_new_thread(server.serve_forever, ())
+
+        self.conn2 = NoteBookConnectionHttp()
+        self.conn2.connect(url)
+        self.wait_for_server(self.conn2)
+        errors = []
+
+        def worker(i):
+            try:
+                for j in range(10):
+                    nodeid = 'n%d_%d' % (i, j)
+                    self.conn2.create_node(nodeid, {'nodeid': nodeid})
+                    with self.conn2.open_file(nodeid, 'file', 'w') as out:
+                        out.write(nodeid)
+                    self.assertEqual(
+                        self.conn2.read_node(nodeid)['nodeid'], nodeid)
+                    with self.conn2.open_file(nodeid, 'file') as infile:
+                        self.assertEqual(infile.read(), nodeid)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        self.conn2.close()
+        self.conn.close()
+        server.shutdown()
+
+    def test_changes(self):
+        """Clients following the change feed should see other changes."""
+        make_clean_dir(TMP_DIR + '/notebook_http')
+        self.conn = fs_raw.NoteBookConnectionFSRaw()
+        self.conn.connect(TMP_DIR + '/notebook_http/n5')
+        self.conn.create_node('n1', {'nodeid': 'n1', 'title': 'one'})
+
+        self.port = 8130
+        url = "http://localhost:%d/notebook/" % self.port
+        server = BaseNoteBookHttpServer(self.conn, port=self.port,
+                                        threaded=True)
+        _thread.start_new_thread(server.serve_forever, ())
+
+        conn1 = NoteBookConnectionHttp()
+        conn1.connect(url)
+        self.wait_for_server(conn1)
+        conn2 = NoteBookConnectionHttp()
+        conn2.connect(url)
+
+        conn1.start_watching(timeout=5)
+        while not conn1.is_watching():
+            time.sleep(0.01)
+
+        # Cached attrs are used without asking the server.
+        self.assertEqual(conn1.read_node('n1')['title'], 'one')
+        requests = conn1.get_pool_stats()['requests']
+        self.assertEqual(conn1.read_node('n1')['title'], 'one')
+        self.assertTrue(conn1.get_pool_stats()['requests'] <= requests + 1)
+        requests = conn1.get_pool_stats()['requests']
+        self.assertTrue(conn1.has_node('n1'))
+        self.assertTrue(conn1.get_pool_stats()['requests'] <= requests + 1)
+
+        # Changes by another client invalidate the cache.
+        conn2.update_node('n1', {'nodeid': 'n1', 'title': 'two'})
+        for i in range(200):
+            if conn1.read_node('n1')['title'] == 'two':
+                break
+            time.sleep(0.01)
+        self.assertEqual(conn1.read_node('n1')['title'], 'two')
+
+        changes = conn2.get_changes(0)
+        self.assertEqual([change['type'] for change in changes['changes']],
+                         ['update_node'])
+
+        conn1.close()
+        conn2.close()
+        self.conn.close()
+        server.shutdown()
+
+    def test_node_tree(self):
+        """Node trees should be rendered from the index a level at a time."""
+        make_clean_dir(TMP_DIR + '/notebook_http')
+        self.conn = fs.NoteBookConnectionFS()
+        self.conn.connect(TMP_DIR + '/notebook_http/n6')
+        rootid = self.conn.create_node(None, {'title': 'root'})
+        self.conn.index_attr('title', 'TEXT')
+        page1 = self.conn.create_node(None, {
+            'parentids': [rootid], 'title': 'page <1>',
+            'content_type': 'text/xhtml+xml'})
+        self.conn.create_node(None, {'parentids': [page1], 'title': 'page 2'})
+
+        self.port = 8131
+        url = "http://localhost:%d/notebook/" % self.port
+        server = BaseNoteBookHttpServer(self.conn, port=self.port)
+        _thread.start_new_thread(server.serve_forever, ())
+        conn = NoteBookConnectionHttp()
+        conn.connect(url)
+        self.wait_for_server(conn)
+
+        # Children past the depth limit are linked rather than listed.
+        body = urllib.request.urlopen(
+            url + 'nodes/%s?all&depth=1' % rootid).read().decode('utf8')
+        self.assertTrue("<a href='%s/page.html'>page &lt;1&gt;</a>" % page1
+                        in body)
+        self.assertTrue("<a href='%s?all'>...</a>" % page1 in body)
+        self.assertFalse('page 2' in body)
+        self.assertEqual(body.count('<ul>'), body.count('</ul>'))
+        self.assertEqual(body.count('<li>'), body.count('</li>'))
+
+        body = urllib.request.urlopen(
+            url + 'nodes/%s?all' % rootid).read().decode('utf8')
+        self.assertTrue('page 2' in body)
+
+        # Lazily expand a node.
+        data = json.loads(urllib.request.urlopen(
+            url + 'nodes/%s?tree' % page1).read().decode('utf8'))
+        self.assertEqual([(row['title'], row['depth'], row['has_children'])
+                          for row in data['nodes']],
+                         [('page <1>', 0, True), ('page 2', 1, False)])
+        self.assertEqual(conn.get_node_tree(page1, 0)[0]['nodeid'], page1)
+
+        conn.close()
+        self.conn.close()
+        server.shutdown()
+
+    def test_encoding(self):
+        self.assertEqual(
+            http_encoding.parse_accept_encoding('gzip;q=0.5, br;q=0, x'),
+            set(['gzip', 'x']))
+        self.assertEqual(http_encoding.choose_encoding('deflate'), 'deflate')
+        self.assertEqual(http_encoding.choose_encoding('identity'), None)
+
+        data = b'hello world' * 100
+        for encoding in http_encoding.get_encodings():
+            self.assertEqual(http_encoding.decompress(
+                http_encoding.compress(data, encoding), encoding), data)
+
+        attr = {'nodeid': 'n1', 'list': [1, 2.5, 'x', None, True]}
+        for content_type in http_encoding.get_data_types():
+            self.assertEqual(http_encoding.loads_data(
+                http_encoding.dumps_data(attr, content_type), content_type),
+                attr)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = self.path.encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.posts.append(self.path)
+        if self.path == "/slow":
+            time.sleep(0.5)
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == "/close":
+            # close without telling the client
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpPool(unittest.TestCase):
+
+    def test_post_retry(self):
+        """POSTs are only resent when a stale connection is detected."""
+        server = ThreadingHTTPServer(("localhost", 8126), KeepAliveHandler)
+        server.posts = []
+        _thread.start_new_thread(server.serve_forever, ())
+        pool = HttpConnectionPool("localhost:8126", maxsize=1,
+                                  timeout=0.2, backoff=0)
+
+        # The server closed the kept-alive connection.
+        self.assertEqual(pool.request("POST", "/close", b"x").read(), b"ok")
+        time.sleep(0.1)
+        self.assertEqual(pool.request("POST", "/create", b"x").read(),
+                         b"ok")
+        self.assertEqual(server.posts, ["/close", "/create"])
+        self.assertEqual(pool.get_stats()["retries"], 1)
+
+        # A timeout after the request was sent is not retried.
+        self.assertRaises(socket.timeout, lambda:
+                          pool.request("POST", "/slow", b"x"))
+        self.assertEqual(server.posts, ["/close", "/create", "/slow"])
+
+        pool.clear()
+        server.shutdown()
+
+    def test_pool(self):
+        """Connections should be reused across requests and threads."""
+        server = ThreadingHTTPServer(("localhost", 8125), KeepAliveHandler)
+        _thread.start_new_thread(server.serve_forever, ())
+
+        pool = HttpConnectionPool("localhost:8125", maxsize=2)
+        for i in range(5):
+            result = pool.request("GET", "/node%d" % i)
+            self.assertEqual(result.read(), b"/node%d" % i)
+
+        # A streamed response holds its connection until closed.
+        result = pool.request("GET", "/stream", stream=True)
+        self.assertEqual(result.read(3), b"/st")
+        result.close()
+
+        def worker():
+            for i in range(10):
+                pool.request("GET", "/thread")
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = pool.get_stats()
+        self.assertEqual(stats["requests"], 46)
+        self.assertTrue(stats["hits"] > stats["new_connections"])
+        self.assertTrue(stats["idle"] <= 2)
+
+        pool.clear()
+        server.shutdown()
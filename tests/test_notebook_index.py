@@ -11,6 +11,7 @@ import traceback
 
 # keepnote imports
 from keepnote import notebook
+import keepnote.notebook.connection as connlib
 
 from . import clean_dir, TMP_DIR
 
@@ -137,6 +138,41 @@ class Index (unittest.TestCase):
 
         book.close()
 
+    def test_node_tree(self):
+        """Read a node tree from the index."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        conn = book.get_connection()
+        rootid = book.get_attr('nodeid')
+
+        rows = conn.get_node_tree(rootid)
+        titles = [row['title'] for row in rows
+                  if (row['title'] or '').startswith('Page')]
+        self.assertEqual(titles, ['Page 1', 'Page A', 'Page B', 'Page X',
+                                  'Page C', 'Page 2', 'Page 3'])
+        self.assertEqual([row['depth'] for row in rows
+                          if row['title'] in ('Page 1', 'Page B', 'Page X')],
+                         [1, 2, 3])
+
+        # The index agrees with walking the nodes.
+        walked = connlib.sort_node_tree(
+            connlib.walk_node_tree(conn, rootid), rootid)
+        self.assertEqual(
+            [(row['nodeid'], row['parentid'], row['has_children'])
+             for row in rows],
+            [(row['nodeid'], row['parentid'], row['has_children'])
+             for row in walked])
+
+        # Depth limits the tree, but not has_children.
+        rows = conn.get_node_tree(rootid, 1)
+        self.assertEqual([row['depth'] for row in rows], [0] + [1] * (
+            len(rows) - 1))
+        page1 = [row for row in rows if row['title'] == 'Page 1'][0]
+        self.assertTrue(page1['has_children'])
+
+        self.assertEqual(conn.get_node_tree('unknown'), [])
+        book.close()
+
     def test_index_all(self):
         """Reindex all nodes in notebook."""
         book = notebook.NoteBook()
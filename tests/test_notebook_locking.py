@@ -0,0 +1,177 @@
+# python imports
+import threading
+import time
+import unittest
+
+# keepnote imports
+from keepnote.notebook.connection import fs
+from keepnote.notebook.connection import fs_raw
+from keepnote.notebook.connection import mem
+from keepnote.notebook.connection.changes import ChangeLog
+from keepnote.notebook.connection.changes import ChangeLogConnection
+from keepnote.notebook.connection.locking import LockedConnection
+from keepnote.notebook.connection.locking import RWLock
+
+from .test_notebook_conn import TestConnBase
+from . import clean_dir
+from . import TMP_DIR
+
+_tmpdir = TMP_DIR + '/notebook_locking/'
+
+
+class TestRWLock (unittest.TestCase):
+
+    def test_readers(self):
+        """Readers share the lock while writers are exclusive."""
+        lock = RWLock()
+        events = []
+
+        def reader(i):
+            with lock.read_lock():
+                events.append(("start", i))
+                time.sleep(0.05)
+                events.append(("end", i))
+
+        threads = [threading.Thread(target=reader, args=(i,))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # All readers started before any finished.
+        self.assertEqual([e[0] for e in events[:3]], ["start"] * 3)
+
+        # A writer waits for readers to finish.
+        lock.acquire_read()
+        acquired = []
+
+        def writer():
+            with lock.write_lock():
+                acquired.append(True)
+        thread = threading.Thread(target=writer)
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(acquired, [])
+        lock.release_read()
+        thread.join()
+        self.assertEqual(acquired, [True])
+
+    def test_reentrant(self):
+        lock = RWLock()
+        with lock.write_lock():
+            with lock.write_lock():
+                with lock.read_lock():
+                    pass
+        with lock.read_lock():
+            with lock.read_lock():
+                self.assertRaises(RuntimeError, lock.acquire_write)
+
+
+class TestLockedConnection (TestConnBase):
+
+    def test_api(self):
+        clean_dir(_tmpdir + '/notebook_api')
+        conn = fs_raw.NoteBookConnectionFSRaw()
+        conn.connect(_tmpdir + '/notebook_api')
+        self._test_api(LockedConnection(conn))
+
+    def test_iter_results(self):
+        """Iterator results are consumed while the lock is held."""
+        lock = RWLock()
+        held = []
+
+        class Conn (mem.NoteBookConnectionMem):
+            def index(self, query):
+                for i in range(2):
+                    held.append(threading.get_ident() in lock._readers)
+                    yield i
+
+        conn = Conn()
+        conn.create_node('node1', {})
+        conn.create_dir('node1', 'dir/')
+        locked = LockedConnection(conn, lock)
+        self.assertEqual(locked.index(['node_path', 'node1']), [0, 1])
+        self.assertEqual(held, [True, True])
+        self.assertEqual(locked.list_dir('node1'), ['dir/'])
+
+    def test_threads(self):
+        """Concurrent reads and writes of a FS notebook."""
+        notebook_file = _tmpdir + '/notebook_threads'
+        clean_dir(notebook_file)
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        rootid = conn.create_node(None, {})
+        nodeids = [conn.create_node(None, {'parentids': [rootid],
+                                           'title': 'node%d' % i})
+                   for i in range(10)]
+        locked = LockedConnection(conn)
+        errors = []
+
+        def worker(i):
+            try:
+                for j in range(20):
+                    nodeid = nodeids[(i + j) % len(nodeids)]
+                    if j % 5 == 0:
+                        attr = locked.read_node(nodeid)
+                        attr['count'] = j
+                        locked.update_node(nodeid, attr)
+                    else:
+                        locked.read_node(nodeid)
+                        locked.index(['search', 'title', 'node'])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(locked.read_nodes(nodeids)[0]['title'], 'node0')
+        locked.close()
+
+
+class TestChangeLog (unittest.TestCase):
+
+    def test_changes(self):
+        clean_dir(_tmpdir + '/notebook_changes')
+        conn = fs_raw.NoteBookConnectionFSRaw()
+        conn.connect(_tmpdir + '/notebook_changes')
+        conn = ChangeLogConnection(conn)
+        log = conn.changes
+
+        conn.create_node('n1', {'nodeid': 'n1'})
+        conn.create_node('n2', {'nodeid': 'n2', 'parentids': ['n1']})
+        with conn.open_file('n2', 'file', 'w') as out:
+            out.write('hello')
+        conn.update_node('n2', {'nodeid': 'n2', 'parentids': []})
+        conn.delete_node('n2')
+
+        data = log.get_changes(0)
+        self.assertFalse(data['reset'])
+        self.assertEqual(data['seq'], 5)
+        self.assertEqual(
+            [(change['type'], change['nodeid'], change['parentids'])
+             for change in data['changes']],
+            [('create_node', 'n1', []),
+             ('create_node', 'n2', ['n1']),
+             ('file', 'n2', []),
+             ('update_node', 'n2', ['n1']),
+             ('delete_node', 'n2', [])])
+        self.assertEqual(log.get_changes(3)['changes'][0]['seq'], 4)
+
+        # Waiting readers are woken by new changes.
+        threading.Timer(0.05, conn.create_node, ('n3', {})).start()
+        data = log.get_changes(5, timeout=5)
+        self.assertEqual(data['changes'][0]['nodeid'], 'n3')
+
+        # Dropped changes require a reset.
+        small = ChangeLog(maxsize=2)
+        for i in range(4):
+            small.add('file', 'n1')
+        self.assertTrue(small.get_changes(0)['reset'])
+        self.assertFalse(small.get_changes(2)['reset'])
+        self.assertTrue(small.get_changes(10)['reset'])
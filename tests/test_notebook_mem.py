@@ -1,8 +1,11 @@
 
 # keepnote imports
+from keepnote.notebook.connection import fs_raw
 from keepnote.notebook.connection import mem
+import keepnote.notebook.sync as sync
 
 from .test_notebook_conn import TestConnBase
+from . import make_clean_dir, TMP_DIR
 
 
 class Mem (TestConnBase):
@@ -17,3 +20,87 @@ class Mem (TestConnBase):
 
         conn = mem.NoteBookConnectionMem()
         self._test_notebook(conn, 'n1')
+
+    def test_files(self):
+        """Files are stored as bytes and counted in the size."""
+        conn = mem.NoteBookConnectionMem()
+        conn.create_node('node1', {})
+        size = conn.get_size()
+
+        data = bytes(range(256)) * 4
+        with conn.open_file('node1', 'image.png', 'wb') as out:
+            out.write(data)
+        self.assertEqual(conn.get_size(), size + len(data))
+
+        with conn.open_file('node1', 'image.png', 'rb') as infile:
+            self.assertEqual(infile.read(10), data[:10])
+            infile.seek(1000)
+            self.assertEqual(infile.read(), data[1000:])
+
+        with conn.open_file('node1', 'image.png', 'ab') as out:
+            out.write(b'end')
+        self.assertEqual(conn.open_file('node1', 'image.png', 'rb').read(),
+                         data + b'end')
+
+        with conn.open_file('node1', 'page.html', 'w') as out:
+            out.write('line1\nDéjà vu\n')
+        self.assertEqual(
+            list(conn.open_file('node1', 'page.html')),
+            ['line1\n', 'Déjà vu\n'])
+
+        conn.delete_node('node1')
+        self.assertEqual(conn.get_size(), 0)
+
+    def test_cache(self):
+        """Use as a bounded write-through cache."""
+        filename = TMP_DIR + '/notebook_mem/cache'
+        make_clean_dir(TMP_DIR + '/notebook_mem')
+        backing = fs_raw.NoteBookConnectionFSRaw()
+        backing.connect(filename)
+
+        conn = mem.NoteBookConnectionMem(backing, max_size=10000)
+        self._test_api(conn)
+
+        data = b'x' * 3000
+        for i in range(10):
+            nodeid = 'cached%d' % i
+            conn.create_node(nodeid, {'nodeid': nodeid})
+            with conn.open_file(nodeid, 'file', 'wb') as out:
+                out.write(data)
+            conn.read_node(nodeid)
+            self.assertTrue(conn.get_size() <= 10000)
+
+        # Evicted nodes are read back from the backing connection.
+        for i in range(10):
+            nodeid = 'cached%d' % i
+            self.assertEqual(conn.read_node(nodeid)['nodeid'], nodeid)
+            self.assertEqual(
+                conn.open_file(nodeid, 'file', 'rb').read(), data)
+            self.assertEqual(
+                backing.open_file(nodeid, 'file', 'rb').read(), data)
+
+        conn.close()
+
+    def test_sync_twice(self):
+        """Syncing into a memory connection again should be a no-op."""
+        conn1 = mem.NoteBookConnectionMem()
+        conn2 = mem.NoteBookConnectionMem()
+        attr = {'nodeid': 'node1', 'title': 'node1'}
+        conn1.create_node('node1', attr)
+        with conn1.open_file('node1', 'dir/page.html', 'w') as out:
+            out.write('hello')
+
+        self.assertEqual(sync.sync_tree('node1', conn1, conn2), ['node1'])
+        self.assertEqual(sync.sync_tree('node1', conn1, conn2), [])
+        self.assertEqual(sorted(conn2.list_dir('node1')), ['dir/'])
+        self.assertEqual(
+            conn2.open_file('node1', 'dir/page.html').read(), 'hello')
+
+    def test_list_root(self):
+        """Listing the node root should not list the root itself."""
+        conn = mem.NoteBookConnectionMem()
+        conn.create_node('node1', {})
+        conn.create_dir('node1', '/')
+        conn.create_dir('node1', 'dir/')
+        self.assertEqual(list(conn.list_dir('node1', '/')), ['dir/'])
+        self.assertEqual(list(conn._list_dir(['/', 'dir/'], '/')), ['dir/'])
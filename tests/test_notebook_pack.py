@@ -0,0 +1,115 @@
+
+# python imports
+import os
+
+# keepnote imports
+from keepnote import notebook
+from keepnote.notebook.connection import fs
+from keepnote.notebook.connection import pack
+import keepnote.notebook.sync as sync
+
+from .test_notebook_conn import TestConnBase
+from . import clean_dir, make_clean_dir, TMP_DIR
+
+
+# root path for test data
+_datapath = os.path.join(TMP_DIR, 'notebook_pack')
+
+
+class Pack (TestConnBase):
+
+    def test_api(self):
+        # initialize a notebook
+        make_clean_dir(_datapath)
+        conn = pack.BaseNoteBookConnectionPack()
+        conn.connect("pack://" + _datapath + "/n1.knp")
+        self._test_api(conn)
+
+        # unsupported queries are errors
+        self.assertRaises(NotImplementedError, conn.index, ["unknown"])
+
+        conn.close()
+
+    def test_notebook(self):
+        # initialize a notebook
+        make_clean_dir(_datapath)
+        conn = pack.NoteBookConnectionPack()
+        self._test_notebook(conn, _datapath + "/n2.knp")
+
+        conn.close()
+
+    def test_compression(self):
+        """Large pages are stored compressed."""
+        make_clean_dir(_datapath)
+        conn = pack.NoteBookConnectionPack()
+        conn.connect(_datapath + "/n3.knp")
+        conn.create_node('node1', {})
+
+        text = "hello world\n" * 1000
+        with conn.open_file('node1', 'page.html', 'w') as out:
+            out.write(text)
+        data = bytes(range(256))
+        with conn.open_file('node1', 'image.png', 'wb') as out:
+            out.write(data)
+
+        stats = conn.get_pack_stats()
+        self.assertEqual(stats['bytes'], len(text) + len(data))
+        self.assertTrue(stats['bytes_stored'] < stats['bytes'])
+        conn.close()
+
+        # Files survive reopening the pack.
+        conn.connect(_datapath + "/n3.knp")
+        self.assertEqual(conn.get_rootid(), 'node1')
+        self.assertEqual(conn.open_file('node1', 'page.html').read(), text)
+        self.assertEqual(conn.open_file('node1', 'image.png', 'rb').read(),
+                         data)
+        conn.close()
+
+    def test_import_export(self):
+        """Copy a notebook directory into a pack and back out again."""
+        clean_dir(_datapath + "/n4")
+        clean_dir(_datapath + "/n4-copy")
+        make_clean_dir(_datapath)
+
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n4")
+        page = notebook.new_page(book, "page1")
+        with page.open_file(notebook.PAGE_DATA_FILE, 'w') as out:
+            out.write(notebook.NOTE_HEADER + "hello world" +
+                      notebook.NOTE_FOOTER)
+        with page.open_file('image.png', 'wb') as out:
+            out.write(bytes(range(256)))
+        notebook.new_page(page, "page2")
+        book.save()
+
+        # Import into a pack.
+        conn = pack.NoteBookConnectionPack()
+        conn.connect(_datapath + "/n4.knp")
+        sync.copy_notebook(book.get_connection(), conn)
+        conn.close()
+        book.close()
+
+        book2 = notebook.NoteBook()
+        book2.load("pack://" + _datapath + "/n4.knp",
+                   pack.NoteBookConnectionPack())
+        self.assertEqual([node.get_title() for node in book2.get_children()],
+                         [node.get_title() for node in book.get_children()])
+        nodeid = book2.search_node_titles("page2")[0][0]
+        self.assertEqual(book2.get_node_by_id(nodeid).get_parent()
+                         .get_title(), "page1")
+        self.assertEqual(len(list(book2.search_node_contents("hello"))), 1)
+
+        # Export back into a notebook directory.
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(_datapath + "/n4-copy")
+        sync.copy_notebook(book2.get_connection(), conn)
+        conn.close()
+        book2.close()
+
+        book3 = notebook.NoteBook()
+        book3.load(_datapath + "/n4-copy")
+        nodeid = book3.search_node_titles("page1")[0][0]
+        page = book3.get_node_by_id(nodeid)
+        with page.open_file('image.png', 'rb') as infile:
+            self.assertEqual(infile.read(), bytes(range(256)))
+        book3.close()
@@ -1,10 +1,15 @@
 
 # python imports
 import os
+import threading
+import time
 import unittest
 
 # keepnote imports
 from keepnote import notebook
+from keepnote import tasklib
+from keepnote.notebook.connection import mem
+from keepnote.notebook.connection.locking import LockedConnection
 import keepnote.notebook.sync as sync
 
 from . import clean_dir, makedirs, TMP_DIR
@@ -77,3 +82,195 @@ class Sync (unittest.TestCase):
         attr = notebook2._conn.read_node(n.get_attr("nodeid"))
         self.assertTrue(attr["title"] == "node2")
         notebook2.close()
+
+    def test_sync_delta(self):
+        """Only changed nodes and files should be transferred."""
+
+        # initialize two notebooks
+        clean_dir(_datapath + "/n3")
+        clean_dir(_datapath + "/n4")
+        makedirs(_datapath)
+
+        notebook1 = notebook.NoteBook()
+        notebook1.create(_datapath + "/n3")
+
+        notebook2 = notebook.NoteBook()
+        notebook2.create(_datapath + "/n4")
+
+        # create a small subtree in notebook1
+        n = notebook1.new_child("text/html", "node1")
+        for i in range(5):
+            out = n.open_file("file" + str(i), "w")
+            out.write("hello" + str(i))
+            out.close()
+        n.open_file("dir/hello", "w").close()
+        child = n.new_child("text/html", "child1")
+        child.open_file("page.html", "w").close()
+
+        # transfer subtree to notebook2
+        attr = dict(n._attr)
+        attr["parentids"] = [notebook2.get_attr("nodeid")]
+        nodeid = attr["nodeid"]
+        synced = sync.sync_tree(nodeid, notebook1._conn, notebook2._conn,
+                                attr)
+        self.assertEqual(synced, [nodeid, child.get_attr("nodeid")])
+        self.assertEqual(
+            notebook2._conn.open_file(nodeid, "file2").read(), "hello2")
+
+        # manifests should now match and nothing is transferred
+        self.assertTrue(sync.manifests_equal(
+            sync.get_manifest(notebook1._conn, nodeid, attr),
+            sync.get_manifest(notebook2._conn, nodeid)))
+        self.assertEqual(sync.sync_tree(nodeid, notebook1._conn,
+                                        notebook2._conn, attr), [])
+
+        # change only a file and sync the tree
+        out = n.open_file("file0", "w")
+        out.write("edited")
+        out.close()
+        self.assertEqual(sync.sync_tree(nodeid, notebook1._conn,
+                                        notebook2._conn, attr), [nodeid])
+        self.assertEqual(
+            notebook2._conn.open_file(nodeid, "file0").read(), "edited")
+
+        # change one file and remove another
+        out = n.open_file("file1", "w")
+        out.write("changed")
+        out.close()
+        n.delete_file("file3")
+        copied = sync.sync_files(notebook1._conn, nodeid,
+                                 notebook2._conn, nodeid)
+        self.assertEqual(copied, ["file1"])
+        self.assertEqual(
+            notebook2._conn.open_file(nodeid, "file1").read(), "changed")
+        self.assertFalse(notebook2._conn.has_file(nodeid, "file3"))
+
+        notebook1.close()
+        notebook2.close()
+
+    def test_sync_newer_target(self):
+        """A newer node in the target keeps its attr and files."""
+        conn1 = mem.NoteBookConnectionMem()
+        conn2 = mem.NoteBookConnectionMem()
+        for conn, title, mtime, page in ((conn1, "old", 1, "OLD"),
+                                         (conn2, "new", 5, "NEW")):
+            conn.create_node("node1", {"nodeid": "node1", "title": title,
+                                       "modified_time": mtime})
+            with conn.open_file("node1", "page.html", "w") as out:
+                out.write(page)
+
+        for on_conflict in (sync.on_conflict_newer,
+                            sync.on_conflict_reject):
+            sync.sync_tree("node1", conn1, conn2, on_conflict=on_conflict)
+            self.assertEqual(conn2.read_node("node1")["title"], "new")
+            self.assertEqual(
+                conn2.open_file("node1", "page.html").read(), "NEW")
+
+        # a newer source node wins
+        conn1.update_node("node1", {"nodeid": "node1", "title": "newest",
+                                    "modified_time": 10})
+        sync.sync_tree("node1", conn1, conn2)
+        self.assertEqual(conn2.read_node("node1")["title"], "newest")
+        self.assertEqual(conn2.open_file("node1", "page.html").read(), "OLD")
+
+    def test_sync_parallel(self):
+        """Subtrees can be synced with a pool of workers."""
+
+        # memory connections are thread-safe, so each worker can use its
+        # own connection to them
+        conn1 = mem.NoteBookConnectionMem()
+        conn2 = mem.NoteBookConnectionMem()
+        conn2.create_node("root2", {"nodeid": "root2"})
+
+        # create a subtree in conn1
+        nodeids = ["node%d" % i for i in range(11)]
+        attr = {"nodeid": nodeids[0], "title": "node1",
+                "parentids": ["root2"], "childrenids": nodeids[1:]}
+        conn1.create_node(nodeids[0], attr)
+        for i, nodeid in enumerate(nodeids[1:]):
+            conn1.create_node(nodeid, {"nodeid": nodeid,
+                                       "title": "child%d" % i,
+                                       "parentids": [nodeids[0]]})
+            with conn1.open_file(nodeid, "page.html", "w") as out:
+                out.write("page%d" % i)
+
+        # file writes are slowed down to check that workers overlap
+        lock = threading.Lock()
+        active = [0]
+        overlaps = []
+        workers = []
+
+        class WorkerConnection (LockedConnection):
+            def open_file(self, nodeid, filename, mode="r", codec=None):
+                if mode.startswith("w"):
+                    with lock:
+                        active[0] += 1
+                        overlaps.append(active[0] > 1)
+                    time.sleep(0.05)
+                    with lock:
+                        active[0] -= 1
+                return LockedConnection.open_file(
+                    self, nodeid, filename, mode, codec)
+
+            def close(self):
+                workers.append(self)
+
+        scheduler = sync.SyncScheduler(conn1, conn2, nworkers=3,
+                                       connect=WorkerConnection)
+
+        # a stopped task cancels the sync
+        task = tasklib.Task()
+        task.run()
+        task.stop()
+        self.assertRaises(sync.SyncCanceled, lambda:
+                          scheduler.sync_tree(nodeids[0], attr, task=task))
+
+        # sync subtree and report progress
+        task = tasklib.Task()
+        task.run()
+        synced = scheduler.sync_tree(nodeids[0], attr, task=task)
+        self.assertEqual(set(synced), set(nodeids))
+        self.assertEqual(task.get_percent(), 1.0)
+        self.assertTrue(any(overlaps))
+        self.assertTrue(len(workers) > 2)
+
+        for i, nodeid in enumerate(nodeids[1:]):
+            self.assertEqual(conn2.open_file(nodeid, "page.html").read(),
+                             "page%d" % i)
+
+    def test_sync_cancel(self):
+        """A canceled sync removes the nodes it created."""
+        conn1 = mem.NoteBookConnectionMem()
+        conn2 = mem.NoteBookConnectionMem()
+        conn2.create_node("root2", {"nodeid": "root2"})
+        nodeids = ["node%d" % i for i in range(6)]
+        attr = {"nodeid": nodeids[0], "parentids": ["root2"],
+                "childrenids": nodeids[1:]}
+        conn1.create_node(nodeids[0], attr)
+        for nodeid in nodeids[1:]:
+            conn1.create_node(nodeid, {"nodeid": nodeid,
+                                       "parentids": [nodeids[0]]})
+            with conn1.open_file(nodeid, "page.html", "w") as out:
+                out.write("page")
+
+        # cancel once the first node has its files
+        task = tasklib.Task()
+        task.run()
+
+        class CancelConnection (LockedConnection):
+            def open_file(self, nodeid, filename, mode="r", codec=None):
+                if mode.startswith("w"):
+                    task.stop()
+                return LockedConnection.open_file(
+                    self, nodeid, filename, mode, codec)
+
+            def close(self):
+                pass
+
+        scheduler = sync.SyncScheduler(conn1, conn2, nworkers=1,
+                                       connect=CancelConnection)
+        self.assertRaises(sync.SyncCanceled, lambda:
+                          scheduler.sync_tree(nodeids[0], attr, task=task))
+        for nodeid in nodeids:
+            self.assertFalse(conn2.has_node(nodeid))
+        self.assertTrue(conn2.has_node("root2"))
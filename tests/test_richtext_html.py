@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 # python import
+import os
 import time
 import sys
 from io import StringIO
@@ -8,8 +9,9 @@ from unittest import TestCase
 
 # keepnote imports
 from keepnote.gui.richtext.richtext_html import HtmlBuffer, nest_indent_tags, \
-    find_paragraphs, P_TAG
+    find_paragraphs, get_tokenizers, P_TAG
 from keepnote.gui.richtext import RichTextIO
+from keepnote.gui.richtext.segment_cache import SegmentCache
 
 from keepnote.gui.richtext.richtextbuffer import RichTextBuffer, ignore_tag, \
     RichTextIndentTag
@@ -18,9 +20,14 @@ from keepnote.gui.richtext.textbuffer_tools import \
     insert_buffer_contents, \
     normalize_tags, \
     iter_buffer_contents, \
+    iter_buffer_contents_fast, \
     PushIter, \
     TextBufferDom
 
+from . import make_clean_dir, TMP_DIR, DATA_DIR
+
+_tmpdir = os.path.join(TMP_DIR, 'richtext_html')
+
 
 def display_item(item):
     """Return a string representing a buffer item"""
@@ -692,6 +699,139 @@ class Html (BufferBase):
         self.assertEqual(list(map(display_item, contents)),
                          [' hello  bye'])
 
+    def test_read_chunks(self):
+        """Reading in small chunks should give the same contents"""
+        html = ("<b>bold</b> line1<br/>\nline2 &amp; more<br/>\n"
+                "<ul><li>one</li><li>two<ol><li>a</li></ol></li></ul>"
+                "<i>italic\n  text</i><br/>\n" * 20 +
+                "a long  run of text " * 20)
+
+        contents = list(self.io.read(StringIO(html), partial=True))
+        chunks = list(self.io.read_chunks(StringIO(html), partial=True,
+                                          chunk_size=50))
+        self.assertTrue(len(chunks) > 1)
+
+        contents2 = []
+        for chunk in chunks:
+            contents2.extend(chunk)
+        self.assertEqual(list(map(display_item, contents2)),
+                         list(map(display_item, contents)))
+
+    def test_segment_cache(self):
+        """Incremental writing should match writing the whole buffer"""
+        html = ("<b>bold</b> line1<br/>\nline2 &amp; more<br/>\n"
+                "<ul><li>one</li><li>two</li></ul>"
+                "<i>italic<br/>\ntext</i><br/>\n<hr/>\nend<br/>\n" * 5)
+        self.read(self.buffer, StringIO(html))
+        cache = SegmentCache(self.buffer)
+
+        def check():
+            outfile = StringIO()
+            self.write(self.buffer, outfile)
+            self.assertEqual("".join(cache.get_html(self.io)),
+                             outfile.getvalue())
+            self.assertEqual(cache.get_dirty(), 0)
+
+        check()
+        nsegments = len(cache)
+        self.assertTrue(nsegments > 5)
+
+        # typing only dirties nearby segments
+        it = self.buffer.get_iter_at_line(1)
+        self.buffer.insert(it, "new ")
+        self.assertTrue(cache.get_dirty() < 4)
+        check()
+
+        # fonts and deletions across segment boundaries
+        bold = self.buffer.tag_table.lookup("bold")
+        self.buffer.apply_tag(bold, self.buffer.get_iter_at_line(2),
+                              self.buffer.get_iter_at_line(8))
+        check()
+        self.buffer.delete(self.buffer.get_iter_at_line(4),
+                           self.buffer.get_iter_at_line(10))
+        check()
+        self.buffer.insert(self.buffer.get_end_iter(), "\nlast")
+        check()
+        cache.close()
+
+    def test_iter_contents_fast(self):
+        """The fast content iterator should match iter_buffer_contents"""
+        def items(contents):
+            return [(item[0], item[1].get_offset(), display_item(item))
+                    for item in contents]
+
+        filenames = []
+        for root, dirs, files in os.walk(DATA_DIR):
+            if "page.html" in files:
+                filenames.append(os.path.join(root, "page.html"))
+        self.assertTrue(len(filenames) > 0)
+
+        for filename in sorted(filenames):
+            self.buffer.clear()
+            with open(filename, encoding="utf8") as infile:
+                self.read(self.buffer, infile)
+            self.assertEqual(
+                items(iter_buffer_contents_fast(self.buffer, None, None,
+                                                ignore_tag)),
+                items(iter_buffer_contents(self.buffer, None, None,
+                                           ignore_tag)), filename)
+
+            # partial ranges
+            start = self.buffer.get_iter_at_offset(3)
+            end = self.buffer.get_iter_at_offset(40)
+            self.assertEqual(
+                items(iter_buffer_contents_fast(self.buffer, start, end)),
+                items(iter_buffer_contents(self.buffer, start, end)),
+                filename)
+
+    def test_tokenizers(self):
+        """All HTML tokenizers should read the test pages the same way"""
+        tokenizers = get_tokenizers()
+        if len(tokenizers) < 2:
+            self.skipTest("only one HTML tokenizer available")
+
+        for root, dirs, files in os.walk(DATA_DIR):
+            if "page.html" not in files:
+                continue
+            with open(os.path.join(root, "page.html"),
+                      encoding="utf8") as infile:
+                html = infile.read()
+
+            contents = {}
+            for name in tokenizers:
+                io = HtmlBuffer(tokenizer=name)
+                contents[name] = list(map(display_item,
+                                          io.read(StringIO(html))))
+            for name in tokenizers[1:]:
+                self.assertEqual(contents[name], contents[tokenizers[0]],
+                                 root)
+
+    def test_save_async(self):
+        """Saving in the background should write the same file"""
+        make_clean_dir(_tmpdir)
+        html = ("<b>bold</b> line1<br/>\nline2 &amp; more<br/>\n"
+                "<ul><li>one</li><li>two</li></ul>" * 5)
+        self.read(self.buffer, StringIO(html))
+        io = RichTextIO()
+
+        filename = os.path.join(_tmpdir, "page.html")
+        io.save(self.buffer, filename, "title")
+        with open(filename) as infile:
+            expected = infile.read()
+
+        errors = []
+        filename2 = os.path.join(_tmpdir, "page2.html")
+        self.buffer.insert(self.buffer.get_start_iter(), "new ")
+        self.buffer.delete(self.buffer.get_start_iter(),
+                           self.buffer.get_iter_at_offset(4))
+        io.save_async(self.buffer, filename2, "title",
+                      on_done=errors.append)
+        self.assertFalse(self.buffer.get_modified())
+        io.wait_save()
+        self.assertEqual(errors, [None])
+        with open(filename2) as infile:
+            self.assertEqual(infile.read(), expected)
+
 
 class Speed (TestCase):
 
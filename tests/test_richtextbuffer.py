@@ -187,3 +187,41 @@ class TestCaseRichTextBuffer (BufferBase):
                           ['BEGIN:size 30',
                            'hello',
                            'END:size 30'])
+
+    def test_load_contents(self):
+        """Bulk loading gives the same contents as insert_contents"""
+        contents = [("text", None, "hi "),
+                    ("beginstr", None, "bold"),
+                    ("text", None, "there"),
+                    ("beginstr", None, "italic"),
+                    ("text", None, " again"),
+                    ("endstr", None, "italic"),
+                    ("endstr", None, "bold"),
+                    ("text", None, " end")]
+
+        self.buffer.insert_contents(contents)
+        expected = [display_item(x) for x in self.get_contents()]
+
+        self.buffer.clear()
+        self.buffer.block_signals()
+        self.buffer.load_contents(contents)
+        self.buffer.unblock_signals()
+        self.assertEqual([display_item(x) for x in self.get_contents()],
+                         expected)
+
+    def test_bullet_list_lines(self):
+        """Toggling a bullet list updates every selected line"""
+        self.buffer.insert_at_cursor("one\ntwo\nthree\n")
+        self.buffer.select_range(self.buffer.get_start_iter(),
+                                 self.buffer.get_end_iter())
+        self.buffer.toggle_bullet_list("bullet")
+        text = self.buffer.get_text(self.buffer.get_start_iter(),
+                                    self.buffer.get_end_iter(), True)
+        self.assertEqual(text, "• one\n• two\n• three\n")
+
+        self.buffer.select_range(self.buffer.get_start_iter(),
+                                 self.buffer.get_end_iter())
+        self.buffer.toggle_bullet_list("none")
+        text = self.buffer.get_text(self.buffer.get_start_iter(),
+                                    self.buffer.get_end_iter(), True)
+        self.assertEqual(text, "one\ntwo\nthree\n")
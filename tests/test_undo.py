@@ -0,0 +1,86 @@
+# python imports
+import unittest
+
+# keepnote imports
+from keepnote.undo import UndoStack, UndoAction
+
+
+class Typing (UndoAction):
+    """Appends characters to a list"""
+
+    def __init__(self, doc, text):
+        self.doc = doc
+        self.text = text
+
+    def do(self):
+        self.doc.extend(self.text)
+
+    def undo(self):
+        del self.doc[-len(self.text):]
+
+    def get_size(self):
+        return 100 + len(self.text)
+
+    def can_merge(self, action):
+        return isinstance(action, Typing) and action.text != " "
+
+    def merge(self, action):
+        self.text += action.text
+
+
+class Undo (unittest.TestCase):
+
+    def test_funcs(self):
+        """Function pairs can be undone and redone."""
+        doc = []
+        stack = UndoStack()
+        stack.do(lambda: doc.append(1), lambda: doc.pop())
+        stack.begin_action()
+        stack.do(lambda: doc.append(2), lambda: doc.pop())
+        stack.do(lambda: doc.append(3), lambda: doc.pop())
+        stack.end_action()
+        self.assertEqual(doc, [1, 2, 3])
+
+        stack.undo()
+        self.assertEqual(doc, [1])
+        stack.redo()
+        self.assertEqual(doc, [1, 2, 3])
+        stack.undo()
+        stack.undo()
+        self.assertEqual(doc, [])
+
+    def test_merge(self):
+        """Adjacent actions are merged into one undo step."""
+        doc = []
+        stack = UndoStack()
+        for char in "hello world":
+            stack.do_action(Typing(doc, char))
+        self.assertEqual("".join(doc), "hello world")
+        self.assertEqual(len(stack), 2)
+
+        stack.undo()
+        self.assertEqual("".join(doc), "hello")
+        stack.redo()
+        self.assertEqual("".join(doc), "hello world")
+
+        # Actions after an undo start a new step.
+        stack.undo()
+        stack.do_action(Typing(doc, "!"))
+        self.assertEqual(len(stack), 2)
+        stack.undo()
+        self.assertEqual("".join(doc), "hello")
+
+    def test_max_memory(self):
+        """Oldest actions are dropped to stay within the memory budget."""
+        doc = []
+        stack = UndoStack(max_memory=1000)
+        for i in range(20):
+            stack.do_action(Typing(doc, " "))
+        self.assertEqual(len(stack), 9)
+        self.assertTrue(stack.get_memory() <= 1000)
+
+        # The newest action is always kept.
+        stack.set_max_memory(10)
+        self.assertEqual(len(stack), 1)
+        stack.undo()
+        self.assertEqual(len(doc), 19)